@@ -24,6 +24,7 @@ After starting this program, you can execute commands from Gen2 observation
 scripts like:
 
    exec VAMPIRES archive_fits frame_no=&get_f_no[VAMPIRES A] path=/path/to/file.fits
+   exec VAMPIRES archive_fits_bulk manifest=/path/to/manifest.csv
 
 Looking at the methods below the comment "VAMPIRES INSTRUMENT COMMANDS"
 you can get a sense of how to implement new commands.
@@ -39,6 +40,10 @@ from g2base import Bunch, Task
 from g2cam.Instrument import BASECAM, CamError, CamCommandError
 from g2cam.util import common_task
 
+# archive_fits_bulk manifests - next to this file, in cams/
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import archive_manifest
+
 
 class VAMPIRES_Error(CamCommandError):
     pass
@@ -233,6 +238,24 @@ class VAMPIRES(BASECAM):
         self.ocs.archive_framelist(framelist)
 
 
+    def archive_fits_bulk(self, manifest=None, tag=None):
+        """Archive a batch of local files to Gen2 in a single request.
+
+        Parameters
+        ----------
+        manifest: str
+            the local path to a frameid|path|size manifest file, as
+            produced by scxkw-g2archive-manifest
+        """
+
+        framelist = archive_manifest.read_manifest(manifest, VAMPIRES_Error)
+
+        # Tell Gen2 about all the files at once, and it will copy and archive them
+        self.logger.info("Submitting framelist of %d frames from '%s'" % (
+            len(framelist), manifest))
+        self.ocs.archive_framelist(framelist)
+
+
     def get_frames(self, frtype='A', num=1, tag=None):
         # obtain Gen2 frames
         framelist = self.ocs.getFrames(num, frtype)
@@ -0,0 +1,56 @@
+#
+# archive_manifest.py -- archive_fits_bulk manifest reading, shared by the
+# SCEXAO and VAMPIRES personalities
+#
+"""
+A manifest is a frameid|path|size CSV file, as produced by scxkw-g2archive-manifest.
+
+read_manifest checks every row (frame ID format, file exists, size matches) and
+returns the framelist for archive_framelist. Errors are raised as <error_class>,
+the personality's CamCommandError.
+"""
+from __future__ import print_function
+import os
+import re
+import csv
+
+
+def read_manifest(manifest, error_class):
+
+    if manifest is None:
+        raise error_class("Missing manifest!")
+
+    if not os.path.isfile(manifest):
+        raise error_class("Manifest (%s) does not refer to a file!" % (manifest))
+
+    framelist = []
+    with open(manifest, 'r') as in_f:
+        reader = csv.reader(in_f, delimiter='|')
+        for row in reader:
+            if len(row) == 0:
+                continue
+            if len(row) != 3:
+                raise error_class("Manifest line '%s' is not frameid|path|size" % ('|'.join(row)))
+
+            frame_no, path, size = row
+
+            # Check frame_no
+            match = re.match(r'^(\w{3})(\w)(\d{8})$', frame_no)
+            if not match:
+                raise error_class("frame_no: '%s' doesn't match expected format" % (frame_no))
+
+            if not os.path.exists(path):
+                raise error_class("Path (%s) does not refer to a file!" % (path))
+
+            # determine size of file for error checking
+            st = os.stat(path)
+            if st.st_size != int(size):
+                raise error_class("Path (%s) size %d does not match manifest size %s" % (
+                    path, st.st_size, size))
+
+            framelist.append((frame_no, path, st.st_size))
+
+    if len(framelist) == 0:
+        raise error_class("Manifest (%s) is empty!" % (manifest))
+
+    return framelist
@@ -6,22 +6,25 @@ import logging
 
 logg = logging.getLogger(__name__)
 
-import os, glob, time, datetime, subprocess
+import os, time, datetime, csv, threading
 
 from tqdm import tqdm
 from tqdm.contrib.logging import logging_redirect_tqdm
 from scxkw.config import GEN2PATH_NODELETE, GEN2PATH_OKDELETE, CAMIDS
-from scxkw.tools.compression_job_manager import FPackJobCodeEnum, FpackJobManager
+from scxkw.tools.compression_job_manager import FpackJobManager
+from scxkw.tools.job_registry import JOBKIND, get_job_registry
 
 from ..tools import file_tools
 from ..tools.vampires_synchro import VampiresSynchronizer
 from ..tools.fits_file_obj import FitsFileObj
+from ..tools.transfer_scheduler import TransferItem, TransferScheduler
+from ..tools.archive_catalog import ArchiveCatalog, STAGE, classify_stage, get_catalog
+from ..tools.archive_watcher import ArchiveWatcher
+from ..tools.logshim_txt_parser import TIMING_SIDECAR_SUFFIX, timing_sidecar_path
 
 if typ.TYPE_CHECKING:
     from g2base.remoteObjects import remoteObjects as ro
 
-from astropy.io import fits
-
 import shutil
 
 
@@ -100,131 +103,243 @@ def archive_monitor_process_filename(raw_file_list: typ.List[str],
     return file_list, file_list_shortname, stream_names, dates
 
 
-def archive_monitor_push_files(g2proxy_obj,
-                               n_files_max=None,
-                               *,
-                               skip_last_wait=True,
-                               time_allowed=(1080, 1380),
-                               bandwidth_mbps_assumed=800):
-
+def archive_log_requested(paths: typ.Iterable[str]) -> None:
     '''
-        Macro function: push .fits.fz files in GEN2_NODELETE path to gen2.
-
-        Look for SCX*.fits.fz files - check the compression job is not ongoing.
-        Request a push to gen2.
-        Sleep assuming a given bandwidth.
+        Utility function - append requested file names to the archive_requested.txt of their
+        <date>/<stream> folder. This is only a human-readable log: state is in the catalog.
+    '''
+    per_folder: typ.Dict[str, typ.List[str]] = {}
+    for path in paths:
+        folder, shortname = path.rsplit('/', 1)
+        per_folder.setdefault(folder, []).append(shortname + '\n')
+    for folder, lines in per_folder.items():
+        with open(folder + '/archive_requested.txt', 'a') as archive_logfile:
+            archive_logfile.writelines(lines)
 
-        Already requested files are stored in archive_requested.txt folder in each repo
 
-        Behold ! It does not mean the g2 request will be executed right away.
-        We need to wait for STARS feedback to allow deletion.
+def archive_check_time_allowed(time_allowed: typ.Optional[typ.Tuple[int, int]]) -> bool:
     '''
+        Utility function - is the current UT time (in minutes) within the (start, stop) window?
 
+        Windows may wrap around midnight, e.g. (1380, 60). None means always allowed.
+    '''
     if time_allowed is None:
-        time_allowed = (0, 1440)
+        return True
     time_start, time_stop = time_allowed
 
-    # Is this allowed to run now?
     current_time = datetime.datetime.now()
     t_minutes = current_time.hour * 60 + current_time.minute
-    if (((time_stop >= time_start) and ((t_minutes < time_start) or
-                                        (t_minutes >= time_stop)))
-            or ((time_stop < time_start) and (t_minutes >= time_stop) and
-                (t_minutes < time_start))):
-        print(
-            f'archive_monitor_push_files not allowed to run at this time ({time_start // 60}h{time_start % 60:02d}-{time_stop // 60}h{time_stop % 60:02d} UT)'
-        )
-        return
 
-    fz_file_list = glob.glob(GEN2PATH_NODELETE + '*/*/SCX*.fits.fz')
+    if time_stop >= time_start:
+        return time_start <= t_minutes < time_stop
+    else:
+        return t_minutes >= time_start or t_minutes < time_stop
+
+
+def archive_list_running_fpack_targets() -> typ.Set[str]:
+    '''
+        Utility function - full paths of the files fpack is running on, from the shared job registry.
+    '''
+    return get_job_registry().running_targets(JOBKIND.FPACK)
+
+
+def archive_list_pushable_files(prefix: str, catalog: ArchiveCatalog,
+                                n_files_max: typ.Optional[int] = None) -> typ.List[typ.Tuple[str, str, str, str]]:
+    '''
+        Utility function - list <prefix>*.fits.fz files in GEN2_NODELETE that are not
+        being compressed and have not been requested for archiving yet.
+
+        Returns a sorted list of (fullname, shortname, stream, date)
+    '''
+    catalog.refresh()
+    fz_file_list = catalog.query_paths([STAGE.COMPRESSED], name_prefix=prefix, suffix='.fits.fz')
     # Exclude running fpack jobs if any
-    running_jobs = subprocess.run(
-        'ps -eo args | grep fpack', shell=True,
-        capture_output=True).stdout.decode('utf8').rstrip().split('\n')
-    running_jobs = [
-        job.split(' ')[-1] for job in running_jobs if job[-5:] == ".fits"
-    ]  # Now this should be a full path!
-
-    file_list = list(set(fz_file_list) - set(running_jobs))
+    running_jobs = archive_list_running_fpack_targets()
+
+    # fpack writes <file>.fits.fz from <file>.fits
+    file_list = [f for f in fz_file_list if f[:-3] not in running_jobs]
     file_list.sort()
 
     (file_list, file_list_shortname, stream_names,
      dates) = archive_monitor_process_filename(file_list, True)
 
-    if n_files_max is None or n_files_max > len(file_list):
-        n_files_max = len(file_list)
+    to_push = list(zip(file_list, file_list_shortname, stream_names, dates))
 
-    print(f'archive_monitor_push_files: {GEN2PATH_NODELETE}*/*/SCX*.fits.fz')
-    print(
-        f'archive_monitor_push_files: found {n_files_max} SCX*.fits.fz files...'
-    )
+    if n_files_max is not None:
+        to_push = to_push[:n_files_max]
 
-    for ii in range(len(file_list)):
+    return to_push
 
-        if ii == n_files_max:
-            break
 
-        # Open the tracking file
-        this_file_shortname = file_list_shortname[ii]
-        archive_req_filename = GEN2PATH_NODELETE + f'/{dates[ii]}/{stream_names[ii]}/archive_requested.txt'
-        try:
-            with open(archive_req_filename, 'r') as archive_logfile:
-                files_pushed = [
-                    l.rstrip() for l in archive_logfile.readlines()
-                ]
-        except FileNotFoundError:
-            files_pushed = []
+def per_thread_proxy(g2proxy_factory: typ.Callable[[], ro.remoteObjectProxy]) -> typ.Callable[[], ro.remoteObjectProxy]:
+    '''
+        Utility function - one remoteObjectProxy per calling thread, made by g2proxy_factory on first use.
+    '''
+    local = threading.local()
 
-        if this_file_shortname in files_pushed:  # File has been requested for push yet
-            # We skip a file so we give us one more n_file_max
-            n_files_max += 1
-            continue
+    def get_proxy() -> ro.remoteObjectProxy:
+        if not hasattr(local, 'proxy'):
+            local.proxy = g2proxy_factory()
+        return local.proxy
 
-        # Get file size
-        # Assume tranfer speed of 90 MB/s, only wait if it's not the last file.
-        size_MB = os.stat(file_list[ii]).st_size / 1024 / 1024
-        how_long = size_MB / (bandwidth_mbps_assumed / 8)
+    return get_proxy
+
+
+def archive_monitor_push_files(g2proxy_factory: typ.Callable[[], ro.remoteObjectProxy],
+                               n_files_max=None,
+                               *,
+                               time_allowed=(1080, 1380),
+                               n_workers=8,
+                               catalog: typ.Optional[ArchiveCatalog] = None):
+
+    '''
+        Macro function: push .fits.fz files in GEN2_NODELETE path to gen2.
+
+        Look for SCX*.fits.fz files - check the compression job is not ongoing.
+        Request a push to gen2, with up to <n_workers> requests in flight.
+        Gen2 acknowledges a request before the transfer happens: the upload itself
+        is paced by Gen2, not here.
+
+        g2proxy_factory() makes the 'SCEXAO' remoteObjectProxy - one per worker thread.
+
+        Already requested files are at the REQUESTED stage in the archive catalog,
+        and logged in archive_requested.txt in each <date>/<stream> folder.
+
+        Behold ! It does not mean the g2 request will be executed right away.
+        We need to wait for STARS feedback to allow deletion.
+    '''
 
+    if not archive_check_time_allowed(time_allowed):
+        print(f'archive_monitor_push_files not allowed to run at this time {time_allowed}.')
+        return
+
+    if catalog is None:
+        catalog = get_catalog(GEN2PATH_NODELETE)
+
+    to_push = archive_list_pushable_files('SCX', catalog, n_files_max)
+
+    print(f'archive_monitor_push_files: {GEN2PATH_NODELETE}*/*/SCX*.fits.fz')
+    print(f'archive_monitor_push_files: found {len(to_push)} SCX*.fits.fz files...')
+
+    get_proxy = per_thread_proxy(g2proxy_factory)
+
+    def send_func(item: TransferItem):
         # Send gen2 transfer query (remove .fits extension)
-        g2proxy_obj.executeCmd('SCEXAO', 'foo', 'archive_fits', [], {
-            'frame_no': this_file_shortname.split('.')[0],
-            'path': file_list[ii]
+        fullname, shortname, _, _ = item.payload
+        get_proxy().executeCmd('SCEXAO', 'foo', 'archive_fits', [], {
+            'frame_no': shortname.split('.')[0],
+            'path': fullname
         })
-        print(f'Submitting {this_file_shortname} to gen2 archive.')
+
+    def on_done(item: TransferItem):
         # Note that the query has been issued
-        with open(archive_req_filename, 'a') as archive_logfile:
-            archive_logfile.write(this_file_shortname + '\n')
-
-        if ii == n_files_max - 1 and skip_last_wait:
-            print(
-                f'Expected transfer time for last file is {how_long} sec from now ({size_MB} MB).'
-            )
-        else:
-            print(
-                f'Waiting {how_long} sec for file {ii+1}/{n_files_max} to transfer ({size_MB} MB).'
-            )
-            time.sleep(how_long)
-
-        # Is this still allowed to run now?
-        current_time = datetime.datetime.now()
-        t_minutes = current_time.hour * 60 + current_time.minute
-        if (((time_stop >= time_start) and ((t_minutes < time_start) or
-                                            (t_minutes >= time_stop)))
-                or ((time_stop < time_start) and (t_minutes >= time_stop) and
-                    (t_minutes < time_start))):
-            print(
-                f"archive_monitor_push_files: aborting gen2 upload requests at {current_time.hour}:{current_time.minute}"
-            )
-            break
+        fullname = item.payload[0]
+        catalog.set_stage([fullname], STAGE.REQUESTED)
+        archive_log_requested([fullname])
 
+    scheduler = TransferScheduler(send_func,
+                                  n_workers=n_workers,
+                                  keep_going=lambda: archive_check_time_allowed(time_allowed),
+                                  on_done=on_done)
+    scheduler.run(TransferItem(p[1], os.stat(p[0]).st_size, p) for p in to_push)
 
-def archive_migrate_compressed_files(*, time_allowed=(17*60, 17*60 + 30)):
+
+def write_archive_manifest(file_list: typ.List[str], manifest_filename: str) -> int:
+    '''
+        Utility function - write a frameid|path|size manifest, in the same
+        format as scxkw-g2archive-manifest, for files already renamed to their frame ID.
+
+        Returns the total size in bytes of the files in the manifest.
+    '''
+    total_bytes = 0
+    with open(manifest_filename, 'w', newline='') as csv_f:
+        writer = csv.writer(csv_f, delimiter='|')
+        for fullname in file_list:
+            filename = fullname.split('/')[-1]
+            frame_id = filename.split('.')[0].upper()
+            size_bytes = os.stat(fullname).st_size
+            total_bytes += size_bytes
+            writer.writerow([frame_id, fullname, size_bytes])
+
+    return total_bytes
+
+
+def archive_monitor_push_files_bulk(g2proxy_factory: typ.Callable[[], ro.remoteObjectProxy],
+                                    n_files_max=None,
+                                    *,
+                                    instrument='SCEXAO',
+                                    files_per_request=500,
+                                    time_allowed=(1080, 1380),
+                                    n_workers=4,
+                                    catalog: typ.Optional[ArchiveCatalog] = None):
+    '''
+        Macro function: push .fits.fz files in GEN2_NODELETE path to gen2,
+        a manifest of up to <files_per_request> files per archive_fits_bulk request.
+
+        instrument: 'SCEXAO' pushes SCX*.fits.fz, 'VAMPIRES' pushes VMP*.fits.fz
+            g2proxy_factory() must make the matching remoteObjectProxy.
+
+        Same worker pool and bookkeeping as archive_monitor_push_files.
+    '''
+    prefix = {'SCEXAO': 'SCX', 'VAMPIRES': 'VMP'}[instrument]
+
+    if not archive_check_time_allowed(time_allowed):
+        print(f'archive_monitor_push_files_bulk not allowed to run at this time {time_allowed}.')
+        return
+
+    if catalog is None:
+        catalog = get_catalog(GEN2PATH_NODELETE)
+
+    to_push = archive_list_pushable_files(prefix, catalog, n_files_max)
+
+    print(f'archive_monitor_push_files_bulk: found {len(to_push)} {prefix}*.fits.fz files to push.')
+
+    def make_items():
+        for kk in range(0, len(to_push), files_per_request):
+            batch = to_push[kk:kk + files_per_request]
+            manifest_filename = f'/tmp/archive_manifest_{prefix}_{int(time.time())}_{kk // files_per_request}.csv'
+            total_bytes = write_archive_manifest([b[0] for b in batch], manifest_filename)
+            yield TransferItem(manifest_filename, total_bytes, batch)
+
+    get_proxy = per_thread_proxy(g2proxy_factory)
+
+    def send_func(item: TransferItem):
+        print(f'Submitting {len(item.payload)} files ({item.n_bytes / 1024**2:.1f} MB) to gen2 archive '
+              f'with {item.name}.')
+        # The cam reads the manifest before archive_fits_bulk returns - it's garbage afterwards.
+        try:
+            get_proxy().executeCmd(instrument, 'foo', 'archive_fits_bulk', [], {
+                'manifest': item.name
+            })
+        finally:
+            os.remove(item.name)
+
+    def on_done(item: TransferItem):
+        # Note that the queries have been issued
+        fullnames = [p[0] for p in item.payload]
+        catalog.set_stage(fullnames, STAGE.REQUESTED)
+        archive_log_requested(fullnames)
+
+    scheduler = TransferScheduler(send_func,
+                                  n_workers=n_workers,
+                                  keep_going=lambda: archive_check_time_allowed(time_allowed),
+                                  on_done=on_done)
+    scheduler.run(make_items())
+
+
+def archive_migrate_compressed_files(*, time_allowed=(17*60, 17*60 + 30),
+                                     catalog: typ.Optional[ArchiveCatalog] = None,
+                                     job_manager: typ.Optional[FpackJobManager] = None):
     '''
         Macro function
 
         Watches for SCX|VMP*.fits.fz files and moves the corresponding SCX|VMP*.fits from GEN2_NODELETE to GEN2_OKDELETE
 
         Is only allowed during certain times to avoid confusion during a night - default 7AM - 7:30AM = 17h UT - should be blazing fast.
+
+        Works per <date>/<stream> folder: one listing, all the moves, one copy of name_changes.txt
+        and one emptiness check per folder.
+        Files with a running fpack job are taken from job_manager if provided, from the job registry otherwise.
     '''
     # Is this allowed to run now?
     time_start, time_stop = time_allowed
@@ -239,22 +354,20 @@ def archive_migrate_compressed_files(*, time_allowed=(17*60, 17*60 + 30)):
         )
         return
 
+    if catalog is None:
+        catalog = get_catalog(GEN2PATH_NODELETE)
+    catalog.refresh()
+
     # Process relevant file list: fz files exist and SCX file exists and no fpack job running
-    scx_file_list = glob.glob(GEN2PATH_NODELETE + '*/*/SCX*.fits') + glob.glob(GEN2PATH_NODELETE + '*/*/VMP*.fits')
-    fz_file_list = glob.glob(GEN2PATH_NODELETE + '*/*/SCX*.fits.fz') + glob.glob(GEN2PATH_NODELETE + '*/*/VMP*.fits.fz')
-    # Remove the fz extension from the fz files
-    fz_file_list = [filename[:-3] for filename in fz_file_list]
-
-    # Now check for active fpack jobs! We spawn fpack jobs with the full file path so we expect them as such
-    running_jobs = subprocess.run(
-        'ps -eo args | grep fpack', shell=True,
-        capture_output=True).stdout.decode('utf8').rstrip().split('\n')
-    running_jobs = [
-        job.split(' ')[-1] for job in running_jobs if job[-5:] == ".fits"
-    ]  # Now this should be a full path!
-
-    file_list = list(
-        set(fz_file_list).intersection(set(scx_file_list)) - set(running_jobs))
+    fits_and_fz_list = catalog.query_compressed_archived()
+
+    # Now check for active fpack jobs!
+    if job_manager is not None:
+        running_jobs = job_manager.running_targets()
+    else:
+        running_jobs = archive_list_running_fpack_targets()
+
+    file_list = list(set(fits_and_fz_list) - running_jobs)
     file_list.sort()
 
     (file_list, file_list_shortname, stream_names,
@@ -265,50 +378,61 @@ def archive_migrate_compressed_files(*, time_allowed=(17*60, 17*60 + 30)):
         f'archive_migrate_compressed_files: found {n_files} (SCX|VMP)*.fits files to move...'
     )
 
-    for ii in range(n_files):
-        # Open the tracking file
-        full_filename = file_list[ii]
-        this_file_shortname = file_list_shortname[ii]
+    # Group per <date>/<stream> folder - as the catalog has it.
+    per_folder: typ.Dict[typ.Tuple[str, str, str], typ.List[typ.Tuple[str, str]]] = {}
+    for full_filename, shortname, stream, date in zip(file_list, file_list_shortname, stream_names, dates):
+        per_folder.setdefault((os.path.dirname(full_filename), date, stream), []).append((full_filename, shortname))
 
-        try:
-            os.makedirs(GEN2PATH_OKDELETE + f'/{dates[ii]}/{stream_names[ii]}')
-        except FileExistsError:
-            pass
+    for (folder_from, date, stream), folder_files in per_folder.items():
+        folder_to = os.path.normpath(os.path.join(GEN2PATH_OKDELETE, date, stream))
+
+        os.makedirs(folder_to, exist_ok=True)
 
-        new_full_filename = GEN2PATH_OKDELETE + f'/{dates[ii]}/{stream_names[ii]}/{this_file_shortname}'
+        # Single listing to know which .txt (and .tim.npy) files are there.
+        txt_present = {entry.name for entry in os.scandir(folder_from)
+                       if entry.name.endswith(('.txt', TIMING_SIDECAR_SUFFIX))}
 
-        # Move the file
-        os.rename(full_filename, new_full_filename)
+        for full_filename, shortname in folder_files:
+            new_full_filename = os.path.join(folder_to, shortname)
 
-        ftxt_origin = '.'.join(full_filename.split('.')[:-1]) + '.txt'
-        ftxt_destination = '.'.join(new_full_filename.split('.')[:-1]) + '.txt'
-        # Move the txt file - if it's there.
-        if os.path.exists(ftxt_origin):
-            os.rename(ftxt_origin, ftxt_destination)
+            # Move the file
+            os.rename(full_filename, new_full_filename)
+            catalog.record_move(full_filename, new_full_filename, stage=STAGE.MIGRATED)
 
-        # Carry the name_changes file - yes we're doing this a useless amount of times.
-        shutil.copyfile(
-            GEN2PATH_NODELETE +
-            f'/{dates[ii]}/{stream_names[ii]}/name_changes.txt',
-            GEN2PATH_OKDELETE +
-            f'/{dates[ii]}/{stream_names[ii]}/name_changes.txt')
+            # Move the txt file - if it's there.
+            txt_name = '.'.join(shortname.split('.')[:-1]) + '.txt'
+            if txt_name in txt_present:
+                os.rename(os.path.join(folder_from, txt_name), os.path.join(folder_to, txt_name))
+            sidecar_name = timing_sidecar_path(txt_name)
+            if sidecar_name in txt_present:
+                os.rename(os.path.join(folder_from, sidecar_name), os.path.join(folder_to, sidecar_name))
 
-        # If no more fits in <date>/<stream>/ ?
-        # Delete archive_requested.txt and name_changes.txt
-        local_sublist = glob.glob(GEN2PATH_NODELETE +
-                                  f'{dates[ii]}/{stream_names[ii]}/SCX*.fits') + \
-                        glob.glob(GEN2PATH_NODELETE +
-                                  f'{dates[ii]}/{stream_names[ii]}/VMP*.fits')
-        
-        if len(local_sublist) == 0:
-            os.remove(GEN2PATH_NODELETE +
-                      f'/{dates[ii]}/{stream_names[ii]}/name_changes.txt')
+        # Carry the name_changes file
+        name_changes_from = os.path.join(folder_from, 'name_changes.txt')
+        if os.path.isfile(name_changes_from):
+            shutil.copyfile(name_changes_from, os.path.join(folder_to, 'name_changes.txt'))
 
+            # If no more fits in <date>/<stream>/ ?
+            # Delete name_changes.txt
+            n_local_left = catalog.count_in_folder(folder_from, [STAGE.FRAMEID])
 
+            if n_local_left == 0:
+                os.remove(name_changes_from)
 
-def synchronize_vampires_files(*, folder_root=GEN2PATH_NODELETE, sync_manager: VampiresSynchronizer) -> None:
-    v1_fileobjs = file_tools.make_fileobjs_from_globs([folder_root + '/*/vcam1/*.fits'], [])
-    v2_fileobjs = file_tools.make_fileobjs_from_globs([folder_root + '/*/vcam2/*.fits'], [])
+    catalog.prune_migrated()
+
+
+def synchronize_vampires_files(*, folder_root=GEN2PATH_NODELETE, sync_manager: VampiresSynchronizer,
+                               catalog: typ.Optional[ArchiveCatalog] = None) -> None:
+    if catalog is None:
+        catalog = get_catalog(folder_root)
+    catalog.refresh()
+
+    v1_fileobjs = file_tools.make_fileobjs_from_filenames(
+        catalog.query_paths([STAGE.RAW], streams=['vcam1'], suffix='.fits'))
+    v2_fileobjs = file_tools.make_fileobjs_from_filenames(
+        catalog.query_paths([STAGE.RAW], streams=['vcam2'], suffix='.fits'))
+    catalog.record_fileobjs(v1_fileobjs + v2_fileobjs)
 
     sync_manager.feed_file_objs(v1_fileobjs)
     sync_manager.feed_file_objs(v2_fileobjs)
@@ -316,55 +440,52 @@ def synchronize_vampires_files(*, folder_root=GEN2PATH_NODELETE, sync_manager: V
     sync_manager.process_queues()
 
 
-def archive_monitor_compression(*, job_manager: FpackJobManager) -> tuple[int,int]:
+def archive_monitor_compression(*, job_manager: FpackJobManager,
+                                catalog: typ.Optional[ArchiveCatalog] = None) -> tuple[int,int]:
     '''
         Macro function: watches for SCX*.fits files in GEN2_NODELETE and spawns
         fpack compression jobs.
 
-        Manages a cap of max_jobs compression jobs.
+        The job manager sizes the concurrency and keeps refilling between calls.
     '''
-    all_fits = glob.glob(GEN2PATH_NODELETE + '*/*/SCX*.fits') + glob.glob(GEN2PATH_NODELETE + '*/*/VMP*.fits')
-    all_fzs = glob.glob(GEN2PATH_NODELETE + '*/*/SCX*.fits.fz') + glob.glob(GEN2PATH_NODELETE + '*/*/VMP*.fits.fz')
+    if catalog is None:
+        catalog = get_catalog(GEN2PATH_NODELETE)
+    catalog.refresh()
 
     # Note: for some of those files, the compression job may already be running!
-    only_fits = file_tools.separate_compression_dups(all_fits, all_fzs)
-    # No need for looping on all files, since we're gonna compress ~15-20 at the same time
-    # tops
+    # Oldest first - the job manager refills its slots from that backlog as jobs complete.
+    only_fits = catalog.query_uncompressed_archived()
     n_cands_comp = len(only_fits)
     print(f'archive_monitor_compression: found {n_cands_comp} candidate files for compression.')
-    file_objs = file_tools.make_fileobjs_from_filenames(only_fits[:100])
-    
 
-    # Cleanup:
-    job_manager.refresh_running_jobs()
-    # Spawn and count
-    n_jobs = 0
-    for file_obj in file_objs:
-        ret = job_manager.run_fpack_compression_job(file_obj)
-        if ret == FPackJobCodeEnum.STARTED:
-            n_jobs += 1
-        elif ret == FPackJobCodeEnum.TOOMANY:
-            break
-        # FPackJobCodeEnum.ALREADY_RUNNING continues silently
-    print(f'archive_monitor_compression: '
-          f'found {len(file_objs)} SCX/VMP files to compress; '
-          f'started {n_jobs} fpacks.')
+    n_jobs = job_manager.queue_fpack_jobs(only_fits)
+
+    print(f'archive_monitor_compression: started {n_jobs} fpacks - {job_manager.report()}')
 
     return n_cands_comp, n_jobs
 
 from scxkw.tools.pdi_deinterleave import deinterleave_filechecker, PDIJobCodeEnum, AsyncPDIDeintJobManager
 
-def archive_monitor_deinterleave_or_passthrough(*, folder_root=GEN2PATH_NODELETE, job_manager: AsyncPDIDeintJobManager):
-    # Allowed deinterleave streams and their target folder:
-    PERMISSIBLE_STREAMS = {
-        'apapane': 'agen2',
-        'vsolo1': 'vgen2',
-        'vsolo2': 'vgen2',
-        'vsync': 'vgen2'
-        }
+# Allowed deinterleave streams and their target folder:
+DEINT_TARGET_STREAMS = {
+    'apapane': 'agen2',
+    'vsolo1': 'vgen2',
+    'vsolo2': 'vgen2',
+    'vsync': 'vgen2'
+    }
+
+def archive_monitor_deinterleave_or_passthrough(*, folder_root=GEN2PATH_NODELETE, job_manager: AsyncPDIDeintJobManager,
+                                                catalog: typ.Optional[ArchiveCatalog] = None):
+    PERMISSIBLE_STREAMS = DEINT_TARGET_STREAMS
+
+    if catalog is None:
+        catalog = get_catalog(folder_root)
+    catalog.refresh()
 
-    fileobj_list = file_tools.make_fileobjs_from_globs([folder_root + f'/*/{stream}/*.fits' for stream in PERMISSIBLE_STREAMS], [])
+    fileobj_list = file_tools.make_fileobjs_from_filenames(
+        catalog.query_paths([STAGE.RAW, STAGE.SYNCED], streams=PERMISSIBLE_STREAMS, suffix='.fits'))
     fileobj_list = [f for f in fileobj_list if f.stream_from_foldername in PERMISSIBLE_STREAMS]
+    catalog.record_fileobjs(fileobj_list)
 
     needs_deinterleave = deinterleave_filechecker(fileobj_list)
 
@@ -376,7 +497,9 @@ def archive_monitor_deinterleave_or_passthrough(*, folder_root=GEN2PATH_NODELETE
 
     for file in fileobj_noneed_deint:
         stream = file.stream_from_foldername
+        old_path = file.full_filepath
         file.move_file_to_streamname(PERMISSIBLE_STREAMS[stream])
+        catalog.record_move(old_path, file.full_filepath)
 
     for file in fileobj_need_deint:
         stream = file.stream_from_foldername
@@ -388,6 +511,38 @@ def archive_monitor_deinterleave_or_passthrough(*, folder_root=GEN2PATH_NODELETE
             break
         # We silently pass on ALREADY_RUNNING and on STARTED.
 
+class MONITOR:
+    GET_IDS = 'get_ids'  # archive_monitor_get_ids
+    COMPRESSION = 'compression'  # archive_monitor_compression
+    DEINT = 'deint'  # archive_monitor_deinterleave_or_passthrough
+    SYNC = 'sync'  # synchronize_vampires_files
+
+
+def route_new_files(watcher: ArchiveWatcher) -> typ.Set[str]:
+    '''
+        Utility function - drain the watcher queues, return the MONITORs that have new work.
+
+        Only new .fits files count (not the .fits.fz we write), routed by catalog stage:
+        a frame-ID-renamed file is work for compression, not for get_ids.
+    '''
+    monitors: typ.Set[str] = set()
+    for stream in list(watcher.queues):
+        for path in watcher.pop_queue(stream):
+            name = path.split('/')[-1]
+            if not name.endswith('.fits'):
+                continue
+            stage = classify_stage(stream, name)
+            if stage == STAGE.FRAMEID:
+                monitors.add(MONITOR.COMPRESSION)
+            elif stage == STAGE.DEINT and stream in ('agen2', 'vgen2'):
+                monitors.add(MONITOR.GET_IDS)
+            elif stream in DEINT_TARGET_STREAMS:
+                monitors.add(MONITOR.DEINT)
+            elif stream in ('vcam1', 'vcam2'):
+                monitors.add(MONITOR.SYNC)
+    return monitors
+
+
 def get_ids_count_files(fobj_list: typ.List[FitsFileObj]) -> typ.Dict[str, int]:
     # Dict to count how many IDs we need per "letter"
     per_id_count = {}
@@ -403,27 +558,30 @@ def get_ids_count_files(fobj_list: typ.List[FitsFileObj]) -> typ.Dict[str, int]:
     return per_id_count
 
 def archive_monitor_get_ids(scx_proxy: ro.remoteObjectProxy,
-                            vmp_proxy: ro.remoteObjectProxy):
+                            vmp_proxy: ro.remoteObjectProxy,
+                            catalog: typ.Optional[ArchiveCatalog] = None):
     '''
         Macro function: watches for *.fits files in GEN2_NODELETE and get a frameID for them
     '''
-
-    # List and sort relevant files - expect GEN2PATH/date/stream/*.fits
-    # Set difference to exclude already renamed files
-    # It is important not to hit the .tmp files
-    fobj_list = file_tools.make_fileobjs_from_globs(
-        [GEN2PATH_NODELETE + '*/agen2/*.fits', GEN2PATH_NODELETE + '*/vgen2/*.fits'],
-        [GEN2PATH_NODELETE + '*/agen2/SCX*.fits', GEN2PATH_NODELETE + '*/vgen2/VMP*.fits']
-    )
+    if catalog is None:
+        catalog = get_catalog(GEN2PATH_NODELETE)
+    catalog.refresh()
+
+    # Relevant files - expect GEN2PATH/date/stream/*.fits, not yet renamed to a frame ID
+    # The catalog never lists the tmp/ files
+    fobj_list = file_tools.make_fileobjs_from_filenames(
+        catalog.query_paths([STAGE.DEINT], streams=['agen2', 'vgen2'], suffix='.fits'))
     assert all([not f.is_archived for f in fobj_list])
     assert all([not f.is_compressed for f in fobj_list])
+    catalog.record_fileobjs(fobj_list)
 
-    batch_assign_ids_and_rename(scx_proxy, vmp_proxy, fobj_list)
+    batch_assign_ids_and_rename(scx_proxy, vmp_proxy, fobj_list, catalog=catalog)
 
 
 def batch_assign_ids_and_rename(scx_proxy: ro.remoteObjectProxy,
                                 vmp_proxy: ro.remoteObjectProxy,
-                                fobj_list: typ.List[FitsFileObj]) -> None:
+                                fobj_list: typ.List[FitsFileObj],
+                                catalog: typ.Optional[ArchiveCatalog] = None) -> None:
     
     assert all([not f.is_archived for f in fobj_list])
     assert all([not f.is_compressed for f in fobj_list])
@@ -444,12 +602,11 @@ def batch_assign_ids_and_rename(scx_proxy: ro.remoteObjectProxy,
     for file in pbar:
         frame_id = frame_ids[CAMIDS[file.stream_from_foldername]].pop(0)
 
-        # Update the keyword with the FRAMEID
+        # Update the keyword with the FRAMEID - in place, both cards in one go.
         # This could error?
-        with fits.open(file.full_filepath, "update") as hdul:
-            header: fits.Header = hdul[0].header # get primary header
-            header["FRAMEID"] = frame_id
-            header["EXP-ID"] = frame_id.replace(frame_id[3], "E", 1)
+        file.defer_header_edit("FRAMEID", frame_id)
+        file.defer_header_edit("EXP-ID", frame_id.replace(frame_id[3], "E", 1))
+        file.flush_header_edits()
 
         # Maintain the file/id mapping text files (per date and stream)
         with open(file.full_filepath.parent / 'name_changes.txt',
@@ -457,7 +614,10 @@ def batch_assign_ids_and_rename(scx_proxy: ro.remoteObjectProxy,
             namelog.write(f"{file.file_name}\t{frame_id}.fits\n")
 
         # Rename the files
+        old_path = file.full_filepath
         with logging_redirect_tqdm():
             file.rename_in_folder(frame_id + '.fits')
+        if catalog is not None:
+            catalog.record_move(old_path, file.full_filepath, stage=STAGE.FRAMEID, frame_id=frame_id)
 
     # Done !
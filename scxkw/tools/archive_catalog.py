@@ -0,0 +1,357 @@
+'''
+    SQLite catalog of the archive pipeline files
+
+    One row per .fits / .fits.fz file under an archive root (<root>/<date>/<stream>/<file>),
+    keyed by full path, with the pipeline stage the file is at.
+
+    The catalog is refreshed incrementally: a <date>/<stream> folder is only re-listed
+    if its mtime has changed since the last listing. Pipeline steps that rename or move
+    files also update the catalog explicitly.
+'''
+from __future__ import annotations
+import typing as typ
+
+import logging
+
+logg = logging.getLogger(__name__)
+
+import datetime
+import os
+import sqlite3
+import time
+from pathlib import Path
+
+if typ.TYPE_CHECKING:
+    from .file_obj import MotherOfFileObj as MFFO
+    from .archive_watcher import ArchiveWatcher
+
+
+class STAGE:
+    RAW = 'raw'  # vcam1, vcam2, apapane... straight out of logshim
+    SYNCED = 'synced'  # vsync, vsolo1, vsolo2
+    DEINT = 'deint'  # agen2, vgen2... awaiting a frame ID
+    FRAMEID = 'frameid'  # SCX*.fits, VMP*.fits
+    COMPRESSED = 'compressed'  # *.fits.fz
+    REQUESTED = 'requested'  # *.fits.fz, gen2 archiving requested
+    MIGRATED = 'migrated'  # Moved to GEN2PATH_OKDELETE
+
+
+STREAMS_RAW = ('vcam1', 'vcam2', 'apapane', 'palila')
+STREAMS_SYNCED = ('vsync', 'vsolo1', 'vsolo2')
+STREAMS_DEINT = ('agen2', 'vgen2', 'pgen2')
+
+# Folders whose mtime is this close to their last listing time get re-listed anyway
+# (mtime granularity / a file landing during the listing).
+MTIME_RACE_MARGIN_NS = 2_000_000_000
+
+CATALOG_FILENAME = '.scxkw_catalog.sqlite'
+
+# MIGRATED rows (files moved out of the root) are kept that long after their <date>, then pruned.
+MIGRATED_RETENTION_DAYS = 30
+
+
+def classify_stage(stream: str, name: str) -> str:
+    if name.endswith('.fits.fz'):
+        return STAGE.COMPRESSED
+    if name.startswith('SCX') or name.startswith('VMP'):
+        return STAGE.FRAMEID
+    if stream in STREAMS_SYNCED:
+        return STAGE.SYNCED
+    if stream in STREAMS_DEINT:
+        return STAGE.DEINT
+    return STAGE.RAW
+
+
+def is_catalogable(name: str) -> bool:
+    return name.endswith('.fits') or name.endswith('.fits.fz')
+
+
+class ArchiveCatalog:
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS files (
+            path TEXT PRIMARY KEY,
+            folder TEXT NOT NULL,
+            name TEXT NOT NULL,
+            date TEXT NOT NULL,
+            stream TEXT NOT NULL,
+            stage TEXT NOT NULL,
+            mtime_ns INTEGER,
+            size INTEGER,
+            frame_id TEXT,
+            n_frames INTEGER,
+            t_start REAL,
+            t_end REAL
+        );
+        CREATE INDEX IF NOT EXISTS files_stage ON files (stage, stream);
+        CREATE INDEX IF NOT EXISTS files_folder ON files (folder);
+        CREATE TABLE IF NOT EXISTS folders (
+            folder TEXT PRIMARY KEY,
+            mtime_ns INTEGER NOT NULL,
+            listed_ns INTEGER NOT NULL
+        );
+    '''
+
+    def __init__(self, root: typ.Union[str, Path], db_path: typ.Optional[typ.Union[str, Path]] = None) -> None:
+        self.root = Path(root).absolute()
+        self.db_path = Path(db_path) if db_path is not None else self.root / CATALOG_FILENAME
+
+        # Several processes may share the catalog - be patient with the lock.
+        self.conn = sqlite3.connect(str(self.db_path), timeout=30.0)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript(self.SCHEMA)
+        self.conn.commit()
+
+        # Optional ArchiveWatcher - with live inotify events, refresh() only re-lists dirty folders.
+        self.watcher: typ.Optional[ArchiveWatcher] = None
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def attach_watcher(self, watcher: ArchiveWatcher) -> None:
+        if Path(watcher.root) != self.root:
+            message = f'ArchiveCatalog::attach_watcher: watcher root {watcher.root} is not {self.root}'
+            logg.critical(message)
+            raise AssertionError(message)
+        self.watcher = watcher
+
+    # Discovery
+
+    def refresh(self) -> int:
+        '''
+            Re-list the <date>/<stream> folders whose mtime changed since their last listing.
+
+            Returns the number of folders re-listed.
+        '''
+        if self.watcher is not None and self.watcher.is_live():
+            self.watcher.poll(0.0)
+            full_rescan, dirty_folders = self.watcher.pop_dirty_folders()
+            if not full_rescan:
+                for folder in dirty_folders:
+                    if os.path.isdir(folder):
+                        self.refresh_folder(folder)
+                    else:
+                        self.conn.execute('DELETE FROM files WHERE folder = ? AND stage != ?',
+                                          (folder, STAGE.MIGRATED))
+                        self.conn.execute('DELETE FROM folders WHERE folder = ?', (folder, ))
+                self.conn.commit()
+                return len(dirty_folders)
+
+        known = {
+            row['folder']: (row['mtime_ns'], row['listed_ns'])
+            for row in self.conn.execute('SELECT folder, mtime_ns, listed_ns FROM folders')
+        }
+
+        n_relisted = 0
+        try:
+            date_entries = [e for e in os.scandir(self.root) if e.is_dir() and not e.name.startswith('.')]
+        except FileNotFoundError:
+            return 0
+
+        seen_folders: typ.Set[str] = set()
+        for date_entry in date_entries:
+            for stream_entry in os.scandir(date_entry.path):
+                if not stream_entry.is_dir() or stream_entry.name == 'tmp':
+                    continue
+                folder = stream_entry.path
+                seen_folders.add(folder)
+                mtime_ns = stream_entry.stat().st_mtime_ns
+                if folder in known:
+                    k_mtime, k_listed = known[folder]
+                    if mtime_ns == k_mtime and k_listed - mtime_ns > MTIME_RACE_MARGIN_NS:
+                        continue
+                self.refresh_folder(folder, mtime_ns=mtime_ns, first_time=folder not in known)
+                n_relisted += 1
+
+        # Folders that went away entirely.
+        for folder in set(known) - seen_folders:
+            self.conn.execute('DELETE FROM files WHERE folder = ? AND stage != ?', (folder, STAGE.MIGRATED))
+            self.conn.execute('DELETE FROM folders WHERE folder = ?', (folder, ))
+        self.conn.commit()
+
+        return n_relisted
+
+    def refresh_folder(self, folder: str, *, mtime_ns: typ.Optional[int] = None, first_time: bool = False) -> None:
+        listed_ns = time.time_ns()
+        if mtime_ns is None:
+            mtime_ns = os.stat(folder).st_mtime_ns
+
+        path_folder = Path(folder)
+        stream = path_folder.name
+        date = path_folder.parent.name
+
+        on_disk: typ.Dict[str, os.stat_result] = {}
+        for entry in os.scandir(folder):
+            if entry.is_file() and is_catalogable(entry.name):
+                on_disk[entry.path] = entry.stat()
+
+        in_db = {
+            row['path']: row
+            for row in self.conn.execute('SELECT path, mtime_ns, size, stage FROM files WHERE folder = ?',
+                                         (folder, ))
+        }
+
+        for path in set(in_db) - set(on_disk):
+            if in_db[path]['stage'] != STAGE.MIGRATED:
+                self.conn.execute('DELETE FROM files WHERE path = ?', (path, ))
+
+        for path, st in on_disk.items():
+            row = in_db.get(path)
+            if row is not None and row['mtime_ns'] == st.st_mtime_ns and row['size'] == st.st_size:
+                continue
+            name = path.split('/')[-1]
+            stage = classify_stage(stream, name)
+            if row is not None and row['stage'] == STAGE.REQUESTED and stage == STAGE.COMPRESSED:
+                stage = STAGE.REQUESTED
+            self.conn.execute(
+                'INSERT INTO files (path, folder, name, date, stream, stage, mtime_ns, size) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?) '
+                'ON CONFLICT(path) DO UPDATE SET stage=excluded.stage, mtime_ns=excluded.mtime_ns, '
+                'size=excluded.size, '
+                # Header patches keep the size - the frame count and timings are still good.
+                'n_frames=CASE WHEN files.size = excluded.size THEN files.n_frames END, '
+                't_start=CASE WHEN files.size = excluded.size THEN files.t_start END, '
+                't_end=CASE WHEN files.size = excluded.size THEN files.t_end END',
+                (path, folder, name, date, stream, stage, st.st_mtime_ns, st.st_size))
+
+        if first_time:
+            self._import_legacy_tracking(folder)
+
+        self.conn.execute(
+            'INSERT INTO folders (folder, mtime_ns, listed_ns) VALUES (?, ?, ?) '
+            'ON CONFLICT(folder) DO UPDATE SET mtime_ns=excluded.mtime_ns, listed_ns=excluded.listed_ns',
+            (folder, mtime_ns, listed_ns))
+        self.conn.commit()
+
+    def _import_legacy_tracking(self, folder: str) -> None:
+        '''
+            Bootstrap from the archive_requested.txt file the first time we see a folder,
+            so that we don't re-request everything.
+        '''
+        try:
+            with open(folder + '/archive_requested.txt', 'r') as archive_logfile:
+                requested = [l.rstrip() for l in archive_logfile.readlines()]
+        except FileNotFoundError:
+            return
+        self.conn.executemany('UPDATE files SET stage = ? WHERE path = ? AND stage = ?',
+                              [(STAGE.REQUESTED, folder + '/' + name, STAGE.COMPRESSED)
+                               for name in requested])
+
+    # Updates from the pipeline
+
+    def record_move(self, old_path: typ.Union[str, Path], new_path: typ.Union[str, Path], *,
+                    stage: typ.Optional[str] = None, frame_id: typ.Optional[str] = None) -> None:
+        old_path, new_path = str(old_path), str(new_path)
+        path_new = Path(new_path)
+        stream, date = path_new.parent.name, path_new.parent.parent.name
+        if stage is None:
+            stage = classify_stage(stream, path_new.name)
+
+        self.conn.execute('DELETE FROM files WHERE path = ?', (new_path, ))
+        cur = self.conn.execute(
+            'UPDATE files SET path = ?, folder = ?, name = ?, date = ?, stream = ?, stage = ?, '
+            'frame_id = COALESCE(?, frame_id) WHERE path = ?',
+            (new_path, str(path_new.parent), path_new.name, date, stream, stage, frame_id, old_path))
+        if cur.rowcount == 0:
+            self.conn.execute(
+                'INSERT INTO files (path, folder, name, date, stream, stage, frame_id) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (new_path, str(path_new.parent), path_new.name, date, stream, stage, frame_id))
+        self.conn.commit()
+
+    def set_stage(self, paths: typ.Iterable[typ.Union[str, Path]], stage: str) -> None:
+        self.conn.executemany('UPDATE files SET stage = ? WHERE path = ?',
+                              [(stage, str(p)) for p in paths])
+        self.conn.commit()
+
+    def record_fileobjs(self, fobjs: typ.Iterable[MFFO]) -> None:
+        '''
+            Store the frame count and timing summary of files we've already opened
+            - from their cached metadata, see fileobj_cache.
+        '''
+        rows = []
+        for fobj in fobjs:
+            try:
+                t_start: typ.Optional[float] = fobj.get_start_unixtime_secs()
+                t_end: typ.Optional[float] = fobj.get_finish_unixtime_secs()
+            except (AssertionError, KeyError, ValueError):
+                t_start, t_end = None, None
+            rows.append((fobj.get_nframes(), t_start, t_end, str(fobj.full_filepath)))
+        self.conn.executemany('UPDATE files SET n_frames = ?, t_start = ?, t_end = ? WHERE path = ?', rows)
+        self.conn.commit()
+
+    def prune_migrated(self, retention_days: int = MIGRATED_RETENTION_DAYS) -> int:
+        '''
+            Forget MIGRATED files whose <date> is older than <retention_days>.
+
+            Returns the number of rows deleted.
+        '''
+        cutoff = (datetime.datetime.utcnow() - datetime.timedelta(days=retention_days)).strftime('%Y%m%d')
+        cur = self.conn.execute('DELETE FROM files WHERE stage = ? AND date < ?', (STAGE.MIGRATED, cutoff))
+        self.conn.commit()
+        return cur.rowcount
+
+    # Queries
+
+    def query_paths(self, stages: typ.Iterable[str], *,
+                    streams: typ.Optional[typ.Iterable[str]] = None,
+                    name_prefix: typ.Optional[str] = None,
+                    suffix: typ.Optional[str] = None,
+                    limit: typ.Optional[int] = None) -> typ.List[str]:
+        '''
+            Paths at given stages, oldest first.
+        '''
+        stages = list(stages)
+        sql = f'SELECT path FROM files WHERE stage IN ({",".join("?" * len(stages))})'
+        args: typ.List[typ.Any] = stages
+        if streams is not None:
+            streams = list(streams)
+            sql += f' AND stream IN ({",".join("?" * len(streams))})'
+            args += streams
+        if name_prefix is not None:
+            sql += ' AND name LIKE ?'
+            args += [name_prefix + '%']
+        if suffix is not None:
+            sql += ' AND name LIKE ?'
+            args += ['%' + suffix]
+        sql += ' ORDER BY mtime_ns, path'
+        if limit is not None:
+            sql += f' LIMIT {int(limit)}'
+
+        return [row['path'] for row in self.conn.execute(sql, args)]
+
+    def query_uncompressed_archived(self, limit: typ.Optional[int] = None) -> typ.List[str]:
+        '''
+            SCX|VMP*.fits files with no .fits.fz sibling, oldest first.
+        '''
+        sql = ('SELECT f.path FROM files f LEFT JOIN files z ON z.path = f.path || \'.fz\' '
+               'WHERE f.stage = ? AND z.path IS NULL ORDER BY f.mtime_ns, f.path')
+        if limit is not None:
+            sql += f' LIMIT {int(limit)}'
+        return [row['path'] for row in self.conn.execute(sql, (STAGE.FRAMEID, ))]
+
+    def query_compressed_archived(self) -> typ.List[str]:
+        '''
+            SCX|VMP*.fits files that have a .fits.fz sibling.
+        '''
+        sql = ('SELECT f.path FROM files f JOIN files z ON z.path = f.path || \'.fz\' '
+               'WHERE f.stage = ? ORDER BY f.path')
+        return [row['path'] for row in self.conn.execute(sql, (STAGE.FRAMEID, ))]
+
+    def count_in_folder(self, folder: typ.Union[str, Path], stages: typ.Iterable[str]) -> int:
+        stages = list(stages)
+        sql = f'SELECT COUNT(*) FROM files WHERE folder = ? AND stage IN ({",".join("?" * len(stages))})'
+        return self.conn.execute(sql, [os.path.normpath(folder)] + stages).fetchone()[0]
+
+
+_CATALOGS: typ.Dict[str, ArchiveCatalog] = {}
+
+
+def get_catalog(root: typ.Union[str, Path]) -> ArchiveCatalog:
+    '''
+        One catalog connection per root per process.
+    '''
+    key = str(Path(root).absolute())
+    if key not in _CATALOGS:
+        _CATALOGS[key] = ArchiveCatalog(key)
+    return _CATALOGS[key]
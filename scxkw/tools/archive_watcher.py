@@ -0,0 +1,263 @@
+'''
+    File arrival watcher for the archive directories <root>/<date>/<stream>/<file>
+
+    Uses inotify (through the optional inotify_simple package) to be told about
+    close-write and rename events in the stream folders. Without inotify, falls back
+    to incremental os.scandir scans that only re-list folders whose mtime changed.
+
+    New files land in per-stream work queues (self.queues), and the folders that
+    changed (new, renamed or deleted files) are reported to the ArchiveCatalog.
+'''
+from __future__ import annotations
+import typing as typ
+
+import logging
+
+logg = logging.getLogger(__name__)
+
+import os
+import time
+from collections import deque
+from pathlib import Path
+
+try:
+    import inotify_simple
+    from inotify_simple import flags as in_flags
+    HAS_INOTIFY = True
+except ImportError:
+    HAS_INOTIFY = False
+
+ARCHIVE_EXTENSIONS = ('.fits', '.fits.fz')
+
+
+class IncrementalScanner:
+    '''
+        Fallback for ArchiveWatcher.
+
+        A date directory's list of stream folders is cached until the date directory's mtime
+        changes; the watched stream folders are stat'ed and only re-listed if their mtime changed.
+    '''
+
+    RACE_MARGIN_NS = 2_000_000_000
+
+    def __init__(self, root: typ.Union[str, Path], streams: typ.Optional[typ.Iterable[str]] = None,
+                 extensions: typ.Tuple[str, ...] = ARCHIVE_EXTENSIONS) -> None:
+        self.root = str(Path(root).absolute())
+        self.streams = None if streams is None else set(streams)
+        self.extensions = extensions
+
+        # dir -> (mtime_ns, listed_ns)
+        self.dir_mtimes: typ.Dict[str, typ.Tuple[int, int]] = {}
+        # date dir -> stream subfolders
+        self.date_subdirs: typ.Dict[str, typ.List[str]] = {}
+        # stream folder -> file names
+        self.known_files: typ.Dict[str, typ.Set[str]] = {}
+
+    def _is_unchanged(self, path: str, mtime_ns: int) -> bool:
+        if path not in self.dir_mtimes:
+            return False
+        k_mtime, k_listed = self.dir_mtimes[path]
+        return mtime_ns == k_mtime and k_listed - mtime_ns > self.RACE_MARGIN_NS
+
+    def _stream_dirs_of(self, date_dir: str) -> typ.List[str]:
+        mtime_ns = os.stat(date_dir).st_mtime_ns
+        if not self._is_unchanged(date_dir, mtime_ns):
+            self.dir_mtimes[date_dir] = (mtime_ns, time.time_ns())
+            self.date_subdirs[date_dir] = [
+                e.path for e in os.scandir(date_dir)
+                if e.is_dir() and e.name != 'tmp' and (self.streams is None or e.name in self.streams)
+            ]
+        return self.date_subdirs[date_dir]
+
+    def scan(self) -> typ.Tuple[typ.List[str], typ.Set[str]]:
+        '''
+            Returns (new file paths, folders that changed)
+        '''
+        new_files: typ.List[str] = []
+        changed_folders: typ.Set[str] = set()
+
+        try:
+            date_dirs = [e.path for e in os.scandir(self.root) if e.is_dir() and not e.name.startswith('.')]
+        except FileNotFoundError:
+            return new_files, changed_folders
+
+        for date_dir in date_dirs:
+            for stream_dir in self._stream_dirs_of(date_dir):
+                try:
+                    mtime_ns = os.stat(stream_dir).st_mtime_ns
+                except FileNotFoundError:
+                    continue
+                if self._is_unchanged(stream_dir, mtime_ns):
+                    continue
+                self.dir_mtimes[stream_dir] = (mtime_ns, time.time_ns())
+
+                names = {e.name for e in os.scandir(stream_dir)
+                         if e.name.endswith(self.extensions) and e.is_file()}
+                old_names = self.known_files.get(stream_dir, set())
+                if names != old_names:
+                    changed_folders.add(stream_dir)
+                new_files += [stream_dir + '/' + n for n in sorted(names - old_names)]
+                self.known_files[stream_dir] = names
+
+        return new_files, changed_folders
+
+
+class ArchiveWatcher:
+    '''
+        Watch <root>/<date>/<stream>/ for files that finished landing.
+
+        streams: stream folder names to watch (None: all)
+        extensions: file name endings that go to the work queues
+    '''
+
+    WATCH_ROOT_MASK = 0
+    WATCH_FILES_MASK = 0
+    if HAS_INOTIFY:
+        WATCH_ROOT_MASK = in_flags.CREATE | in_flags.MOVED_TO | in_flags.ONLYDIR
+        WATCH_FILES_MASK = (in_flags.CLOSE_WRITE | in_flags.MOVED_TO | in_flags.MOVED_FROM |
+                            in_flags.DELETE | in_flags.DELETE_SELF)
+
+    def __init__(self, root: typ.Union[str, Path], streams: typ.Optional[typ.Iterable[str]] = None,
+                 extensions: typ.Tuple[str, ...] = ARCHIVE_EXTENSIONS,
+                 use_inotify: bool = True) -> None:
+
+        self.root = str(Path(root).absolute())
+        self.streams = None if streams is None else set(streams)
+        self.extensions = extensions
+
+        self.queues: typ.Dict[str, typ.Deque[str]] = {}
+        self.dirty_folders: typ.Set[str] = set()
+        # Set when we may have missed events: a full catalog rescan is needed.
+        self.needs_full_rescan = True
+
+        self.scanner = IncrementalScanner(self.root, self.streams, self.extensions)
+
+        self.inotify: typ.Any = None
+        self.wd_to_path: typ.Dict[int, str] = {}
+        if use_inotify and HAS_INOTIFY:
+            self.inotify = inotify_simple.INotify()
+            self._watch_tree()
+        elif use_inotify:
+            logg.warning('ArchiveWatcher::__init__ - inotify_simple not available, '
+                         'falling back to incremental scans.')
+
+        # Initial population of the queues with what's there already.
+        self._ingest(*self.scanner.scan())
+
+    def is_live(self) -> bool:
+        '''
+            True if we're getting inotify events, i.e. the dirty folders are exhaustive.
+        '''
+        return self.inotify is not None
+
+    def _add_watch(self, path: str, mask: int) -> None:
+        try:
+            wd = self.inotify.add_watch(path, mask)
+        except (FileNotFoundError, NotADirectoryError):
+            return
+        self.wd_to_path[wd] = path
+
+    def _watch_tree(self) -> None:
+        self._add_watch(self.root, self.WATCH_ROOT_MASK)
+        for date_entry in os.scandir(self.root):
+            if date_entry.is_dir() and not date_entry.name.startswith('.'):
+                self._watch_date_dir(date_entry.path)
+
+    def _watch_date_dir(self, date_dir: str) -> None:
+        self._add_watch(date_dir, self.WATCH_ROOT_MASK)
+        for stream_entry in os.scandir(date_dir):
+            if stream_entry.is_dir():
+                self._watch_stream_dir(stream_entry.path)
+
+    def _watch_stream_dir(self, stream_dir: str) -> None:
+        name = stream_dir.split('/')[-1]
+        if name == 'tmp' or (self.streams is not None and name not in self.streams):
+            return
+        self._add_watch(stream_dir, self.WATCH_FILES_MASK)
+
+    def _ingest(self, new_files: typ.Iterable[str], changed_folders: typ.Iterable[str]) -> int:
+        n_new = 0
+        for path in new_files:
+            stream = path.split('/')[-2]
+            self.queues.setdefault(stream, deque()).append(path)
+            n_new += 1
+        self.dirty_folders.update(changed_folders)
+        return n_new
+
+    def poll(self, timeout_s: float = 0.0) -> int:
+        '''
+            Wait up to timeout_s for something to happen, and fill the queues.
+
+            Returns the number of new files queued.
+        '''
+        if self.inotify is None:
+            time.sleep(timeout_s)
+            return self._ingest(*self.scanner.scan())
+
+        new_files: typ.List[str] = []
+        changed_folders: typ.Set[str] = set()
+
+        for event in self.inotify.read(timeout=int(timeout_s * 1000)):
+            if event.mask & in_flags.Q_OVERFLOW:
+                logg.error('ArchiveWatcher::poll - inotify queue overflow, rescanning.')
+                self.needs_full_rescan = True
+                self.scanner.dir_mtimes.clear()  # Force a re-listing of everything
+                self._ingest(*self.scanner.scan())
+                continue
+
+            parent = self.wd_to_path.get(event.wd)
+            if parent is None:
+                continue
+            if event.mask & in_flags.IGNORED:
+                del self.wd_to_path[event.wd]
+                continue
+
+            path = parent + '/' + event.name if event.name else parent
+
+            if event.mask & in_flags.ISDIR:
+                if parent == self.root:
+                    self._watch_date_dir(path)
+                    changed_folders.update(self.scanner._stream_dirs_of(path))
+                else:
+                    self._watch_stream_dir(path)
+                    changed_folders.add(path)
+                # Files may have landed before the watch was set.
+                scanned, _ = self.scanner.scan()
+                new_files += scanned
+                continue
+
+            if not event.name.endswith(self.extensions):
+                continue
+
+            changed_folders.add(parent)
+            names = self.scanner.known_files.setdefault(parent, set())
+            if event.mask & (in_flags.CLOSE_WRITE | in_flags.MOVED_TO):
+                if event.name not in names:
+                    names.add(event.name)
+                    new_files.append(path)
+            else:  # MOVED_FROM, DELETE
+                names.discard(event.name)
+
+        return self._ingest(new_files, changed_folders)
+
+    def pop_dirty_folders(self) -> typ.Tuple[bool, typ.Set[str]]:
+        '''
+            Returns (full rescan needed, folders that changed since last call)
+        '''
+        full, dirty = self.needs_full_rescan, self.dirty_folders
+        self.needs_full_rescan = False
+        self.dirty_folders = set()
+        return full, dirty
+
+    def pop_queue(self, stream: str) -> typ.List[str]:
+        queue = self.queues.get(stream)
+        if queue is None:
+            return []
+        ret = list(queue)
+        queue.clear()
+        return ret
+
+    def close(self) -> None:
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None
@@ -0,0 +1,216 @@
+'''
+    Compression option benchmark
+
+    For sample cubes of each stream, try fpack algorithm / tiling variants through the
+    in-process backend (fits_compress), and measure compression ratio, compression and
+    decompression MB/s, and whether the round-trip is lossless - for quantized float data,
+    the largest error in units of the image noise.
+
+    From those, recommend one option set per archive key (SCXB, VMPA, ...) and save it
+    as JSON, which FpackJobManager can load (options_file).
+'''
+from __future__ import annotations
+import typing as typ
+
+import logging
+
+logg = logging.getLogger(__name__)
+
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+from astropy.io import fits
+
+from scxkw.config import CAMIDS
+from .fits_compress import fpack_options_to_kwargs, write_compressed
+
+# Raw / intermediate stream folders that end up under a given archive key.
+STREAM_ARCHIVE_KEYS = {
+    'apapane': 'SCXB',
+    'palila': 'SCXC',
+    'vcam1': 'VMPA',
+    'vcam2': 'VMPA',
+    'vsync': 'VMPA',
+    'vsolo1': 'VMPA',
+    'vsolo2': 'VMPA',
+    **CAMIDS
+}
+
+# Algorithm variants - tiling variants are added per file in candidate_options.
+INT_ALGORITHMS = ('-r', '-h -s 0', '-g', '-g2', '-p')
+FLOAT_ALGORITHMS = ('-r -q 4', '-r -q 16', '-h -q 16', '-g2 -q 16', '-g -q 0')
+
+
+class BenchResult(typ.NamedTuple):
+    stream: str
+    file: str
+    options: str
+    ratio: float
+    comp_MBps: float
+    decomp_MBps: float
+    lossless: bool
+    is_float: bool
+    max_err_sigma: float  # Largest round-trip error / noise estimate - 0.0 if lossless
+
+
+def noise_sigma(data: np.ndarray) -> float:
+    '''
+        Robust pixel noise estimate (MAD of neighbouring pixel differences), like fpack's.
+    '''
+    diffs = np.diff(np.asarray(data, np.float64).reshape(-1, data.shape[-1]), axis=-1)
+    diffs = diffs[np.isfinite(diffs)]
+    if len(diffs) == 0:
+        return 0.0
+    return float(1.4826 * np.median(np.abs(diffs - np.median(diffs))) / np.sqrt(2))
+
+
+def candidate_options(header: fits.Header, data: np.ndarray) -> typ.List[str]:
+    '''
+        Algorithm x tiling variants applicable to this image (unscaled data).
+    '''
+    is_int = header['BITPIX'] > 0
+    algorithms = INT_ALGORITHMS if is_int else FLOAT_ALGORITHMS
+    if is_int and (data.min() < 0 or data.max() >= 2**24):
+        algorithms = tuple(a for a in algorithms if a != '-p')  # PLIO: 0 <= values < 2**24 only.
+
+    nx, ny = header['NAXIS1'], header.get('NAXIS2', 1)
+    # Row by row (fpack default), 16 rows, full frame.
+    tilings = ['', f' -t {nx},{min(16, ny)}', f' -t {nx},{ny}']
+
+    options: typ.List[str] = []
+    for algo in algorithms:
+        for tiling in tilings:
+            if algo.startswith('-h') and tiling == '':
+                continue  # hcompress needs 2D tiles; default is already 16 rows.
+            options.append(algo + tiling)
+    return options
+
+
+def benchmark_file(filename: str, stream: str, workdir: str,
+                   options_list: typ.Optional[typ.List[str]] = None) -> typ.List[BenchResult]:
+    with fits.open(filename, memmap=True, do_not_scale_image_data=True) as hdul:
+        header = hdul[0].header
+        reference = np.array(hdul[0].data)
+    n_bytes = reference.nbytes
+    is_float = header['BITPIX'] < 0
+    sigma = noise_sigma(reference) if is_float else 0.0
+
+    if options_list is None:
+        options_list = candidate_options(header, reference)
+
+    results: typ.List[BenchResult] = []
+    out_filename = os.path.join(workdir, 'bench.fits.fz')
+    for options in options_list:
+        comp_kwargs, _ = fpack_options_to_kwargs(options)
+        if os.path.exists(out_filename):
+            os.remove(out_filename)
+
+        t_start = time.time()
+        try:
+            write_compressed(filename, out_filename, comp_kwargs)
+        except Exception as exc:
+            logg.error(f'benchmark_file: {options} failed on {filename} - {exc}')
+            continue
+        t_comp = time.time() - t_start
+
+        t_start = time.time()
+        with fits.open(out_filename, do_not_scale_image_data=True) as hdul:
+            decompressed = np.asarray(hdul[1].data)
+        t_decomp = time.time() - t_start
+
+        lossless = bool(np.array_equal(decompressed, reference, equal_nan=is_float))
+        max_err_sigma = 0.0
+        if not lossless:
+            if is_float and np.array_equal(np.isnan(decompressed), np.isnan(reference)):
+                max_err = float(np.nanmax(np.abs(decompressed.astype(np.float64) - reference)))
+                max_err_sigma = max_err / sigma if sigma > 0 else np.inf
+            else:
+                max_err_sigma = np.inf
+
+        results.append(BenchResult(
+            stream=stream,
+            file=filename,
+            options=options,
+            ratio=n_bytes / os.path.getsize(out_filename),
+            comp_MBps=n_bytes / 1024**2 / max(t_comp, 1e-6),
+            decomp_MBps=n_bytes / 1024**2 / max(t_decomp, 1e-6),
+            lossless=lossless,
+            is_float=is_float,
+            max_err_sigma=max_err_sigma,
+        ))
+
+    return results
+
+
+def run_benchmark(samples: typ.Dict[str, typ.List[str]],
+                  tmp_dir: typ.Optional[str] = None) -> typ.List[BenchResult]:
+    '''
+        samples: {stream name: [sample files]}
+    '''
+    results: typ.List[BenchResult] = []
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as workdir:
+        for stream, filenames in samples.items():
+            for filename in filenames:
+                logg.warning(f'run_benchmark: {stream} - {filename}')
+                results += benchmark_file(filename, stream, workdir)
+    return results
+
+
+def _is_acceptable(res: BenchResult, float_max_err_sigma: float) -> bool:
+    return res.lossless or (res.is_float and res.max_err_sigma <= float_max_err_sigma)
+
+
+def recommend(results: typ.List[BenchResult], *,
+              min_comp_MBps: float = 50.0,
+              require_lossless: bool = True,
+              float_max_err_sigma: float = 0.25) -> typ.Dict[str, str]:
+    '''
+        Per archive key: the options with the best mean ratio among the acceptable ones
+        that compress at least at min_comp_MBps on average.
+        Falls back to the fastest acceptable option if none is fast enough.
+
+        Acceptable: lossless on all samples (if require_lossless) for integer data. Float data is
+        quantized by design: errors up to float_max_err_sigma x the image noise are acceptable.
+    '''
+    per_key: typ.Dict[str, typ.Dict[str, typ.List[BenchResult]]] = {}
+    for res in results:
+        key = STREAM_ARCHIVE_KEYS.get(res.stream, res.stream)
+        per_key.setdefault(key, {}).setdefault(res.options, []).append(res)
+
+    recommendations: typ.Dict[str, str] = {}
+    for key, per_options in per_key.items():
+        scored = []
+        for options, runs in per_options.items():
+            if require_lossless and not all(_is_acceptable(r, float_max_err_sigma) for r in runs):
+                continue
+            scored.append((np.mean([r.ratio for r in runs]),
+                           np.mean([r.comp_MBps for r in runs]), options))
+        if len(scored) == 0:
+            logg.error(f'recommend: no acceptable options for {key}.')
+            continue
+        fast_enough = [s for s in scored if s[1] >= min_comp_MBps]
+        if len(fast_enough) > 0:
+            recommendations[key] = max(fast_enough)[2]
+        else:
+            recommendations[key] = max(scored, key=lambda s: s[1])[2]
+
+    return recommendations
+
+
+def write_report(results: typ.List[BenchResult], recommendations: typ.Dict[str, str],
+                 report_path: str, options_path: str) -> None:
+    '''
+        TSV of all the measurements, and the JSON {archive key: options} for FpackJobManager.
+    '''
+    with open(report_path, 'w') as report:
+        report.write('\t'.join(BenchResult._fields) + '\n')
+        for res in results:
+            report.write(f'{res.stream}\t{res.file}\t{res.options}\t{res.ratio:.3f}\t'
+                         f'{res.comp_MBps:.1f}\t{res.decomp_MBps:.1f}\t{res.lossless}\t'
+                         f'{res.is_float}\t{res.max_err_sigma:.4f}\n')
+
+    with open(options_path, 'w') as options_file:
+        json.dump(recommendations, options_file, indent=4)
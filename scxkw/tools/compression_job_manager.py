@@ -4,12 +4,20 @@ logg = logging.getLogger(__name__)
 
 import typing as typ
 
+import os
+import json
+import time
+import threading
+from collections import deque
+from concurrent import futures
 from pathlib import Path
 import subprocess as sproc
 
 from enum import IntEnum
 
 from .fits_file_obj import FitsFileObj
+from .fits_compress import compress_file_inprocess, compress_files_inprocess
+from .job_registry import JOBKIND, JobRegistry, get_job_registry
 from . import file_tools
 
 class FPackJobCodeEnum(IntEnum):
@@ -19,28 +27,129 @@ class FPackJobCodeEnum(IntEnum):
     STARTED = 0
 
 class FpackJobManager:
-    MAX_CONCURRENT_JOBS = 50 # FIXME
+    MAX_CONCURRENT_JOBS = 50 # Hard cap - the actual cap is from max_concurrent_jobs()
     FPACK_OPTIONS_SCX = '-h -s 0 -q 20' # Maintains the original .fits file!
     FPACK_OPTIONS_VMP = '-r -D -Y' # Removes the original .fits file
 
-    def __init__(self) -> None:
-        self.pending_jobs: typ.Dict[str, sproc.Popen] = {}
-
-        # Now check for active fpack jobs that this manager didn't launch.
-        running_fpacks_str = sproc.run(
-            'ps -eo args | egrep ^fpack', shell=True,
-            capture_output=True).stdout.decode('utf8').strip()
-        if running_fpacks_str == '':
-            running_fpacks = []
-        else:
-            running_fpacks = running_fpacks_str.split('\n')
-
+    # Compression backend per archive key: external fpack process, or in-process (fits_compress)
+    BACKEND_FPACK = 'fpack'
+    BACKEND_INPROCESS = 'inprocess'
+    BACKENDS = {'SCXB': BACKEND_FPACK, 'VMPA': BACKEND_FPACK}
+
+    # Throughput-based cap adaptation - see _close_epoch
+    IMPROVE_RATIO = 1.05
+    DEGRADE_RATIO = 0.90
+
+    def __init__(self, registry: typ.Optional[JobRegistry] = None,
+                 max_concurrent_jobs: typ.Optional[int] = None,
+                 backends: typ.Optional[typ.Dict[str, str]] = None,
+                 options_file: typ.Optional[str] = None) -> None:
+        '''
+            max_concurrent_jobs: fixed cap. None: adapt from CPU count, load average
+            and the observed compression throughput.
+            backends: {archive key: backend} overrides of BACKENDS.
+            options_file: JSON of recommended fpack options per archive key (scxkw-compression-benchmark).
+        '''
+        self.pending_jobs: typ.Dict[str, typ.Union[sproc.Popen, futures.Future]] = {}
+        # Completion threads reap jobs and refill slots: protect pending_jobs and backlog.
+        self.lock = threading.RLock()
+
+        # Files waiting for a slot, oldest first.
+        self.backlog: typ.Deque[str] = deque()
+
+        # Shared with other managers / monitors, possibly in other processes.
+        self.registry = get_job_registry() if registry is None else registry
+
+        self.options_per_key: typ.Dict[str, str] = {}
+        if options_file is not None:
+            self.load_options_file(options_file)
+
+        self.backends = dict(self.BACKENDS)
+        if backends is not None:
+            self.backends.update(backends)
+        # Created on first in-process job; workers are spawned on demand.
+        self.pool: typ.Optional[futures.ProcessPoolExecutor] = None
+
+        self.fixed_max_jobs = max_concurrent_jobs
+        self.n_cpus = os.cpu_count() or 1
+        self.io_cap = self.n_cpus  # Adapted from throughput
+
+        # Stats
+        self.t_first_start: typ.Optional[float] = None
+        self.n_files_done = 0
+        self.n_bytes_done = 0
+        self.n_files_failed = 0
+
+        self._epoch_start = time.time()
+        self._epoch_bytes = 0
+        self._epoch_count = 0
+        self._last_epoch_Bps: typ.Optional[float] = None
+
+        running_fpacks = self.registry.running_targets(JOBKIND.FPACK)
         if len(running_fpacks) > 0:
-            logg.error('FpackJobManager::__init__ - Running fpack jobs:')
-            logg.error(str(running_fpacks))
-            raise AssertionError(
-                'There are running fpack jobs on the system. '
-                'It is bad juju to instantiate a FPackJobManager now.')
+            logg.warning(f'FpackJobManager::__init__ - {len(running_fpacks)} fpack jobs '
+                         'from other managers are running - will not touch their files.')
+
+    def load_options_file(self, options_file: str) -> None:
+        '''
+            Load {archive key: fpack options} as written by compression_benchmark.write_report.
+        '''
+        with open(options_file, 'r') as file:
+            self.options_per_key = json.load(file)
+        logg.warning(f'FpackJobManager::load_options_file - {self.options_per_key}')
+
+    def fpack_options_for_key(self, archive_key: str) -> str:
+        '''
+            Benchmarked options if we have them for this key, but always keep the
+            keep/delete original policy of the defaults (-D -Y for VAMPIRES).
+        '''
+        defaults = self.FPACK_OPTIONS_VMP if archive_key.startswith('VMPA') else self.FPACK_OPTIONS_SCX
+        if archive_key in self.options_per_key:
+            disposal = [tok for tok in defaults.split() if tok in ('-D', '-Y')]
+            algo = [tok for tok in self.options_per_key[archive_key].split() if tok not in ('-D', '-Y')]
+            return ' '.join(algo + disposal)
+
+        assert archive_key.startswith('VMPA') or archive_key.startswith('SCXB')
+        return defaults
+
+    def max_concurrent_jobs(self) -> int:
+        if self.fixed_max_jobs is not None:
+            return self.fixed_max_jobs
+
+        # CPUs not busy with something other than our own jobs.
+        others_load = max(0., os.getloadavg()[0] - len(self.pending_jobs))
+        cpu_cap = max(1, int(round(self.n_cpus - others_load)))
+
+        return max(1, min(self.MAX_CONCURRENT_JOBS, cpu_cap, self.io_cap))
+
+    def queue_fpack_jobs(self, filenames: typ.Iterable[str]) -> int:
+        '''
+            Replace the backlog with <filenames> (expected oldest first), and fill free slots.
+            Slots freed later are refilled from the backlog as soon as a job completes.
+
+            Returns the number of jobs started now.
+        '''
+        with self.lock:
+            self.backlog = deque(f for f in filenames if f not in self.pending_jobs)
+            return self._fill_slots()
+
+    def _fill_slots(self) -> int:
+        n_started = 0
+        with self.lock:
+            while len(self.backlog) > 0 and len(self.pending_jobs) < self.max_concurrent_jobs():
+                filename = self.backlog.popleft()
+                try:
+                    file_obj = FitsFileObj(filename)
+                except (AssertionError, OSError) as exc:  # Gone or unreadable since listed
+                    logg.error(f'FpackJobManager::_fill_slots - skipping {filename}: {exc}')
+                    continue
+                ret = self.run_fpack_compression_job(file_obj)
+                if ret == FPackJobCodeEnum.STARTED:
+                    n_started += 1
+                elif ret == FPackJobCodeEnum.TOOMANY:
+                    self.backlog.appendleft(filename)
+                    break
+        return n_started
 
     def run_fpack_compression_job(self,
                                   file_obj: FitsFileObj,
@@ -48,41 +157,139 @@ class FpackJobManager:
         if not file_obj.check_existence_on_disk():
             logg.error(f'Fpack job manager: file {file_obj} does not exist.')
             return FPackJobCodeEnum.NOFILE
-        if len(self.pending_jobs) == self.MAX_CONCURRENT_JOBS:
-            logg.error(f'Fpack job manager: max allowed ({self.MAX_CONCURRENT_JOBS}) fpack jobs already running at the same time.')
-            return FPackJobCodeEnum.TOOMANY
-        if str(file_obj.full_filepath) in self.pending_jobs:
-            return FPackJobCodeEnum.ALREADY_RUNNING
-
-        if forced_fpack_options is not None:
-            cmdline = f'fpack {forced_fpack_options} -v {str(file_obj.full_filepath)}'
-        else:
-            assert file_obj.archive_key is not None
-            if file_obj.archive_key.startswith('VMPA'):
-                cmdline = f'fpack {self.FPACK_OPTIONS_VMP} -v {str(file_obj.full_filepath)}'
-            else:
-                assert file_obj.archive_key.startswith('SCXB')
-                cmdline = f'fpack {self.FPACK_OPTIONS_SCX} -v {str(file_obj.full_filepath)}'
-
-        proc = sproc.Popen(cmdline.split(' '),
-                           stdout=sproc.PIPE,
-                           stderr=sproc.PIPE)
 
-        self.pending_jobs[str(file_obj.full_filepath)] = proc
+        with self.lock:
+            max_jobs = self.max_concurrent_jobs()
+            if len(self.pending_jobs) >= max_jobs:
+                logg.info(f'Fpack job manager: max allowed ({max_jobs}) fpack jobs already running at the same time.')
+                return FPackJobCodeEnum.TOOMANY
+            if str(file_obj.full_filepath) in self.pending_jobs:
+                return FPackJobCodeEnum.ALREADY_RUNNING
+            if not self.registry.claim(file_obj.full_filepath, JOBKIND.FPACK):
+                return FPackJobCodeEnum.ALREADY_RUNNING
+
+            try:
+                if forced_fpack_options is not None:
+                    fpack_options = forced_fpack_options
+                else:
+                    assert file_obj.archive_key is not None
+                    fpack_options = self.fpack_options_for_key(file_obj.archive_key)
+
+                filename = str(file_obj.full_filepath)
+                n_bytes = os.path.getsize(filename)  # Before fpack -D deletes it.
+                backend = self.backends.get(file_obj.archive_key or '', self.BACKEND_FPACK)
+
+                if backend == self.BACKEND_INPROCESS:
+                    if self.pool is None:
+                        self.pool = futures.ProcessPoolExecutor(max_workers=self.MAX_CONCURRENT_JOBS)
+                    fut = self.pool.submit(compress_file_inprocess, filename, fpack_options)
+                    self.pending_jobs[filename] = fut
+                else:
+                    cmdline = f'fpack {fpack_options} -v {filename}'
+                    proc = sproc.Popen(cmdline.split(' '),
+                                       stdout=sproc.PIPE,
+                                       stderr=sproc.PIPE)
+                    self.registry.set_pid(filename, proc.pid)
+                    self.pending_jobs[filename] = proc
+            except Exception:
+                # Don't leave the file locked under our (live) pid.
+                self.registry.release(file_obj.full_filepath)
+                raise
+
+            if self.t_first_start is None:
+                self.t_first_start = time.time()
+
+        if backend == self.BACKEND_INPROCESS:
+            # Done-callbacks run in the pool's management thread - don't refill slots from there.
+            fut.add_done_callback(lambda fut: threading.Thread(
+                target=self._job_done,
+                args=(filename, n_bytes, None if fut.exception() is None else str(fut.exception())),
+                daemon=True).start())
+        else:
+            threading.Thread(target=self._wait_job, args=(filename, proc, n_bytes), daemon=True).start()
 
         return FPackJobCodeEnum.STARTED
 
+    def _wait_job(self, filename: str, proc: sproc.Popen, n_bytes: int) -> None:
+        '''
+            Runs in a thread per fpack process.
+        '''
+        _, stderr = proc.communicate()  # Drains the pipes, reaps the process.
+        error = None if proc.returncode == 0 else f'({proc.returncode}): {stderr.decode("utf8").strip()}'
+        self._job_done(filename, n_bytes, error)
+
+    def _job_done(self, filename: str, n_bytes: int, error: typ.Optional[str]) -> None:
+        '''
+            Completion callback - frees the slot and refills it from the backlog.
+        '''
+        with self.lock:
+            self.pending_jobs.pop(filename, None)
+            self.registry.release(filename)
+
+            if error is not None:
+                self.n_files_failed += 1
+                logg.error(f'FpackJobManager::_job_done - compression failed on {filename} {error}')
+            else:
+                self.n_files_done += 1
+                self.n_bytes_done += n_bytes
+                self._epoch_bytes += n_bytes
+                self._epoch_count += 1
+                if self._epoch_count >= max(4, self.max_concurrent_jobs()):
+                    self._close_epoch()
+
+            self._fill_slots()
+
+    def _close_epoch(self) -> None:
+        '''
+            Adapt io_cap: grow it while more jobs bring more throughput,
+            step back when throughput degrades (disk-bound).
+        '''
+        now = time.time()
+        epoch_Bps = self._epoch_bytes / max(now - self._epoch_start, 1e-3)
+        cap = self.max_concurrent_jobs()
+
+        if self._last_epoch_Bps is not None and self.fixed_max_jobs is None:
+            if epoch_Bps < self.DEGRADE_RATIO * self._last_epoch_Bps:
+                self.io_cap = max(1, min(self.io_cap, cap) * 3 // 4)
+            elif epoch_Bps > self.IMPROVE_RATIO * self._last_epoch_Bps and cap >= self.io_cap:
+                self.io_cap = min(self.MAX_CONCURRENT_JOBS, self.io_cap + max(1, self.io_cap // 4))
+
+        logg.warning(f'FpackJobManager::_close_epoch - {self._epoch_count} files at '
+                     f'{epoch_Bps / 1024**2:.1f} MB/s with cap {cap}; io cap now {self.io_cap}.')
+
+        self._last_epoch_Bps = epoch_Bps
+        self._epoch_start = now
+        self._epoch_bytes = 0
+        self._epoch_count = 0
+
+    def report(self) -> str:
+        '''
+            Compression rate since the first job was started.
+        '''
+        with self.lock:
+            elapsed = 0. if self.t_first_start is None else time.time() - self.t_first_start
+            elapsed = max(elapsed, 1e-3)
+            return (f'{self.n_files_done} files ({self.n_files_done / elapsed:.2f} files/s), '
+                    f'{self.n_bytes_done / 1024**2:.1f} MB ({self.n_bytes_done / 1024**2 / elapsed:.1f} MB/s) '
+                    f'compressed; {self.n_files_failed} failed; {len(self.pending_jobs)} running, '
+                    f'{len(self.backlog)} queued, cap {self.max_concurrent_jobs()}.')
+
+    def running_targets(self) -> typ.Set[str]:
+        '''
+            Full paths of the files currently being compressed - by any manager.
+            Read-only: slots are refilled from the daemon loop (queue_fpack_jobs / refresh_running_jobs).
+        '''
+        return self.registry.running_targets(JOBKIND.FPACK)
+
     def refresh_running_jobs(self) -> None:
-        # job.poll() is None if process is still running.
-        self.pending_jobs = {
-            filename: self.pending_jobs[filename]
-            for filename in self.pending_jobs
-            if self.pending_jobs[filename].poll() is None
-        }
+        # Jobs are reaped by their completion threads; this only tops up the free slots
+        # (e.g. if the load average went down).
+        self._fill_slots()
 
 
 def compress_all_fits_in_given_folder_lossless(folder: typ.Union[str,Path], *,
-                                               dry_run: bool = True):
+                                               dry_run: bool = True,
+                                               backend: str = FpackJobManager.BACKEND_FPACK):
     '''
     Find all fits files
 
@@ -114,7 +321,11 @@ def compress_all_fits_in_given_folder_lossless(folder: typ.Union[str,Path], *,
 
     if dry_run:
         return
-    
+
+    if backend == FpackJobManager.BACKEND_INPROCESS:
+        compress_files_inprocess(files_valid_and_integer, FPACK_OPTIONS, n_workers=20)
+        return
+
     sproc.run('cat %s | xargs -P20 -I {} fpack %s -v {}' % (file_list, FPACK_OPTIONS),
               shell = True)
 
@@ -8,22 +8,67 @@ import logging
 logg = logging.getLogger(__name__)
 
 import abc
+import errno
+import functools
 import re
 import os, shutil
+import stat
 from datetime import datetime
 from pathlib import Path
 from astropy.io import fits
 import numpy as np
 import time
 
-from .logshim_txt_parser import LogshimTxtParser
+from .logshim_txt_parser import LogshimTxtParser, timing_sidecar_path
 from .fix_header import fix_header_times
+from .fits_header_patch import patch_header
+from .frame_source import T_FrameData
+from .fits_stream_writer import FSYNC, fsync_path
+from .fileobj_cache import FileMeta, FileObjCache, file_signature, get_fileobj_cache, pack_header
+
+_MILK_NAME_REGEX = re.compile(r'^[a-zA-Z0-9]+_\d{2}:\d{2}:\d{2}.\d{1,9}')
+
+
+@functools.lru_cache(maxsize=65536)
+def _milk_name_timestamp(date_folder: str, fname_no_decimal: str, stream: str) -> float:
+    dt = datetime.strptime(date_folder + 'T' + fname_no_decimal,
+                           f'%Y%m%dT{stream}_%H:%M:%S')
+    return dt.timestamp()
+
+
+def _rename_or_move(src: Path, dst: Path) -> None:
+    '''
+    Plain rename(2) - shutil.move stats around before trying it - and copy across filesystems.
+    '''
+    try:
+        os.replace(src, dst)
+    except OSError as exc:
+        if exc.errno != errno.EXDEV:
+            raise
+        shutil.move(str(src), dst)
+
+
+def publish_staged_file(staged: Path, final: Path, fsync: str = FSYNC.NONE) -> None:
+    '''
+    Second half of MotherOfFileObj.write_to_disk: rename the file written by stage_to_disk
+    into place. Callers may do it from another process, in an order of their choosing.
+    '''
+    _rename_or_move(staged, final)
+
+    if fsync == FSYNC.FULL:
+        fsync_path(final.parent)
 
 
 class MotherOfFileObj(abc.ABC):
 
     HDU_POS = 0
 
+    # Share headers / txt summaries across runs (on disk for the GEN2PATH_* roots only) - see fileobj_cache
+    USE_METADATA_CACHE = True
+
+    # Durability of write_to_disk - see fits_stream_writer.FSYNC
+    FSYNC_POLICY = FSYNC.NONE
+
     def __init__(self,
                  fullname: typ.Union[Path, str],
                  on_disk: bool = True,
@@ -38,7 +83,13 @@ class MotherOfFileObj(abc.ABC):
         self.full_filepath: Path = Path(fullname)
 
         # Cannot access data member in this superclass
-        self.data: t_Op[np.ndarray] = None
+        # ndarray, or FrameSelection for lazy (memory-mapped) data
+        self.data: t_Op[T_FrameData] = None
+
+        # Header edits not yet written to disk - see defer_header_edit
+        self.pending_header_edits: typ.Dict[str, typ.Any] = {}
+
+        self.disk_stat: t_Op[os.stat_result] = None
 
         self._initial_name_check()
 
@@ -67,12 +118,21 @@ class MotherOfFileObj(abc.ABC):
 
     def _initial_existence_check(self) -> None:
 
-        if not self.full_filepath.is_file():
+        # Keep the stat around: it validates the metadata cache entry and gives the ctime.
+        try:
+            self.disk_stat = os.stat(self.full_filepath)
+        except FileNotFoundError:
+            self.disk_stat = None
+        if self.disk_stat is None or not stat.S_ISREG(self.disk_stat.st_mode):
             message = f"MotherOfFileObj::_initial_existence_check: does not exist - {str(self.full_filepath)}"
             logg.critical(message)
             raise AssertionError(message)
 
     def _initialize_members(self) -> None:
+        self._initialize_path_members()
+        self._initialize_content_members()
+
+    def _initialize_path_members(self) -> None:
 
         self.file_name: str = self.full_filepath.name
 
@@ -95,8 +155,8 @@ class MotherOfFileObj(abc.ABC):
         self.time_from_filename: float | None = None
 
         # Oh look an ugly regex to find if this is a MILK-generated filename
-        self.name_is_milk_compliant: bool = re.match(
-            '^[a-zA-Z0-9]+_\d{2}:\d{2}:\d{2}.\d{1,9}', self.full_filepath.name) is not None
+        self.name_is_milk_compliant: bool = _MILK_NAME_REGEX.match(
+            self.full_filepath.name) is not None
 
         if not self.is_archived and self.name_is_milk_compliant:
             self.stream_from_filename = self.file_name.split('_')[0]
@@ -104,35 +164,109 @@ class MotherOfFileObj(abc.ABC):
             fname_no_decimal = self.full_filepath.stem.split('.')[0]
             frac_seconds = float('0' + self.full_filepath.suffixes[0])
 
-            dt = datetime.strptime(
-                self.date_from_foldername + 'T' + fname_no_decimal,
-                f'%Y%m%dT{self.stream_from_filename}_%H:%M:%S')
+            self.time_from_filename = _milk_name_timestamp(
+                self.date_from_foldername, fname_no_decimal,
+                self.stream_from_filename) + frac_seconds
+
+        self.txt_file_path: Path = self.full_filepath.parent / (
+            self.full_filepath.stem + '.txt')
 
-            self.time_from_filename = dt.timestamp() + frac_seconds
+    def _initialize_content_members(self) -> None:
+        '''
+        Header, header time and txt file. Loaded lazily from the metadata cache if
+        the cached entry still matches the files on disk - see fileobj_cache.
+        '''
+        self._fits_header: t_Op[fits.Header] = None
+        self._txt_file_parser: t_Op[LogshimTxtParser] = None
+        self.metadata: t_Op[FileMeta] = None
 
+        cache = None
         if self.is_on_disk:
-            self.file_time_creation: t_Op[float] = os.path.getctime(
-                self.full_filepath)
+            assert self.disk_stat is not None
+            self.file_time_creation: t_Op[float] = self.disk_stat.st_ctime
+            cache = self._metadata_cache()
+            if cache is not None:
+                self.metadata = cache.lookup(
+                    self.full_filepath,
+                    (self.disk_stat.st_size, self.disk_stat.st_mtime_ns),
+                    file_signature(self.txt_file_path))
 
         # File time. If archive-name file, best guess is creation time.
         self.file_time = self.time_from_filename if self.time_from_filename else self.file_time_creation
 
-        self.fits_header: fits.Header = self._locate_fitsheader()
+        if self.metadata is not None:
+            self.file_time_header: float | None = self.metadata.file_time_header
+            self.txt_exists: bool = self.metadata.txt_exists
+            return
+
+        self._fits_header = self._locate_fitsheader()
+        self.file_time_header = self._header_file_time(self._fits_header)
 
-        self.file_time_header: float | None = None
-        if 'DATE' in self.fits_header:
-            _DATE: str = self.fits_header['DATE']  # type: ignore
-            self.file_time_header = datetime.strptime(
-                _DATE, '%Y-%m-%dT%H:%M:%S').timestamp()
+        self.txt_exists, self._txt_file_parser = self._locate_txtparser()
+
+        if cache is not None:
+            self.metadata = self._make_metadata()
+            cache.store(self.full_filepath, self.metadata)
+
+    @staticmethod
+    def _header_file_time(header: fits.Header) -> float:
+        if 'DATE' in header:
+            _DATE: str = header['DATE']  # type: ignore
         else:
-            _DATE = f"{self.fits_header['DATE-OBS']}T{self.fits_header['UT']}"
-            self.file_time_header = datetime.strptime(
-                _DATE, '%Y-%m-%dT%H:%M:%S').timestamp()
+            _DATE = f"{header['DATE-OBS']}T{header['UT']}"
+        return datetime.strptime(_DATE, '%Y-%m-%dT%H:%M:%S').timestamp()
+
+    def _metadata_cache(self) -> t_Op[FileObjCache]:
+        if not type(self).USE_METADATA_CACHE:
+            return None
+        return get_fileobj_cache(self.full_rootfolder)
+
+    def _make_metadata(self) -> FileMeta:
+        assert self.disk_stat is not None
+        t_first_us, t_last_us = self._txt_time_bounds_us()
+        return FileMeta(
+            self.disk_stat.st_size, self.disk_stat.st_mtime_ns,
+            *file_signature(self.txt_file_path),
+            header=pack_header(self.fits_header),
+            file_time_header=self.file_time_header,
+            n_frames=self.get_nframes(),
+            txt_exists=self.txt_exists,
+            t_first_us=t_first_us,
+            t_last_us=t_last_us)
+
+    @property
+    def fits_header(self) -> fits.Header:
+        if self._fits_header is None:
+            if self.metadata is not None:
+                self._fits_header = self.metadata.get_header()
+            else:
+                self._fits_header = self._locate_fitsheader()
+        return self._fits_header
 
-        self.txt_file_path: Path = self.full_filepath.parent / (
-            self.full_filepath.stem + '.txt')
+    @fits_header.setter
+    def fits_header(self, header: fits.Header) -> None:
+        self._fits_header = header
+
+    @property
+    def txt_file_parser(self) -> t_Op[LogshimTxtParser]:
+        if self._txt_file_parser is None and self.txt_exists and self.is_on_disk:
+            self._txt_file_parser = LogshimTxtParser(self.txt_file_path)
+        return self._txt_file_parser
 
-        self.txt_exists, self.txt_file_parser = self._locate_txtparser()
+    @txt_file_parser.setter
+    def txt_file_parser(self, parser: t_Op[LogshimTxtParser]) -> None:
+        self._txt_file_parser = parser
+
+    def _txt_time_bounds_us(self) -> typ.Tuple[t_Op[float], t_Op[float]]:
+        '''
+        First and last framegrabber times, without parsing the txt file if we have them cached.
+        '''
+        if not self.txt_exists:
+            return None, None
+        if self._txt_file_parser is None and self.metadata is not None:
+            return self.metadata.t_first_us, self.metadata.t_last_us
+        assert self.txt_file_parser is not None
+        return self.txt_file_parser.time_bounds_us()
 
     def _locate_fitsheader(self) -> fits.Header:
         if self.is_on_disk:
@@ -144,7 +278,7 @@ class MotherOfFileObj(abc.ABC):
     def _locate_txtparser(self) -> typ.Tuple[bool, t_Op[LogshimTxtParser]]:
         if self.is_on_disk and self.txt_file_path.is_file():
             txt_file_parser = LogshimTxtParser(self.txt_file_path)
-            if len(txt_file_parser.lines) == self.get_nframes():
+            if txt_file_parser.n_lines == self.get_nframes():
                 return True, txt_file_parser
             else:
                 return False, None
@@ -159,17 +293,25 @@ class MotherOfFileObj(abc.ABC):
         self.txt_exists = False
         self.txt_file_parser = None
 
-    def write_to_disk(self, try_flush_ram: bool = False) -> None:
+    def stage_to_disk(self) -> Path:
+        '''
+        First half of write_to_disk: write the txt file, and the data under the tmp/ subfolder.
+        Returns the staged path - see publish_staged_file.
+        '''
         if self.is_on_disk:
-            message = f"MotherOfFileObj::write_to_disk: already exists - {str(self.full_filepath)}"
+            message = f"MotherOfFileObj::stage_to_disk: already exists - {str(self.full_filepath)}"
             logg.critical(message)
             raise AssertionError(message)
 
         os.makedirs(self.full_filepath.parent, exist_ok=True)
 
+        fsync = type(self).FSYNC_POLICY
+
         if self.txt_exists:
             assert self.txt_file_parser is not None
             self.txt_file_parser.write_to_disk()
+            if fsync != FSYNC.NONE:
+                fsync_path(self.txt_file_path)
 
         # Attempt an atomic write that will avoid the typical globs *.fits that we use.
         os.makedirs(self.full_filepath.parent / 'tmp', exist_ok=True)
@@ -178,10 +320,18 @@ class MotherOfFileObj(abc.ABC):
 
         self._write_data_to_disk(tmped_name)
 
-        shutil.move(str(tmped_name), self.full_filepath)
+        if fsync != FSYNC.NONE:
+            fsync_path(tmped_name)
 
         # DO NOT delete the /tmp folder... race condition with other processes!
 
+        return tmped_name
+
+    def write_to_disk(self, try_flush_ram: bool = False) -> None:
+        tmped_name = self.stage_to_disk()
+
+        publish_staged_file(tmped_name, self.full_filepath, type(self).FSYNC_POLICY)
+
         self.is_on_disk = True
 
         if try_flush_ram:
@@ -287,26 +437,49 @@ class MotherOfFileObj(abc.ABC):
         self._move(new_full_filepath, allow_makedirs=allow_makedirs)
 
     def _move(self, new_full_path: Path, allow_makedirs: bool = True) -> None:
+        '''
+        Only the path-derived members change: the header, txt arrays and
+        stat we already have are still those of the (same) file.
+        '''
 
         if allow_makedirs and self.is_on_disk:
             os.makedirs(new_full_path.parent, exist_ok=True)
 
         new_txt_path = new_full_path.parent / (new_full_path.stem + '.txt')
 
+        old_full_filepath = self.full_filepath
+        old_cache = self._metadata_cache() if self.is_on_disk else None
+
         if self.is_on_disk:
             logg.warning(
                 f'MotherOfFileObj::_move - moving {str(self.full_filepath)}'
                 f' to {new_full_path}')
             if self.txt_exists:
-                shutil.move(str(self.txt_file_path), new_txt_path)
-            shutil.move(str(self.full_filepath), new_full_path)
+                _rename_or_move(self.txt_file_path, new_txt_path)
+                try:  # Binary timing sidecar, if any
+                    _rename_or_move(Path(timing_sidecar_path(self.txt_file_path)),
+                                    Path(timing_sidecar_path(new_txt_path)))
+                except FileNotFoundError:
+                    pass
+            _rename_or_move(self.full_filepath, new_full_path)
 
         self.full_filepath = new_full_path
 
-        # Re-initialize internals.
-        if self.is_on_disk:
-            self._initial_existence_check()
-        self._initialize_members()
+        self._initialize_path_members()
+        self.file_time = self.time_from_filename if self.time_from_filename else self.file_time_creation
+
+        if self._txt_file_parser is not None:
+            if self.is_on_disk:
+                self._txt_file_parser.follow_file_move(str(self.txt_file_path))
+            else:
+                self._txt_file_parser.name = str(self.txt_file_path)
+
+        # Carry the cache entry over - rename(2) keeps size and mtime.
+        if old_cache is not None:
+            old_cache.forget(old_full_filepath)
+            new_cache = self._metadata_cache()
+            if new_cache is not None and self.metadata is not None:
+                new_cache.store(self.full_filepath, self.metadata)
 
     @abc.abstractmethod
     def get_nframes(self) -> int:
@@ -325,35 +498,40 @@ class MotherOfFileObj(abc.ABC):
         if self.data is not None and self.is_on_disk:
             del self.data
             self.data = None
-            if self.constr_data:
+            if self.constr_data is not None:
                 del self.constr_data
                 self.constr_data = None
 
     @abc.abstractmethod
-    def _merge_data_after(self, other_data):
+    def _merge_data_after(self, *others_data):
         pass
 
     def merge_with_file_after(self, other: MotherOfFileObj) -> MotherOfFileObj:
+        return self.merge_with_files_after([other])
+
+    def merge_with_files_after(self, others: typ.Sequence[MotherOfFileObj]) -> MotherOfFileObj:
+        '''
+            One file of self's frames then the others', in order - header, txt and data built once.
+        '''
 
         # Assert we're merging identical subclass types.
-        assert type(self) == type(other)
+        assert all(type(self) == type(other) for other in others)
 
         self._ensure_data_loaded()
-        other._ensure_data_loaded()
+        for other in others:
+            other._ensure_data_loaded()
 
         assert (self.txt_file_parser is not None
-                and other.txt_file_parser is not None)
-        parser = self.txt_file_parser.clone_instance()
-        parser.lines += other.txt_file_parser.lines
-        parser._init_arrays_from_lines()
+                and all(other.txt_file_parser is not None for other in others))
+        parser = self.txt_file_parser.concatenated_with(*[other.txt_file_parser for other in others])
 
         header = self.fits_header.copy()
-        header['NAXIS3'] = self.get_nframes() + other.get_nframes()
+        header['NAXIS3'] = self.get_nframes() + sum(other.get_nframes() for other in others)
 
         tstr = fix_header_times(header, parser.fgrab_t_us[0] / 1e6,
                                 parser.fgrab_t_us[-1] / 1e6)
 
-        merge_data = self._merge_data_after(other.data)
+        merge_data = self._merge_data_after(*[other.data for other in others])
 
         # Instantiate the appropriate subclass
         file_obj = type(self)(self.full_filepath,
@@ -423,13 +601,14 @@ class MotherOfFileObj(abc.ABC):
     def get_start_unixtime_secs(self) -> float:
 
         if self.txt_exists:
-            assert self.txt_file_parser is not None
+            t_first_us, _ = self._txt_time_bounds_us()
+            assert t_first_us is not None
             if ('EXPTIME' in self.fits_header
                     and self.fits_header['EXPTIME'] is not None):
-                return (self.txt_file_parser.fgrab_t_us[0] / 1e6 -
+                return (t_first_us / 1e6 -
                         self.fits_header['EXPTIME'])
             else:
-                return self.txt_file_parser.fgrab_t_us[0] / 1e6
+                return t_first_us / 1e6
         elif 'DATE-OBS' in self.fits_header and 'UT-STR' in self.fits_header:
             # Return timestamp from UT-START - one exposure
             full_tstr = (
@@ -454,8 +633,9 @@ class MotherOfFileObj(abc.ABC):
     def get_finish_unixtime_secs(self) -> float:
         if self.txt_exists:
             # Return acqtime from last frame
-            assert self.txt_file_parser is not None
-            return self.txt_file_parser.fgrab_t_us[-1] / 1e6
+            _, t_last_us = self._txt_time_bounds_us()
+            assert t_last_us is not None
+            return t_last_us / 1e6
         elif 'DATE-OBS' in self.fits_header and 'UT-END' in self.fits_header:
             # Return timestamp from UT-END
             full_tstr = (
@@ -477,12 +657,43 @@ class MotherOfFileObj(abc.ABC):
 
     def edit_header(self, key: str, value):
         '''
-        Don't use this for multiple updates... gun' be slow.
+        For multiple updates, use defer_header_edit then flush_header_edits.
+        '''
+        self.defer_header_edit(key, value)
+        self.flush_header_edits()
+
+    def defer_header_edit(self, key: str, value):
+        '''
+        Edit the in-RAM header now, and queue the on-disk edit until flush_header_edits.
         '''
         self.fits_header[key] = value
         if self.is_on_disk:
-            with fits.open(self.full_filepath, 'update') as fptr:
-                fptr[self.HDU_POS].header[key] = value
+            self.pending_header_edits[key] = value
+
+    def flush_header_edits(self) -> None:
+        '''
+        Write all the queued header edits in one go, in place when possible.
+        '''
+        if self.is_on_disk and len(self.pending_header_edits) > 0:
+            patch_header(self.full_filepath, self.pending_header_edits, self.HDU_POS)
+            self._refresh_metadata()
+        self.pending_header_edits = {}
+
+    def _refresh_metadata(self) -> None:
+        '''
+        We just changed the file: re-validate our cache entry rather than let the next run re-read it.
+        '''
+        cache = self._metadata_cache()
+        if self.metadata is None or cache is None:
+            return
+        self.disk_stat = os.stat(self.full_filepath)
+        self.file_time_header = self._header_file_time(self.fits_header)
+        self.metadata = self.metadata._replace(
+            size=self.disk_stat.st_size,
+            mtime_ns=self.disk_stat.st_mtime_ns,
+            header=pack_header(self.fits_header),
+            file_time_header=self.file_time_header)
+        cache.store(self.full_filepath, self.metadata)
 
     def delete_from_disk(self,
                          try_purge_ram: bool = False,
@@ -492,6 +703,7 @@ class MotherOfFileObj(abc.ABC):
             return
 
         assert self.is_on_disk
+        self.pending_header_edits = {}
 
         logg.warning(
             f'MotherOfFileObj::delete_from_disk - '
@@ -507,8 +719,17 @@ class MotherOfFileObj(abc.ABC):
                     str(self.full_filepath) + extension)
         if self.txt_exists:
             os.remove(str(self.txt_file_path) + extension)
+            try:
+                os.remove(timing_sidecar_path(self.txt_file_path))
+            except FileNotFoundError:
+                pass
         os.remove(str(self.full_filepath) + extension)
 
+        cache = self._metadata_cache()
+        if cache is not None:
+            cache.forget(self.full_filepath)
+        self.metadata = None
+
         self.is_on_disk = False  # But we don't have self.const_data as in an originally virtual file.
 
         if try_purge_ram:
@@ -5,11 +5,20 @@ import logging
 
 logg = logging.getLogger(__name__)
 
+t_Op = typ.Optional
+
+import functools
 import glob
 import pathlib
+from concurrent import futures
+
+import numpy as np
+from astropy.io import fits
 
 from .fits_file_obj import FitsFileObj
-from .framelist_file_obj import FrameListFitsFileObj
+from .frame_source import FrameSelection, FrameSource, open_frame_source
+from .framelist_file_obj import FrameListFitsFileObj, FrameRefs
+from .fileobj_cache import flush_fileobj_caches
 
 if typ.TYPE_CHECKING:
     StrPath = typ.Union[str, pathlib.Path]
@@ -21,10 +30,8 @@ def convert_to_filelist_obj(fobj: FitsFileObj) -> FrameListFitsFileObj:
 
     n_frames = fobj.get_nframes()
 
-    import numpy as np
-    flist_data = np.zeros((n_frames, 2), dtype=object)
-    flist_data[:, 0] = str(fobj.full_filepath)
-    flist_data[:, 1] = np.arange(n_frames).astype(np.uint64)
+    flist_data = FrameRefs(np.array([str(fobj.full_filepath)]), np.zeros(n_frames, np.int32),
+                           np.arange(n_frames, dtype=np.int64))
 
     flist_fobj = FrameListFitsFileObj(flist_path,
                                       on_disk=False,
@@ -35,40 +42,93 @@ def convert_to_filelist_obj(fobj: FitsFileObj) -> FrameListFitsFileObj:
     return flist_fobj
 
 
-def consolidate_framelist_to_fits(
-        fobj: FrameListFitsFileObj,
-        seek_dict: typ.Optional[typ.Dict[str, FitsFileObj]] = None) -> FitsFileObj:
+def _frame_source_for(path: str, seek_dict: t_Op[typ.Dict[str, FitsFileObj]]) -> FrameSource:
+    if seek_dict is not None and path in seek_dict:
+        seek_fobj = seek_dict[path]
+        seek_fobj._ensure_data_loaded()
+        data = seek_fobj.data
+        if isinstance(data, FrameSelection) and len(data.segments) == 1 and len(data) == data.sources[0].n_frames:
+            return data.sources[0]
+        return FrameSource(np.asarray(data), path=pathlib.Path(path))
+
+    source = open_frame_source(path)
+    if source is None:  # .gz - no choice but to read it whole.
+        source = FrameSource(fits.getdata(path), path=pathlib.Path(path))
+    return source
+
+
+def frame_selection_from_refs(
+        refs: FrameRefs,
+        seek_dict: t_Op[typ.Dict[str, FitsFileObj]] = None,
+        source_cache: t_Op[typ.Dict[str, FrameSource]] = None,
+        what: str = '') -> FrameSelection:
+    '''
+        The referenced frames, in order, as a FrameSelection over lazy sources
+        (memmaps / tile reads) - one source per file, one segment per run of consecutive frames.
+        Nothing is read until the selection is iterated.
 
-    fobj._ensure_data_loaded()
-    
-    import numpy as np
+        source_cache: {path: source}, used and filled - to share sources across calls.
+    '''
+    if source_cache is None:
+        source_cache = {}
+    sources: typ.List[FrameSource] = []
+    for path in refs.paths:
+        if str(path) not in source_cache:
+            source_cache[str(path)] = _frame_source_for(str(path), seek_dict)
+        sources.append(source_cache[str(path)])
+
+    run_path_idx, run_first, run_count = refs.to_runs()
+    segments: typ.List[typ.Tuple[FrameSource, np.ndarray]] = []
+    for path_idx, first, count in zip(run_path_idx, run_first, run_count):
+        source = sources[path_idx]
+        if first < 0 or first + count > source.n_frames:
+            message = (f'frame_selection_from_refs: frames [{first}, {first + count}) of '
+                       f'{refs.paths[path_idx]} ({source.n_frames} frames) - {what}')
+            logg.critical(message)
+            raise AssertionError(message)
+        segments.append((source, np.arange(first, first + count)))
+
+    if len(segments) == 0:
+        message = f'frame_selection_from_refs: no frames - {what}'
+        logg.critical(message)
+        raise AssertionError(message)
+
+    return FrameSelection(segments)
+
+
+def plan_framelist_consolidation(
+        fobj: FrameListFitsFileObj,
+        seek_dict: t_Op[typ.Dict[str, FitsFileObj]] = None) -> FrameSelection:
+    '''
+        The frames of the framelist, in order, as a FrameSelection - see frame_selection_from_refs.
+    '''
+    return frame_selection_from_refs(fobj.get_frame_refs(), seek_dict, what=str(fobj.full_filepath))
 
-    assert (fobj.data is not None and isinstance(fobj.data, np.ndarray)
-            and fobj.data.dtype == object)
-    
-    required_fits_files = set(fobj.data[:, 0])
 
-    useful_dict: typ.Dict[str, FitsFileObj] = {}
+def consolidate_framelist_to_fits(
+        fobj: FrameListFitsFileObj,
+        seek_dict: t_Op[typ.Dict[str, FitsFileObj]] = None) -> FitsFileObj:
+    '''
+        The (not on disk) FitsFileObj of the consolidated framelist.
 
-    for req_ffo_str in required_fits_files:
-        if seek_dict is not None and req_ffo_str in seek_dict:
-            useful_dict[req_ffo_str] = seek_dict[req_ffo_str]
-        else:
-            useful_dict[req_ffo_str] = FitsFileObj(req_ffo_str)
-        useful_dict[req_ffo_str]._ensure_data_loaded()
+        Its data is the plan_framelist_consolidation selection: write_to_disk then streams it,
+        reading at most FitsFileObj.WRITE_CHUNK_BYTES of frames at a time, grouped by source file.
+    '''
+    plan = plan_framelist_consolidation(fobj, seek_dict)
 
     fits_path = '.fits'.join(str(fobj.full_filepath).rsplit('.fitsframes', 1))
 
-    # The fact that data is a list an not a single block ndarray might help with speed.
-    # Astropy tolerates it (because fits.writeto is called with header != None)
-    data = [useful_dict[filename].data[kk] for filename, kk in fobj.data]
+    # The framelist header describes an empty data unit.
+    header = fobj.fits_header.copy()
+    for kk, n_axis in enumerate(plan.shape[::-1]):
+        header[f'NAXIS{kk + 1}'] = n_axis
 
     real_fits_obj = FitsFileObj(fits_path,
                                 on_disk=False,
-                                header=fobj.fits_header,
-                                data=data,
+                                header=header,
+                                data=plan,
                                 txt_parser=fobj.txt_file_parser)
-    
+
     return real_fits_obj
 
     # WARNING! As soon as you write FITS files in vgen2,
@@ -90,7 +150,11 @@ def make_fileobjs_from_globs(
         pos_globs: typ.List[str],
         neg_globs: typ.List[str],
         sort_by_time: bool = True,
-        type_to_use: type = FitsFileObj) -> typ.List[FitsFileObj]:
+        type_to_use: type = FitsFileObj,
+        **kwargs) -> typ.List[FitsFileObj]:
+    '''
+        kwargs: mode, n_workers, errors - see make_fileobjs_from_filenames
+    '''
 
     filename_set: typ.Set[str] = set()
     for pp in pos_globs:
@@ -101,7 +165,8 @@ def make_fileobjs_from_globs(
 
     file_obj_list = make_fileobjs_from_filenames(list(filename_set),
                                                  sort_by_time,
-                                                 type_to_use=type_to_use)
+                                                 type_to_use=type_to_use,
+                                                 **kwargs)
 
     return file_obj_list
 
@@ -126,20 +191,82 @@ def separate_compression_dups(
     return list_uncomp
 
 
+class FOBJ_MODE:
+    SERIAL = 'serial'
+    THREAD = 'thread'  # Header / txt I/O bound: network or spinning disks
+    PROCESS = 'process'  # Parsing bound: cold metadata cache
+
+
+T_FobjErrors = typ.List[typ.Tuple[str, BaseException]]
+
+
+def _make_fileobj_or_error(type_to_use: type, filename: str) -> typ.Tuple[typ.Any, t_Op[BaseException]]:
+    try:
+        return type_to_use(filename), None
+    except Exception as exc:
+        return None, exc
+
+
 def make_fileobjs_from_filenames(
         filename_list: typ.List[str],
         sort_by_time: bool = True,
-        type_to_use: type = FitsFileObj) -> typ.List[FitsFileObj]:
+        type_to_use: type = FitsFileObj,
+        mode: str = FOBJ_MODE.THREAD,
+        n_workers: t_Op[int] = None,
+        errors: t_Op[T_FobjErrors] = None) -> typ.List[FitsFileObj]:
     '''
         Turn a list of raw file names into a list of fileobjects
         
         Object based rewrite of former archive_monitor_process_filename
             from scxkw.daemons.g2archiving
+
+        mode: FOBJ_MODE - construct in the calling thread, a thread pool, or a process pool.
+        n_workers: pool size (None: executor default)
+        errors: if given, receives the (filename, exception) of the files we couldn't open.
+            These are logged and skipped in any case.
+
+        The output order only depends on the file names and times, not on the mode.
     '''
 
     from tqdm import tqdm
-    file_obj_list = [type_to_use(filename) for filename in tqdm(filename_list)]
 
+    filename_list = sorted(filename_list)
+
+    if mode == FOBJ_MODE.SERIAL or len(filename_list) <= 1:
+        results = [_make_fileobj_or_error(type_to_use, filename) for filename in tqdm(filename_list)]
+    elif mode in (FOBJ_MODE.THREAD, FOBJ_MODE.PROCESS):
+        executor_type = (futures.ThreadPoolExecutor if mode == FOBJ_MODE.THREAD
+                         else futures.ProcessPoolExecutor)
+        with executor_type(max_workers=n_workers) as executor:
+            # map: results in input order.
+            results = list(tqdm(executor.map(functools.partial(_make_fileobj_or_error, type_to_use),
+                                             filename_list, chunksize=1 if mode == FOBJ_MODE.THREAD else 16),
+                                total=len(filename_list)))
+    else:
+        message = f'make_fileobjs_from_filenames: unknown mode {mode}'
+        logg.critical(message)
+        raise AssertionError(message)
+
+    file_obj_list = []
+    for filename, (fobj, exc) in zip(filename_list, results):
+        if exc is not None:
+            logg.error(f'make_fileobjs_from_filenames: skipping {filename} - {exc!r}')
+            if errors is not None:
+                errors.append((filename, exc))
+            continue
+        file_obj_list.append(fobj)
+
+    if mode == FOBJ_MODE.PROCESS:
+        # Workers die without flushing their caches: keep what they found out in ours.
+        for fobj in file_obj_list:
+            cache = fobj._metadata_cache()
+            if cache is not None and fobj.metadata is not None:
+                cache.store(fobj.full_filepath, fobj.metadata)
+
+    # Persist what we just learnt about new files - the daemons never exit.
+    flush_fileobj_caches()
+
+    # Stable sorts on a sorted input: deterministic for equal times.
     if sort_by_time:
         file_obj_list.sort(key=lambda fobj: fobj.file_time)
     else:
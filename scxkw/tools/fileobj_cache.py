@@ -0,0 +1,249 @@
+'''
+    Metadata cache for MotherOfFileObj
+
+    Building a file object reads the FITS header and parses the whole logshim txt file.
+    Here we keep, per file path, what the file objects need to exist without touching
+    the file contents: the header (zlib'ed), the header time, the number of frames,
+    and the first / last framegrabber timestamps of the txt file.
+
+    Entries are validated against the (size, mtime_ns) of the FITS file and of its txt file,
+    so re-listing known files costs a couple of stat calls each.
+
+    The cache lives in RAM and, for the configured archive roots (GEN2PATH_*), in an SQLite file
+    at the root (<root>/<date>/<stream>/<file>). Files elsewhere, or a root that is not writable,
+    get the in-RAM part only.
+'''
+from __future__ import annotations
+import typing as typ
+
+import logging
+
+logg = logging.getLogger(__name__)
+
+import atexit
+import os
+import sqlite3
+import threading
+import zlib
+from pathlib import Path
+
+from astropy.io import fits
+
+from scxkw import config as cfg
+
+CACHE_FILENAME = '.scxkw_fobj_cache.sqlite'
+
+# (size, mtime_ns) - (-1, -1) if the file does not exist.
+T_Signature = typ.Tuple[int, int]
+NO_FILE_SIGNATURE: T_Signature = (-1, -1)
+
+# Only these roots get an SQLite file - config names, not all of them are set on every machine.
+PERSISTENT_ROOT_KEYS = ('GEN2PATH_PRELIM', 'GEN2PATH_NODELETE', 'GEN2PATH_OKDELETE')
+
+
+def persistent_roots() -> typ.Set[str]:
+    return {
+        os.path.normpath(os.path.abspath(getattr(cfg, key)))
+        for key in PERSISTENT_ROOT_KEYS if getattr(cfg, key, None)
+    }
+
+
+def file_signature(path: typ.Union[str, Path]) -> T_Signature:
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return NO_FILE_SIGNATURE
+    return st.st_size, st.st_mtime_ns
+
+
+def pack_header(header: fits.Header) -> bytes:
+    return zlib.compress(header.tostring().encode('ascii'), 1)
+
+
+class FileMeta(typ.NamedTuple):
+    size: int
+    mtime_ns: int
+    txt_size: int
+    txt_mtime_ns: int
+    header: bytes  # pack_header
+    file_time_header: typ.Optional[float]
+    n_frames: int
+    txt_exists: bool
+    t_first_us: typ.Optional[float]
+    t_last_us: typ.Optional[float]
+
+    def is_valid(self, signature: T_Signature, txt_signature: T_Signature) -> bool:
+        return ((self.size, self.mtime_ns) == signature and
+                (self.txt_size, self.txt_mtime_ns) == txt_signature)
+
+    def get_header(self) -> fits.Header:
+        return fits.Header.fromstring(zlib.decompress(self.header).decode('ascii'))
+
+
+class FileObjCache:
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS fobj_meta (
+            path TEXT PRIMARY KEY,
+            folder TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            txt_size INTEGER NOT NULL,
+            txt_mtime_ns INTEGER NOT NULL,
+            header BLOB NOT NULL,
+            file_time_header REAL,
+            n_frames INTEGER NOT NULL,
+            txt_exists INTEGER NOT NULL,
+            t_first_us REAL,
+            t_last_us REAL
+        );
+        CREATE INDEX IF NOT EXISTS fobj_meta_folder ON fobj_meta (folder);
+    '''
+
+    # Batch the commits when filling a cold cache.
+    COMMIT_EVERY = 64
+
+    def __init__(self, root: typ.Union[str, Path], db_path: typ.Optional[typ.Union[str, Path]] = None,
+                 persistent: bool = True) -> None:
+        self.root = Path(root).absolute()
+        self.db_path = Path(db_path) if db_path is not None else self.root / CACHE_FILENAME
+
+        self.lock = threading.RLock()
+        self.entries: typ.Dict[str, FileMeta] = {}
+        self.loaded_folders: typ.Set[str] = set()
+        # Writes are queued and done in one short transaction - never hold the lock between calls.
+        self.pending_stores: typ.Dict[str, FileMeta] = {}
+        self.pending_forgets: typ.Set[str] = set()
+
+        self.conn: typ.Optional[sqlite3.Connection] = None
+        if not persistent:
+            return
+        try:
+            self.conn = sqlite3.connect(str(self.db_path), timeout=30.0, check_same_thread=False)
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.executescript(self.SCHEMA)
+            self.conn.commit()
+        except sqlite3.Error as exc:
+            logg.warning(f'FileObjCache::__init__ - cannot use {self.db_path} ({exc}) - RAM only.')
+            self.conn = None
+
+    def close(self) -> None:
+        self.flush()
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def flush(self) -> None:
+        with self.lock:
+            stores, self.pending_stores = self.pending_stores, {}
+            forgets, self.pending_forgets = self.pending_forgets, set()
+            if self.conn is None or len(stores) + len(forgets) == 0:
+                return
+            try:
+                with self.conn:  # One transaction
+                    self.conn.executemany('DELETE FROM fobj_meta WHERE path = ?', [(p, ) for p in forgets])
+                    self.conn.executemany(
+                        f'INSERT OR REPLACE INTO fobj_meta (path, folder, {", ".join(FileMeta._fields)}) '
+                        f'VALUES ({", ".join("?" * (len(FileMeta._fields) + 2))})',
+                        [(p, os.path.dirname(p)) + tuple(meta) for p, meta in stores.items()])
+            except sqlite3.Error as exc:
+                # It's only a cache.
+                logg.warning(f'FileObjCache::flush - {self.db_path}: {exc}')
+
+    def _load_folder(self, folder: str) -> None:
+        '''
+            One query for all the entries of a folder - we're usually building all its file objects.
+        '''
+        self.loaded_folders.add(folder)
+        if self.conn is None:
+            return
+        try:
+            rows = self.conn.execute(f'SELECT path, {", ".join(FileMeta._fields)} FROM fobj_meta '
+                                     'WHERE folder = ?', (folder, )).fetchall()
+        except sqlite3.Error as exc:
+            logg.warning(f'FileObjCache::_load_folder - {self.db_path}: {exc}')
+            return
+        for row in rows:
+            self.entries.setdefault(row[0], self._meta_from_row(row[1:]))
+
+    def _load_path(self, path: str) -> typ.Optional[FileMeta]:
+        if self.conn is None:
+            return None
+        try:
+            row = self.conn.execute(f'SELECT {", ".join(FileMeta._fields)} FROM fobj_meta WHERE path = ?',
+                                    (path, )).fetchone()
+        except sqlite3.Error as exc:
+            logg.warning(f'FileObjCache::_load_path - {self.db_path}: {exc}')
+            return None
+        return None if row is None else self._meta_from_row(row)
+
+    @staticmethod
+    def _meta_from_row(row: typ.Sequence[typ.Any]) -> FileMeta:
+        meta = FileMeta(*row)
+        return meta._replace(txt_exists=bool(meta.txt_exists))
+
+    def lookup(self, path: typ.Union[str, Path], signature: T_Signature,
+               txt_signature: T_Signature) -> typ.Optional[FileMeta]:
+        '''
+            The cached entry for <path>, if it matches the current file signatures.
+        '''
+        path = str(path)
+        with self.lock:
+            folder = os.path.dirname(path)
+            if folder not in self.loaded_folders:
+                self._load_folder(folder)
+
+            meta = self.entries.get(path)
+            if meta is not None and meta.is_valid(signature, txt_signature):
+                return meta
+            if path in self.pending_stores or path in self.pending_forgets:
+                return None  # Ours is the latest word on that one.
+
+            # Another process may have refreshed it since we loaded the folder.
+            meta = self._load_path(path)
+            if meta is not None and meta.is_valid(signature, txt_signature):
+                self.entries[path] = meta
+                return meta
+
+            return None
+
+    def store(self, path: typ.Union[str, Path], meta: FileMeta) -> None:
+        path = str(path)
+        with self.lock:
+            self.entries[path] = meta
+            self.pending_forgets.discard(path)
+            self.pending_stores[path] = meta
+            if len(self.pending_stores) >= self.COMMIT_EVERY:
+                self.flush()
+
+    def forget(self, path: typ.Union[str, Path]) -> None:
+        path = str(path)
+        with self.lock:
+            self.entries.pop(path, None)
+            self.pending_stores.pop(path, None)
+            self.pending_forgets.add(path)
+
+
+# Keyed by pid too: a forked worker must not reuse its parent's SQLite connection.
+_CACHES: typ.Dict[typ.Tuple[int, str], FileObjCache] = {}
+_CACHES_LOCK = threading.Lock()
+
+
+def get_fileobj_cache(root: typ.Union[str, Path]) -> FileObjCache:
+    '''
+        One cache per archive root per process - RAM only unless <root> is one of the persistent_roots().
+    '''
+    key = (os.getpid(), str(Path(root).absolute()))
+    with _CACHES_LOCK:
+        if key not in _CACHES:
+            _CACHES[key] = FileObjCache(key[1], persistent=os.path.normpath(key[1]) in persistent_roots())
+        return _CACHES[key]
+
+
+def flush_fileobj_caches() -> None:
+    for (pid, _), cache in list(_CACHES.items()):
+        if pid == os.getpid():
+            cache.flush()
+
+
+atexit.register(flush_fileobj_caches)
@@ -0,0 +1,191 @@
+'''
+    In-process tile compression to fpack-compatible .fits.fz files
+
+    Uses astropy's CompImageHDU (cfitsio's tile compression code) with the algorithm and
+    parameters parsed from an fpack option string, so that the FpackJobManager can swap
+    an `fpack` subprocess for a worker in a process pool.
+
+    The input is memory-mapped and not rescaled (BZERO/BSCALE kept as-is), so we never
+    hold a scaled copy of the cube in RAM.
+'''
+from __future__ import annotations
+import typing as typ
+
+import logging
+
+logg = logging.getLogger(__name__)
+
+import os
+import shutil
+import subprocess as sproc
+import tempfile
+import time
+from concurrent import futures
+
+from astropy.io import fits
+
+FPACK_ALGORITHMS = {
+    '-r': 'RICE_1',
+    '-h': 'HCOMPRESS_1',
+    '-g': 'GZIP_1',
+    '-g1': 'GZIP_1',
+    '-g2': 'GZIP_2',
+    '-p': 'PLIO_1',
+}
+
+# fpack flags with no effect on the output file.
+FPACK_IGNORED_FLAGS = ('-v', '-Y', '-C')
+
+
+def fpack_options_to_kwargs(fpack_options: str) -> typ.Tuple[typ.Dict[str, typ.Any], bool]:
+    '''
+        Translate an fpack option string (e.g. '-h -s 0 -q 20') to CompImageHDU keyword arguments.
+
+        Returns (kwargs, delete_original)
+    '''
+    kwargs: typ.Dict[str, typ.Any] = {'compression_type': 'RICE_1'}  # fpack default
+    delete_original = False
+
+    tokens = fpack_options.split()
+    ii = 0
+    while ii < len(tokens):
+        tok = tokens[ii]
+        if tok in FPACK_ALGORITHMS:
+            kwargs['compression_type'] = FPACK_ALGORITHMS[tok]
+        elif tok == '-s':
+            ii += 1
+            kwargs['hcomp_scale'] = float(tokens[ii])
+        elif tok in ('-q', '-qz'):
+            ii += 1
+            kwargs['quantize_level'] = float(tokens[ii])
+            kwargs['quantize_method'] = 2 if tok == '-qz' else 1
+        elif tok == '-t':
+            ii += 1
+            # fpack gives the fastest axis first, astropy wants numpy order.
+            kwargs['tile_shape'] = tuple(int(t) for t in tokens[ii].split(','))[::-1]
+        elif tok == '-D':
+            delete_original = True
+        elif tok in FPACK_IGNORED_FLAGS:
+            pass
+        else:
+            message = f'fpack_options_to_kwargs: unsupported fpack option {tok} in "{fpack_options}"'
+            logg.critical(message)
+            raise AssertionError(message)
+        ii += 1
+
+    return kwargs, delete_original
+
+
+def write_compressed(filename: str, out_filename: str, comp_kwargs: typ.Dict[str, typ.Any]) -> None:
+    '''
+        Compress the primary HDU of <filename> into <out_filename>, as fpack would:
+        empty primary HDU + compressed image extension.
+    '''
+    with fits.open(filename, memmap=True, do_not_scale_image_data=True) as hdul:
+        header = hdul[0].header
+        data = hdul[0].data
+        tile_shape = comp_kwargs.get('tile_shape')
+        if tile_shape is not None and len(tile_shape) < data.ndim:
+            # Like fpack -t, unspecified (slow) axes get 1.
+            comp_kwargs = dict(comp_kwargs, tile_shape=(1, ) * (data.ndim - len(tile_shape)) + tuple(tile_shape))
+        comp_hdu = fits.CompImageHDU(data, header, **comp_kwargs)
+        # CompImageHDU drops the scaling keywords of unscaled data - put them back.
+        for key in ('BZERO', 'BSCALE'):
+            if key in header:
+                comp_hdu.header[key] = header[key]
+        fits.HDUList([fits.PrimaryHDU(), comp_hdu]).writeto(out_filename)
+
+
+def compress_file_inprocess(filename: str, fpack_options: str) -> typ.Tuple[int, int]:
+    '''
+        Drop-in for `fpack <fpack_options> <filename>`: writes <filename>.fz
+        (atomically, through a .tmp file), deletes the original with -D.
+
+        Returns (input bytes, output bytes)
+    '''
+    comp_kwargs, delete_original = fpack_options_to_kwargs(fpack_options)
+
+    out_filename = filename + '.fz'
+    tmp_filename = out_filename + '.tmp'
+    try:
+        write_compressed(filename, tmp_filename, comp_kwargs)
+    except Exception:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        raise
+
+    n_bytes_in = os.path.getsize(filename)
+    n_bytes_out = os.path.getsize(tmp_filename)
+    os.rename(tmp_filename, out_filename)
+
+    if delete_original:
+        os.remove(filename)
+
+    return n_bytes_in, n_bytes_out
+
+
+def compress_files_inprocess(filenames: typ.Iterable[str], fpack_options: str,
+                             n_workers: typ.Optional[int] = None) -> typ.Tuple[int, int]:
+    '''
+        Compress many files over a process pool - largest first, to finish together.
+
+        Returns (n_files, n_failed)
+    '''
+    filenames = sorted(filenames, key=os.path.getsize, reverse=True)
+    n_failed = 0
+    with futures.ProcessPoolExecutor(max_workers=n_workers) as executor:
+        future_to_name = {
+            executor.submit(compress_file_inprocess, fname, fpack_options): fname
+            for fname in filenames
+        }
+        for fut in futures.as_completed(future_to_name):
+            exc = fut.exception()
+            if exc is not None:
+                n_failed += 1
+                logg.error(f'compress_files_inprocess: {future_to_name[fut]} failed - {exc}')
+
+    return len(filenames), n_failed
+
+
+def benchmark_backends(filenames: typ.Iterable[str], fpack_options: str,
+                       tmp_dir: typ.Optional[str] = None) -> typ.List[typ.Dict[str, typ.Any]]:
+    '''
+        Compress copies of <filenames> with the external fpack and with the in-process backend.
+
+        Returns one dict per (file, backend) with ratio and MB/s.
+    '''
+    # Never let -D delete the copies under our feet while we measure.
+    options_keep = ' '.join(tok for tok in fpack_options.split() if tok != '-D')
+
+    results: typ.List[typ.Dict[str, typ.Any]] = []
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as workdir:
+        for filename in filenames:
+            n_bytes = os.path.getsize(filename)
+            for backend in ('fpack', 'inprocess'):
+                copy_name = os.path.join(workdir, f'{backend}_{os.path.basename(filename)}')
+                shutil.copyfile(filename, copy_name)
+
+                t_start = time.time()
+                if backend == 'fpack':
+                    sproc.run(['fpack'] + options_keep.split() + [copy_name], check=True,
+                              stdout=sproc.DEVNULL, stderr=sproc.DEVNULL)
+                else:
+                    compress_file_inprocess(copy_name, options_keep)
+                elapsed = time.time() - t_start
+
+                n_bytes_out = os.path.getsize(copy_name + '.fz')
+                results.append({
+                    'file': filename,
+                    'backend': backend,
+                    'ratio': n_bytes / n_bytes_out,
+                    'MBps': n_bytes / 1024**2 / max(elapsed, 1e-6),
+                    'seconds': elapsed,
+                })
+                os.remove(copy_name)
+                os.remove(copy_name + '.fz')
+
+    for res in results:
+        logg.warning(f'benchmark_backends: {res["backend"]:>9s} {os.path.basename(res["file"])} - '
+                     f'ratio {res["ratio"]:.2f}, {res["MBps"]:.1f} MB/s')
+
+    return results
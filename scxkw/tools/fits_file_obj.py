@@ -16,9 +16,20 @@ from .logshim_txt_parser import LogshimTxtParser
 from .fix_header import fix_header_times
 
 from .file_obj import MotherOfFileObj
+from .frame_source import CHUNK_BYTES, FrameSelection, TiledFrameSource, open_frame_source
+from .fits_stream_writer import write_fits_cube
 
 class FitsFileObj(MotherOfFileObj):
 
+    # Cubes on disk: memory-map (or tile-read .fz), and let sub-files index into
+    # the source rather than copy - see frame_source.
+    LAZY_DATA = True
+    # Write through fits_stream_writer rather than fits.writeto
+    STREAM_WRITES = True
+    # Frame data held in RAM at once by streamed writes (about twice that when gathering
+    # frames from several sources, see FrameSelection.iter_chunks)
+    WRITE_CHUNK_BYTES = CHUNK_BYTES
+
     def _initial_name_check(self) -> None:
         if not self.full_filepath.is_absolute():
             message = f"FitsFileObj::_initial_name_check: not an absolute path - {str(self.full_filepath)}"
@@ -31,14 +42,26 @@ class FitsFileObj(MotherOfFileObj):
             raise AssertionError(message)
         
     def _write_data_to_disk(self, filename: Path) -> None:
-        # Miles: I had to hack this in on 2023/09/14 reducing data in /mnt/tier0/20230914
-        self.constr_data = np.asarray(self.constr_data)
-        # </Miles>
+        data = self.constr_data
+        if not self.STREAM_WRITES:
+            # Miles: I had to hack this in on 2023/09/14 reducing data in /mnt/tier0/20230914
+            self.constr_data = np.asarray(self.constr_data)
+            # </Miles>
+            logg.warning(
+                f'FitsFileObj::write_to_disk - Writing {str(self.full_filepath)} '
+                f'({self.get_nframes()}x[{self.constr_data.shape[1]}x{self.constr_data.shape[2]}])'
+            )
+            fits.writeto(filename, self.constr_data, self.fits_header)
+            return
+
         logg.warning(
             f'FitsFileObj::write_to_disk - Writing {str(self.full_filepath)} '
-            f'({self.get_nframes()}x[{self.constr_data.shape[1]}x{self.constr_data.shape[2]}])'
+            f'({self.get_nframes()}x[{self.fits_header["NAXIS2"]}x{self.fits_header["NAXIS1"]}])'
         )
-        fits.writeto(filename, self.constr_data, self.fits_header)
+        # Lists of frames (framelist consolidation), FrameSelections: streamed chunk by chunk,
+        # never stacked in RAM.
+        n_frames = len(data) if hasattr(data, '__len__') else self.get_nframes()
+        write_fits_cube(filename, self.fits_header, data, n_frames=n_frames, chunk_bytes=self.WRITE_CHUNK_BYTES)
 
     def get_nframes(self) -> int:
         # Assume logshim format... n_frames = last axis
@@ -48,18 +71,28 @@ class FitsFileObj(MotherOfFileObj):
     def _ensure_data_loaded(self):
         if self.data is None:
             if self.is_on_disk:
-                self.data = fits.getdata(self.full_filepath, memmap=False)
+                source = open_frame_source(self.full_filepath, self.HDU_POS) if self.LAZY_DATA else None
+                if source is not None:
+                    self.data = FrameSelection.from_source(source)
+                else:
+                    self.data = fits.getdata(self.full_filepath, memmap=False)
             else:
                 self.data = self.constr_data
 
-    def _merge_data_after(self, other_data):
-        np.concatenate((self.data, other_data), axis=0)
+    def _merge_data_after(self, *others_data):
+        all_data = (self.data, ) + others_data
+        if all(isinstance(data, FrameSelection) for data in all_data):
+            return FrameSelection.concatenate(all_data)
+        return np.concatenate([np.asarray(data) for data in all_data], axis=0)
 
 
 class FitsFzFileObj(MotherOfFileObj):
 
     HDU_POS = 1 # We're working on the first extension
 
+    # Decompress only the tiles of the frames we read - see frame_source.TiledFrameSource
+    LAZY_DATA = True
+
     def _initial_name_check(self) -> None:
         if not self.full_filepath.is_absolute():
             message = f"FitsFileObj::_initial_name_check: not an absolute path - {str(self.full_filepath)}"
@@ -82,10 +115,13 @@ class FitsFzFileObj(MotherOfFileObj):
     def _ensure_data_loaded(self):
         if self.data is None:
             if self.is_on_disk:
-                # This will uncompress HDU 1
-                self.data = fits.getdata(self.full_filepath, memmap=False)
+                if self.LAZY_DATA:
+                    self.data = FrameSelection.from_source(TiledFrameSource(self.full_filepath, self.HDU_POS))
+                else:
+                    # This will uncompress HDU 1
+                    self.data = fits.getdata(self.full_filepath, memmap=False)
             else:
                 self.data = self.constr_data
 
-    def _merge_data_after(self, other_data):
+    def _merge_data_after(self, *others_data):
         raise NotImplementedError('Illegal on .fits.fz. For now.')
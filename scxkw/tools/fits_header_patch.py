@@ -0,0 +1,139 @@
+'''
+    In-place FITS header patching
+
+    fits.open(..., 'update') may rewrite the whole file (multi-GB cubes) as soon as
+    the header changes size. Here we serialize the edited header and, if it still fits
+    in the 2880-byte blocks already allocated on disk (using the blank padding after END),
+    we only overwrite the 80-byte cards that changed.
+    Only if the header really overflows its blocks do we fall back to astropy's full rewrite.
+'''
+from __future__ import annotations
+import typing as typ
+
+import logging
+
+logg = logging.getLogger(__name__)
+
+import os
+import re
+from pathlib import Path
+from astropy.io import fits
+
+FITS_BLOCK = 2880
+FITS_CARD = 80
+END_CARD = b'END'.ljust(FITS_CARD, b' ')
+
+T_Edits = typ.Union[typ.Dict[str, typ.Any], typ.Callable[[fits.Header], None]]
+
+# Keys that define the data layout: never patch those in place.
+_STRUCTURAL_KEY_REGEX = re.compile(
+    r'^(SIMPLE|XTENSION|BITPIX|NAXIS\d*|EXTEND|PCOUNT|GCOUNT|GROUPS|TFIELDS|THEAP|'
+    r'T(FORM|TYPE|DIM|SCAL|ZERO|NULL|UNIT)\d+|Z[A-Z]+\d*)$')
+
+
+def _data_size_bytes(header: fits.Header) -> int:
+    '''
+        Size of the data unit following <header>, padded to FITS blocks.
+    '''
+    n_axis = header.get('NAXIS', 0)
+    if n_axis == 0:
+        return 0
+    n_elem = 1
+    for kk in range(1, n_axis + 1):
+        n_elem *= header[f'NAXIS{kk}']
+    n_bytes = abs(header['BITPIX']) // 8 * header.get('GCOUNT', 1) * (header.get('PCOUNT', 0) + n_elem)
+    return -(-n_bytes // FITS_BLOCK) * FITS_BLOCK
+
+
+def locate_header(fileobj: typ.BinaryIO, hdu_number: int = 0) -> typ.Tuple[int, bytes]:
+    '''
+        Find the raw header of HDU <hdu_number> by walking the file.
+
+        Returns (byte offset of the header, raw header bytes including the END block padding)
+    '''
+    offset = 0
+    for hdu_idx in range(hdu_number + 1):
+        fileobj.seek(offset)
+        blocks: typ.List[bytes] = []
+        while True:
+            block = fileobj.read(FITS_BLOCK)
+            if len(block) < FITS_BLOCK:
+                message = f'locate_header: unexpected EOF looking for HDU {hdu_number} - {fileobj.name}'
+                logg.critical(message)
+                raise AssertionError(message)
+            blocks.append(block)
+            if any(block[ii:ii + FITS_CARD] == END_CARD for ii in range(0, FITS_BLOCK, FITS_CARD)):
+                break
+        raw = b''.join(blocks)
+        if hdu_idx == hdu_number:
+            return offset, raw
+        offset += len(raw) + _data_size_bytes(fits.Header.fromstring(raw.decode('ascii')))
+
+    raise AssertionError('Unreachable')
+
+
+def _apply_edits(header: fits.Header, edits: T_Edits) -> None:
+    if callable(edits):
+        edits(header)
+    else:
+        for key, value in edits.items():
+            header[key] = value
+
+
+def _touches_structure(old_header: fits.Header, new_header: fits.Header) -> bool:
+    for key in set(old_header.keys()) ^ set(new_header.keys()):
+        if _STRUCTURAL_KEY_REGEX.match(key):
+            return True
+    for key in old_header.keys():
+        if _STRUCTURAL_KEY_REGEX.match(key) and key in new_header and old_header[key] != new_header[key]:
+            return True
+    return False
+
+
+def patch_header(filename: typ.Union[str, Path], edits: T_Edits, hdu_number: int = 0) -> bool:
+    '''
+        Apply <edits> to the header of HDU <hdu_number> of <filename>.
+
+        <edits> is either a {key: value | (value, comment)} dict,
+        or a function that edits a fits.Header in place.
+
+        For compressed (.fits.fz) files, the header is the raw BINTABLE header;
+        non-structural keys are shared with the image header.
+
+        Returns True if patched in place, False if we had to fall back to a full rewrite.
+    '''
+    with open(filename, 'rb') as fptr:
+        hdr_offset, raw_old = locate_header(fptr, hdu_number)
+
+    old_header = fits.Header.fromstring(raw_old.decode('ascii'))
+    new_header = old_header.copy()
+    _apply_edits(new_header, edits)
+
+    raw_new = new_header.tostring().encode('ascii')  # Padded with blanks to a multiple of 2880.
+
+    if len(raw_new) > len(raw_old) or _touches_structure(old_header, new_header):
+        logg.warning(f'patch_header: header of {filename} overflows its blocks or '
+                     'changes the data layout - full rewrite.')
+        with fits.open(filename, 'update', disable_image_compression=True) as hdul:
+            _apply_edits(hdul[hdu_number].header, edits)
+        return False
+
+    raw_new = raw_new.ljust(len(raw_old), b' ')
+
+    # Runs of consecutive changed cards, as (start, end) byte offsets within the header
+    runs: typ.List[typ.List[int]] = []
+    for ii in range(0, len(raw_old), FITS_CARD):
+        if raw_new[ii:ii + FITS_CARD] != raw_old[ii:ii + FITS_CARD]:
+            if runs and runs[-1][1] == ii:
+                runs[-1][1] = ii + FITS_CARD
+            else:
+                runs.append([ii, ii + FITS_CARD])
+
+    fd = os.open(filename, os.O_RDWR)
+    try:
+        for start, end in runs:
+            os.pwrite(fd, raw_new[start:end], hdr_offset + start)
+    finally:
+        os.close(fd)
+
+    return True
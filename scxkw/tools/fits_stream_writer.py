@@ -0,0 +1,276 @@
+'''
+    Streaming FITS cube writer
+
+    fits.writeto wants the whole cube as one array - and turns a list of frames into one.
+    Here we write the header, then the frames in order, from any iterable of frames / chunks
+    of frames (or a FrameSelection), straight into the output file:
+        - the file is pre-sized with fallocate when the filesystem supports it,
+        - data goes out in large writes ending on ALIGN boundaries (small frames are batched),
+        - we hold at most one input chunk plus WRITE_BYTES of output buffer.
+
+    The header is the one fits.writeto would produce for that data (BITPIX, BZERO for unsigned
+    ints...), so files are byte-identical to the astropy ones.
+
+    Atomicity (tmp file + rename) and the fsync policy are handled by the caller,
+    see MotherOfFileObj.write_to_disk.
+'''
+from __future__ import annotations
+import typing as typ
+
+import logging
+
+logg = logging.getLogger(__name__)
+
+import ctypes
+import ctypes.util
+import errno
+import io
+import itertools
+import os
+from pathlib import Path
+
+import numpy as np
+from astropy.io import fits
+from astropy.io.fits.hdu.base import BITPIX2DTYPE
+
+from .fits_header_patch import FITS_BLOCK
+from .frame_source import CHUNK_BYTES, FrameSelection
+
+
+class FSYNC:
+    NONE = 'none'  # Leave it to the page cache
+    FILE = 'file'  # fsync the file before the rename
+    FULL = 'full'  # ... and the folder after the rename
+
+
+ALIGN = 1024**2
+WRITE_BYTES = 8 * 1024**2
+
+_LIBC: typ.Any = None
+
+
+def _fallocate(fd: int, size: int) -> bool:
+    '''
+        fallocate(2) - not posix_fallocate, whose glibc fallback writes every block
+        on filesystems without support (NFS...). Returns False if not supported.
+    '''
+    global _LIBC
+    if _LIBC is None:
+        try:
+            _LIBC = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            _LIBC.fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+        except (OSError, AttributeError):
+            _LIBC = False
+    if _LIBC is False or size == 0:
+        return False
+    if _LIBC.fallocate(fd, 0, 0, size) != 0:
+        err = ctypes.get_errno()
+        if err not in (errno.EOPNOTSUPP, errno.ENOSYS):
+            logg.warning(f'_fallocate: {os.strerror(err)}')
+        return False
+    return True
+
+
+def fsync_path(path: typ.Union[str, Path]) -> None:
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def header_for_cube(header: fits.Header, dtype: np.dtype, shape: typ.Tuple[int, ...]) -> fits.Header:
+    '''
+        The primary header fits.writeto(filename, <dtype, shape> data, header) would write.
+    '''
+    dummy = fits.PrimaryHDU(np.zeros((1, ) * len(shape), dtype), header)
+    buff = io.BytesIO()
+    dummy.writeto(buff)
+    out_header = fits.Header.fromstring(buff.getvalue()[:len(buff.getvalue()) - FITS_BLOCK].decode('ascii'))
+    for kk, n_axis in enumerate(shape[::-1]):
+        out_header[f'NAXIS{kk + 1}'] = n_axis
+    return out_header
+
+
+class FitsCubeWriter:
+    '''
+        with FitsCubeWriter(filename, header, dtype, shape) as writer:
+            for chunk in chunks:
+                writer.write(chunk)
+
+        Chunks are frames (ndim - 1) or stacks of frames (ndim), of the physical dtype
+        (what fits.getdata would return) - or of the on-disk dtype, then written as-is.
+    '''
+
+    def __init__(self,
+                 filename: typ.Union[str, Path],
+                 header: fits.Header,
+                 dtype: np.dtype,
+                 shape: typ.Tuple[int, ...],
+                 preallocate: bool = True) -> None:
+        self.filename = Path(filename)
+        self.dtype = np.dtype(dtype)
+        self.shape = tuple(shape)
+        self.header = header_for_cube(header, self.dtype, self.shape)
+
+        self.bzero = self.header.get('BZERO', 0)
+        self.bscale = self.header.get('BSCALE', 1)
+        self.raw_dtype = np.dtype(BITPIX2DTYPE[self.header['BITPIX']]).newbyteorder('>')
+        if not (self.bscale == 1 and self.bzero in (0, -128, 2**(self.raw_dtype.itemsize * 8 - 1))):
+            message = f'FitsCubeWriter::__init__: unsupported scaling BZERO={self.bzero} BSCALE={self.bscale} - {self.filename}'
+            logg.critical(message)
+            raise AssertionError(message)
+
+        header_bytes = self.header.tostring().encode('ascii')
+        self.data_bytes = int(np.prod(self.shape)) * self.raw_dtype.itemsize
+        self.total_bytes = len(header_bytes) + -(-self.data_bytes // FITS_BLOCK) * FITS_BLOCK
+        self.n_data_written = 0
+
+        self.fd = os.open(self.filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        if preallocate:
+            _fallocate(self.fd, self.total_bytes)
+
+        # Bytes not yet written, starting at file offset self.offset (always ALIGNed when empty).
+        self.offset = 0
+        self.pending = bytearray(header_bytes)
+
+    def __enter__(self) -> FitsCubeWriter:
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def _write_out(self, buff: typ.Union[bytes, bytearray, memoryview]) -> None:
+        view = memoryview(buff)
+        while len(view) > 0:
+            n = os.pwrite(self.fd, view, self.offset)
+            self.offset += n
+            view = view[n:]
+
+    def _write_bytes(self, buff: memoryview) -> None:
+        if len(self.pending) > 0:
+            if len(self.pending) + len(buff) < WRITE_BYTES:
+                self.pending += buff
+                return
+            # Top up to the next ALIGN boundary, and write out.
+            n_top = min(len(buff), -(self.offset + len(self.pending)) % ALIGN)
+            self.pending += buff[:n_top]
+            buff = buff[n_top:]
+            if (self.offset + len(self.pending)) % ALIGN != 0:
+                return
+            self._write_out(self.pending)
+            self.pending = bytearray()
+
+        # Big enough: straight from the caller's buffer, no copy.
+        n_direct = len(buff) // ALIGN * ALIGN
+        if n_direct >= WRITE_BYTES:
+            self._write_out(buff[:n_direct])
+            buff = buff[n_direct:]
+        self.pending += buff
+
+    def _to_raw(self, chunk: np.ndarray) -> np.ndarray:
+        if chunk.dtype.newbyteorder('=') == self.raw_dtype.newbyteorder('='):
+            pass  # Already on-disk values
+        elif chunk.dtype.newbyteorder('=') == self.dtype and self.bzero != 0:
+            # Offset integers: flip the sign bit.
+            sign_bit = np.array(1 << (self.dtype.itemsize * 8 - 1), f'u{self.dtype.itemsize}').view(self.dtype)
+            chunk = (chunk.astype(self.dtype, copy=False) ^ sign_bit).view(self.raw_dtype.newbyteorder('='))
+        else:
+            message = f'FitsCubeWriter::write: got {chunk.dtype} data for {self.dtype} - {self.filename}'
+            logg.critical(message)
+            raise AssertionError(message)
+        return np.ascontiguousarray(chunk, dtype=self.raw_dtype)
+
+    def write(self, chunk: np.ndarray) -> None:
+        chunk = np.asarray(chunk)
+        if chunk.shape[chunk.ndim - len(self.shape) + 1:] != self.shape[1:]:
+            message = f'FitsCubeWriter::write: chunk shape {chunk.shape} for cube {self.shape} - {self.filename}'
+            logg.critical(message)
+            raise AssertionError(message)
+
+        raw = self._to_raw(chunk)
+        if self.n_data_written + raw.nbytes > self.data_bytes:
+            message = f'FitsCubeWriter::write: more data than the {self.shape} cube - {self.filename}'
+            logg.critical(message)
+            raise AssertionError(message)
+
+        self._write_bytes(memoryview(raw).cast('B'))
+        self.n_data_written += raw.nbytes
+
+    def close(self) -> None:
+        if self.n_data_written != self.data_bytes:
+            self.abort()
+            message = (f'FitsCubeWriter::close: {self.n_data_written} bytes of data written '
+                       f'for a {self.data_bytes} bytes cube - {self.filename}')
+            logg.critical(message)
+            raise AssertionError(message)
+
+        self.pending += bytes(self.total_bytes - self.offset - len(self.pending))  # FITS block padding
+        self._write_out(self.pending)
+        self.pending = bytearray()
+        os.close(self.fd)
+        self.fd = -1
+
+    def abort(self) -> None:
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+        if self.filename.exists():
+            os.remove(self.filename)
+
+
+def _peek(iterable: typ.Iterable[np.ndarray]) -> typ.Tuple[typ.Optional[np.ndarray], typ.Iterator[np.ndarray]]:
+    iterator = iter(iterable)
+    first = next(iterator, None)
+    if first is None:
+        return None, iterator
+    first = np.asarray(first)
+    return first, itertools.chain([first], iterator)
+
+
+def write_fits_cube(filename: typ.Union[str, Path],
+                    header: fits.Header,
+                    data: typ.Union[np.ndarray, FrameSelection, typ.Iterable[np.ndarray]],
+                    n_frames: typ.Optional[int] = None,
+                    chunk_bytes: int = CHUNK_BYTES) -> None:
+    '''
+        Write <data> as a FITS cube (frames on axis 0), at most one chunk in RAM at a time.
+
+        <data> can be a cube, a FrameSelection (frames read from its sources one chunk at a time),
+        or an iterable of frames / chunks of frames - then n_frames must be given.
+    '''
+    chunks: typ.Iterator[np.ndarray]
+    if isinstance(data, FrameSelection):
+        shape = data.shape
+        dtype = data.dtype
+    elif isinstance(data, np.ndarray):
+        frames_per_chunk = max(1, chunk_bytes // max(1, data[:1].nbytes))
+        chunks = (data[kk:kk + frames_per_chunk] for kk in range(0, len(data), frames_per_chunk))
+        shape = data.shape
+        dtype = data.dtype
+    else:
+        if n_frames is None:
+            message = f'write_fits_cube: need n_frames to stream an iterable - {filename}'
+            logg.critical(message)
+            raise AssertionError(message)
+        first, chunks = _peek(data)
+        if first is None:
+            message = f'write_fits_cube: no data - {filename}'
+            logg.critical(message)
+            raise AssertionError(message)
+        # Frames, or chunks of frames?
+        frame_shape = first.shape if first.ndim == 2 else first.shape[1:]
+        shape = (n_frames, ) + tuple(frame_shape)
+        dtype = first.dtype
+
+    with FitsCubeWriter(filename, header, dtype, shape) as writer:
+        if isinstance(data, FrameSelection):
+            if data.raw_format() == (writer.raw_dtype.newbyteorder('='), writer.bzero, writer.bscale):
+                chunks = data.iter_raw_chunks(chunk_bytes)  # The source bytes, as-is.
+            else:
+                chunks = data.iter_chunks(chunk_bytes)
+        for chunk in chunks:
+            writer.write(chunk)
@@ -19,6 +19,7 @@ import glob
 from datetime import datetime, timezone, timedelta
 
 from .fits_format import format_values
+from .fits_header_patch import patch_header
 
 
 def fix_header_times(header: fits.Header, start_time_unix: float,
@@ -146,9 +147,7 @@ def fix_file(filename: str,
         Comments will ALWAYS be superseded.
     '''
 
-    with fits.open(filename, 'update') as f:
-        hdu = f[hdu_number]
-        header = hdu.header
+    def _apply(header: fits.Header) -> None:
         existing_keys = set(header)
         new_keys = set(new_keyvals)
 
@@ -178,6 +177,8 @@ def fix_file(filename: str,
                     formattable_val, _ = format_values(val, fmt_dict[key], non_equalizable_formattables = True)
                     header[key] = formattable_val
 
+    patch_header(filename, _apply, hdu_number)
+
 
 def reformat_all_files(folder: str | Path):
     key_list = rdbutil.get_all_uppercase_keys_from_redis()
@@ -0,0 +1,459 @@
+'''
+    Lazy, zero-copy frame access for FITS cubes
+
+    A FrameSource is a cube we can read frames from: the memory-mapped raw data unit of an
+    uncompressed FITS file (BZERO / BSCALE applied on read only), any in-RAM array,
+    or a tile-compressed (.fits.fz) HDU of which we only decompress the tiles we read.
+
+    A FrameSelection is an ordered list of (source, frame indices) segments. Sub-files and
+    merged files carry FrameSelections instead of copied data: boolean masks and concatenations
+    only compose index arrays, and frames are read - in chunks - when they're eventually written.
+
+    Frame axis is axis 0 (numpy order, NAXIS3 for logshim cubes).
+'''
+from __future__ import annotations
+import typing as typ
+
+import logging
+
+logg = logging.getLogger(__name__)
+
+import collections
+from pathlib import Path
+
+import numpy as np
+from astropy.io import fits
+from astropy.io.fits.hdu.base import BITPIX2DTYPE
+
+from .fits_header_patch import locate_header
+
+# Upper bound on the frame data materialized at once by FrameSelection.iter_chunks
+CHUNK_BYTES = 64 * 1024**2
+
+
+def _physical_dtype(raw_dtype: np.dtype, bzero: float, bscale: float) -> np.dtype:
+    '''
+        The dtype astropy would give the scaled data (uint=True).
+    '''
+    if bzero == 0 and bscale == 1:
+        return raw_dtype.newbyteorder('=')
+    if bscale == 1 and raw_dtype.kind == 'i':
+        n_bits = raw_dtype.itemsize * 8
+        if n_bits > 8 and bzero == 2**(n_bits - 1):
+            return np.dtype(f'u{raw_dtype.itemsize}')
+    if raw_dtype.kind == 'u' and raw_dtype.itemsize == 1 and bscale == 1 and bzero == -128:
+        return np.dtype(np.int8)
+    if raw_dtype.itemsize <= 2 or raw_dtype == np.dtype('>f4'):
+        return np.dtype(np.float32)
+    return np.dtype(np.float64)
+
+
+class FrameSource:
+    '''
+        A cube to read frames from. <raw> is the data as stored (a memmap for files).
+    '''
+
+    def __init__(self,
+                 raw: np.ndarray,
+                 bzero: float = 0,
+                 bscale: float = 1,
+                 path: typ.Optional[Path] = None) -> None:
+        self.raw = raw
+        self.path = path
+        self._set_format(raw.dtype, raw.shape, bzero, bscale)
+
+    def _set_format(self, raw_dtype: np.dtype, shape: typ.Tuple[int, ...], bzero: float, bscale: float) -> None:
+        self.raw_dtype = raw_dtype
+        self.shape = tuple(shape)
+        self.bzero = bzero
+        self.bscale = bscale
+        self.dtype = _physical_dtype(raw_dtype, bzero, bscale)
+
+    @classmethod
+    def from_fits(cls, path: typ.Union[str, Path], hdu_number: int = 0) -> FrameSource:
+        '''
+            Memory-map the data unit of HDU <hdu_number> - uncompressed files only.
+            Costs reading the header blocks; pages are only touched when frames are read.
+        '''
+        path = Path(path)
+        with open(path, 'rb') as fptr:
+            hdr_offset, raw_header = locate_header(fptr, hdu_number)
+        header = fits.Header.fromstring(raw_header.decode('ascii'))
+
+        shape = tuple(header[f'NAXIS{kk}'] for kk in range(header['NAXIS'], 0, -1))
+        raw_dtype = np.dtype(BITPIX2DTYPE[header['BITPIX']]).newbyteorder('>')
+        if len(shape) == 0 or np.prod(shape) == 0:
+            raw = np.zeros(shape, raw_dtype)
+        else:
+            raw = np.memmap(path, dtype=raw_dtype, mode='r', offset=hdr_offset + len(raw_header), shape=shape)
+
+        return cls(raw, header.get('BZERO', 0), header.get('BSCALE', 1), path)
+
+    @property
+    def n_frames(self) -> int:
+        return self.shape[0]
+
+    @property
+    def frame_shape(self) -> typ.Tuple[int, ...]:
+        return self.shape[1:]
+
+    @property
+    def is_scaled(self) -> bool:
+        return not (self.bzero == 0 and self.bscale == 1)
+
+    def read_raw(self, indices: typ.Union[np.ndarray, slice, int]) -> np.ndarray:
+        # Fancy indexing a memmap copies only the frames requested.
+        return np.asarray(self.raw[indices])
+
+    def scale(self, raw: np.ndarray) -> np.ndarray:
+        '''
+            raw (as stored) -> physical values, native byte order.
+        '''
+        if not self.is_scaled:
+            return raw.astype(self.dtype, copy=False)
+        if self.dtype.kind == 'u' or self.dtype == np.int8:
+            # Offset integers: flip the sign bit rather than go through floats.
+            native = raw.astype(raw.dtype.newbyteorder('='), copy=False)
+            sign_bit = np.array(1 << (self.dtype.itemsize * 8 - 1), f'u{self.dtype.itemsize}').view(self.dtype)
+            return native.view(self.dtype) ^ sign_bit
+        return raw.astype(self.dtype) * self.dtype.type(self.bscale) + self.dtype.type(self.bzero)
+
+    def read(self, indices: typ.Union[np.ndarray, slice, int]) -> np.ndarray:
+        return self.scale(self.read_raw(indices))
+
+    def close(self) -> None:
+        # A memmap is unmapped when the last reference to it goes - nothing to release here.
+        pass
+
+
+class TiledFrameSource(FrameSource):
+    '''
+        Frames of a tile-compressed image HDU (fpack'ed .fits.fz).
+
+        Reading frames decompresses only the tiles that hold them (CompImageHDU.section),
+        one "tile block" (tile size along the frame axis, usually 1 frame) at a time.
+        Recently decompressed blocks are kept in a small LRU cache.
+    '''
+
+    # Per source. Long sequential reads bypass it.
+    CACHE_BYTES = 64 * 1024**2
+
+    def __init__(self, path: typ.Union[str, Path], hdu_number: int = 1) -> None:
+        self.raw = None  # type: ignore
+        self.path = Path(path)
+        self.hdu_number = hdu_number
+        self._hdul: typ.Optional[fits.HDUList] = None
+
+        hdu = self._hdu()
+        header = hdu.header  # The image header, not the BINTABLE one.
+        self._set_format(np.dtype(BITPIX2DTYPE[header['BITPIX']]), hdu.shape,
+                         header.get('BZERO', 0), header.get('BSCALE', 1))
+        self.block_frames = int(hdu.tile_shape[0]) if len(self.shape) > 0 else 1
+
+        self._cache: collections.OrderedDict[int, np.ndarray] = collections.OrderedDict()
+        self._cache_bytes = 0
+
+    def _hdu(self) -> fits.CompImageHDU:
+        if self._hdul is None:
+            # Unscaled: we want the stored values, like the memmap of uncompressed files.
+            self._hdul = fits.open(self.path, do_not_scale_image_data=True)
+        return self._hdul[self.hdu_number]
+
+    def close(self) -> None:
+        if self._hdul is not None:
+            self._hdul.close()
+            self._hdul = None
+        self._cache.clear()
+        self._cache_bytes = 0
+
+    def _cache_store(self, block: int, data: np.ndarray) -> None:
+        if data.nbytes > self.CACHE_BYTES:
+            return
+        self._cache[block] = data
+        self._cache_bytes += data.nbytes
+        while self._cache_bytes > self.CACHE_BYTES:
+            _, evicted = self._cache.popitem(last=False)
+            self._cache_bytes -= evicted.nbytes
+
+    def _decompress_blocks(self, first: int, last: int) -> typ.List[np.ndarray]:
+        '''
+            Tile blocks [first, last], one section read.
+        '''
+        start = first * self.block_frames
+        stop = min((last + 1) * self.block_frames, self.n_frames)
+        data = np.asarray(self._hdu().section[start:stop])
+        blocks = [data[kk:kk + self.block_frames] for kk in range(0, len(data), self.block_frames)]
+        if data.nbytes <= self.CACHE_BYTES:
+            for block, block_data in zip(range(first, last + 1), blocks):
+                self._cache_store(block, block_data.copy())
+        return blocks
+
+    def read_raw(self, indices: typ.Union[np.ndarray, slice, int]) -> np.ndarray:
+        if isinstance(indices, (int, np.integer)):
+            return self.read_raw(np.array([indices]))[0]
+        indices = np.arange(self.n_frames)[indices]
+        out = np.empty((len(indices), ) + self.frame_shape, self.raw_dtype)
+        if len(indices) == 0:
+            return out
+
+        block_ids = indices // self.block_frames
+        needed = np.unique(block_ids)
+
+        # Cached blocks, then runs of consecutive missing blocks in one go each.
+        blocks: typ.Dict[int, np.ndarray] = {}
+        missing: typ.List[int] = []
+        for block in needed.tolist():
+            if block in self._cache:
+                self._cache.move_to_end(block)
+                blocks[block] = self._cache[block]
+            else:
+                missing.append(block)
+        if len(missing) > 0:
+            missing_arr = np.asarray(missing)
+            cuts = np.flatnonzero(np.diff(missing_arr) != 1) + 1
+            for run in np.split(missing_arr, cuts):
+                for block, block_data in zip(run.tolist(), self._decompress_blocks(run[0], run[-1])):
+                    blocks[block] = block_data
+
+        order = np.argsort(block_ids, kind='stable')
+        bounds = np.flatnonzero(np.diff(block_ids[order])) + 1
+        for group in np.split(order, bounds):
+            block = int(block_ids[group[0]])
+            out[group] = blocks[block][indices[group] - block * self.block_frames]
+        return out
+
+
+def open_frame_source(path: typ.Union[str, Path], hdu_number: int = 0) -> typ.Optional[FrameSource]:
+    '''
+        The lazy source for a FITS file: memmap, or tile reads for .fz (image in HDU 1+).
+        None if we can't do better than reading it whole (.gz).
+    '''
+    path = Path(path)
+    if path.suffix == '.fz':
+        return TiledFrameSource(path, max(hdu_number, 1))
+    if path.suffix == '.gz':
+        return None
+    return FrameSource.from_fits(path, hdu_number)
+
+
+def _as_indices(selector: typ.Any, length: int) -> np.ndarray:
+    if isinstance(selector, slice):
+        return np.arange(length)[selector]
+    selector = np.asarray(selector)
+    if selector.dtype == bool:
+        if len(selector) != length:
+            message = f'FrameSelection: boolean selector of length {len(selector)} for {length} frames.'
+            logg.critical(message)
+            raise AssertionError(message)
+        return np.flatnonzero(selector)
+    return np.arange(length)[selector]
+
+
+class FrameSelection:
+    '''
+        An ordered selection of frames across one or more FrameSources.
+
+        Behaves like a (read-only) cube for the file objects: len, shape, dtype, indexing,
+        np.asarray. Indexing with anything but an int returns another FrameSelection.
+    '''
+
+    def __init__(self, segments: typ.Sequence[typ.Tuple[FrameSource, np.ndarray]]) -> None:
+        self.segments: typ.List[typ.Tuple[FrameSource, np.ndarray]] = [
+            (source, np.asarray(indices, dtype=np.int64)) for source, indices in segments if len(indices) > 0
+        ]
+        if len(self.segments) == 0 and len(segments) > 0:
+            # Keep a source around for shape / dtype of empty selections.
+            self.segments = [(segments[0][0], np.zeros(0, np.int64))]
+
+        frame_shapes = set(source.frame_shape for source, _ in self.segments)
+        if len(frame_shapes) > 1:
+            message = f'FrameSelection::__init__: mixing frame shapes {frame_shapes}.'
+            logg.critical(message)
+            raise AssertionError(message)
+
+        self._length = sum(len(indices) for _, indices in self.segments)
+
+    @classmethod
+    def from_source(cls, source: FrameSource) -> FrameSelection:
+        return cls([(source, np.arange(source.n_frames))])
+
+    @classmethod
+    def from_fits(cls, path: typ.Union[str, Path], hdu_number: int = 0) -> FrameSelection:
+        return cls.from_source(FrameSource.from_fits(path, hdu_number))
+
+    @classmethod
+    def concatenate(cls, selections: typ.Iterable[FrameSelection]) -> FrameSelection:
+        segments: typ.List[typ.Tuple[FrameSource, np.ndarray]] = []
+        for sel in selections:
+            for source, indices in sel.segments:
+                if len(segments) > 0 and segments[-1][0] is source:
+                    segments[-1] = (source, np.concatenate((segments[-1][1], indices)))
+                else:
+                    segments.append((source, indices))
+        return cls(segments)
+
+    def __len__(self) -> int:
+        return self._length
+
+    @property
+    def frame_shape(self) -> typ.Tuple[int, ...]:
+        return self.segments[0][0].frame_shape
+
+    @property
+    def shape(self) -> typ.Tuple[int, ...]:
+        return (self._length, ) + self.frame_shape
+
+    @property
+    def ndim(self) -> int:
+        return len(self.shape)
+
+    @property
+    def dtype(self) -> np.dtype:
+        return self.segments[0][0].dtype
+
+    @property
+    def frame_nbytes(self) -> int:
+        return int(np.prod(self.frame_shape)) * self.dtype.itemsize
+
+    @property
+    def nbytes(self) -> int:
+        return self._length * self.frame_nbytes
+
+    @property
+    def sources(self) -> typ.List[FrameSource]:
+        seen: typ.Dict[int, FrameSource] = {}
+        for source, _ in self.segments:
+            seen.setdefault(id(source), source)
+        return list(seen.values())
+
+    def _locate(self, position: int) -> typ.Tuple[FrameSource, int]:
+        if position < 0:
+            position += self._length
+        if not 0 <= position < self._length:
+            raise IndexError(f'FrameSelection: frame {position} out of {self._length}')
+        for source, indices in self.segments:
+            if position < len(indices):
+                return source, int(indices[position])
+            position -= len(indices)
+        raise AssertionError('Unreachable')
+
+    def __getitem__(self, selector: typ.Any) -> typ.Union[np.ndarray, FrameSelection]:
+        if isinstance(selector, (int, np.integer)):
+            source, index = self._locate(int(selector))
+            return source.read(index)
+
+        positions = _as_indices(selector, self._length)
+        # Positions -> (segment, index within segment), keeping the requested order.
+        boundaries = np.cumsum([0] + [len(indices) for _, indices in self.segments])
+        seg_ids = np.searchsorted(boundaries, positions, side='right') - 1
+
+        segments: typ.List[typ.Tuple[FrameSource, np.ndarray]] = []
+        if len(positions) > 0:
+            # Split where the segment changes.
+            cuts = np.flatnonzero(np.diff(seg_ids)) + 1
+            for start, end in zip(np.r_[0, cuts], np.r_[cuts, len(positions)]):
+                seg_id = seg_ids[start]
+                source, indices = self.segments[seg_id]
+                segments.append((source, indices[positions[start:end] - boundaries[seg_id]]))
+        else:
+            segments.append((self.segments[0][0], np.zeros(0, np.int64)))
+
+        return FrameSelection(segments)
+
+    def iter_chunk_plans(self, max_bytes: int = CHUNK_BYTES) -> \
+            typ.Iterator[typ.List[typ.Tuple[FrameSource, np.ndarray]]]:
+        '''
+            The selection cut in consecutive chunks of at most <max_bytes> of frames,
+            each chunk as its list of (source, indices) pieces, in order.
+        '''
+        frames_per_chunk = max(1, max_bytes // max(1, self.frame_nbytes))
+        pieces: typ.List[typ.Tuple[FrameSource, np.ndarray]] = []
+        n_pieces_frames = 0
+        for source, indices in self.segments:
+            start = 0
+            while start < len(indices):
+                n_take = min(len(indices) - start, frames_per_chunk - n_pieces_frames)
+                pieces.append((source, indices[start:start + n_take]))
+                n_pieces_frames += n_take
+                start += n_take
+                if n_pieces_frames == frames_per_chunk:
+                    yield pieces
+                    pieces, n_pieces_frames = [], 0
+        if n_pieces_frames > 0:
+            yield pieces
+
+    def _gather(self, pieces: typ.List[typ.Tuple[FrameSource, np.ndarray]], raw: bool) -> np.ndarray:
+        '''
+            Read one chunk: one read per source, in increasing frame order (sequential I/O
+            whatever the interleaving of the sources in the output), scattered into place.
+        '''
+        if len(pieces) == 1:
+            source, indices = pieces[0]
+            read = source.read_raw if raw else source.read
+            return read(_contiguous_or_fancy(indices))
+
+        n_frames = sum(len(indices) for _, indices in pieces)
+        out_dtype = pieces[0][0].raw_dtype if raw else self.dtype
+        out = np.empty((n_frames, ) + self.frame_shape, out_dtype)
+
+        by_source: typ.Dict[int, typ.Tuple[FrameSource, typ.List[np.ndarray], typ.List[np.ndarray]]] = {}
+        position = 0
+        for source, indices in pieces:
+            _, src_indices, out_positions = by_source.setdefault(id(source), (source, [], []))
+            src_indices.append(indices)
+            out_positions.append(np.arange(position, position + len(indices)))
+            position += len(indices)
+
+        for source, src_indices, out_positions in by_source.values():
+            indices = np.concatenate(src_indices)
+            positions = np.concatenate(out_positions)
+            order = np.argsort(indices, kind='stable')
+            read = source.read_raw if raw else source.read
+            out[positions[order]] = read(_contiguous_or_fancy(indices[order]))
+        return out
+
+    def iter_chunks(self, max_bytes: int = CHUNK_BYTES) -> typ.Iterator[np.ndarray]:
+        '''
+            Physical values, in order, chunks of at most <max_bytes>.
+            Peak memory is about twice that: the chunk, and the frames of one of its sources.
+        '''
+        for pieces in self.iter_chunk_plans(max_bytes):
+            yield self._gather(pieces, raw=False)
+
+    def iter_raw_chunks(self, max_bytes: int = CHUNK_BYTES) -> typ.Iterator[np.ndarray]:
+        '''
+            Data as stored in the sources, in order - see raw_format.
+        '''
+        for pieces in self.iter_chunk_plans(max_bytes):
+            yield self._gather(pieces, raw=True)
+
+    def raw_format(self) -> typ.Optional[typ.Tuple[np.dtype, float, float]]:
+        '''
+            (raw dtype - native order, bzero, bscale) if shared by all the sources - then raw chunks can
+            be written out as-is under the same header. None otherwise.
+        '''
+        formats = set((source.raw_dtype.newbyteorder('='), source.bzero, source.bscale)
+                      for source, _ in self.segments)
+        return formats.pop() if len(formats) == 1 else None
+
+    def __array__(self, dtype=None, copy=None) -> np.ndarray:
+        out = np.empty(self.shape, self.dtype)
+        pos = 0
+        for chunk in self.iter_chunks():
+            out[pos:pos + len(chunk)] = chunk
+            pos += len(chunk)
+        return out if dtype is None else out.astype(dtype, copy=False)
+
+    def __repr__(self) -> str:
+        paths = ', '.join(str(source.path) for source in self.sources)
+        return f'FrameSelection({self._length} frames of {self.frame_shape} from [{paths}])'
+
+
+def _contiguous_or_fancy(indices: np.ndarray) -> typ.Union[np.ndarray, slice]:
+    # A slice of a memmap is a view, copied once by read_raw: cheaper than fancy indexing.
+    if len(indices) > 0 and indices[-1] - indices[0] == len(indices) - 1 and np.all(np.diff(indices) == 1):
+        return slice(int(indices[0]), int(indices[-1]) + 1)
+    return indices
+
+
+T_FrameData = typ.Union[np.ndarray, FrameSelection]
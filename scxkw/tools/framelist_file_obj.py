@@ -18,21 +18,113 @@ from .fix_header import fix_header_times
 from .file_obj import MotherOfFileObj
 
 
+# Legacy layout: one 264-byte row per frame, 256 bytes of space-padded path + a native uint64.
+LEGACY_PATH_BYTES = 256
+LEGACY_ROW_BYTES = LEGACY_PATH_BYTES + 8
+
+
+def _dedup_by_runs(keys: np.ndarray, run_starts: np.ndarray, n_rows: int) -> typ.Tuple[np.ndarray, np.ndarray]:
+    '''
+        Framelists are long runs of frames of the same file: only sort the key of each run.
+        Returns (unique keys, index of the unique key for each row)
+    '''
+    unique_keys, run_inverse = np.unique(keys[run_starts], return_inverse=True)
+    run_count = np.diff(np.r_[run_starts, n_rows])
+    return unique_keys, np.repeat(run_inverse.astype(np.int32), run_count)
+
+
+class FrameRefs(typ.NamedTuple):
+    '''
+        The frames of a framelist: frame kk is frame frame_idx[kk] of file paths[path_idx[kk]].
+        Every path appears once in paths.
+    '''
+    paths: np.ndarray  # str
+    path_idx: np.ndarray  # int32
+    frame_idx: np.ndarray  # int64
+
+    @property
+    def n_frames(self) -> int:
+        return len(self.path_idx)
+
+    @classmethod
+    def from_object_buff(cls, object_buff: np.ndarray) -> FrameRefs:
+        n_rows = object_buff.shape[0]
+        if n_rows == 0:
+            return cls(np.zeros(0, str), np.zeros(0, np.int32), np.zeros(0, np.int64))
+        col_paths = object_buff[:, 0]
+        run_starts = np.flatnonzero(np.r_[True, col_paths[1:] != col_paths[:-1]])
+        paths, path_idx = _dedup_by_runs(col_paths.astype(str), run_starts, n_rows)
+        return cls(paths, path_idx, object_buff[:, 1].astype(np.int64))
+
+    @classmethod
+    def from_uint_buff(cls, uint8_buff: np.ndarray) -> FrameRefs:
+        '''
+            From the legacy n x 264 uint8 rows.
+        '''
+        n_rows = uint8_buff.shape[0]
+        if n_rows == 0:
+            return cls(np.zeros(0, str), np.zeros(0, np.int32), np.zeros(0, np.int64))
+        rows = np.ascontiguousarray(uint8_buff).view(np.uint64)  # n x 33 - compare 8 bytes at a time.
+        path_words = rows[:, :LEGACY_PATH_BYTES // 8]
+        run_starts = np.flatnonzero(np.r_[True, np.any(path_words[1:] != path_words[:-1], axis=1)])
+        # Decode the path of each run only.
+        run_paths = np.ascontiguousarray(uint8_buff[run_starts, :LEGACY_PATH_BYTES]).view(f'S{LEGACY_PATH_BYTES}')[:, 0]
+        paths, run_inverse = np.unique(np.char.decode(np.char.strip(run_paths), 'ascii'), return_inverse=True)
+        path_idx = np.repeat(run_inverse.astype(np.int32), np.diff(np.r_[run_starts, n_rows]))
+        return cls(paths, path_idx, rows[:, -1].astype(np.int64))
+
+    @classmethod
+    def from_runs(cls, paths: np.ndarray, run_path_idx: np.ndarray, run_first: np.ndarray,
+                  run_count: np.ndarray) -> FrameRefs:
+        n_frames = int(np.sum(run_count))
+        run_starts = np.cumsum(run_count) - run_count
+        path_idx = np.repeat(run_path_idx.astype(np.int32), run_count)
+        frame_idx = np.repeat(run_first.astype(np.int64) - run_starts, run_count) + np.arange(n_frames)
+        return cls(paths, path_idx, frame_idx)
+
+    def to_runs(self) -> typ.Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        '''
+            (path index, first frame, n frames) of the runs of consecutive frames of the same file.
+        '''
+        n_frames = len(self.path_idx)
+        breaks = np.flatnonzero((np.diff(self.path_idx) != 0) | (np.diff(self.frame_idx) != 1)) + 1
+        run_starts = np.r_[0, breaks] if n_frames > 0 else np.zeros(0, np.int64)
+        run_count = np.diff(np.r_[run_starts, n_frames])
+        return self.path_idx[run_starts], self.frame_idx[run_starts], run_count
+
+    def to_object_buff(self) -> np.ndarray:
+        obj_arr = np.zeros((len(self.path_idx), 2), dtype=object)
+        obj_arr[:, 0] = self.paths.astype(object)[self.path_idx]
+        obj_arr[:, 1] = self.frame_idx
+        return obj_arr
+
+    def to_uint_buff(self) -> np.ndarray:
+        '''
+            To the legacy n x 264 uint8 rows.
+        '''
+        paths = np.char.encode(self.paths.astype(str), 'ascii')
+        if len(paths) > 0 and np.char.str_len(paths).max() > LEGACY_PATH_BYTES:
+            message = f'FrameRefs::to_uint_buff: path longer than {LEGACY_PATH_BYTES} characters.'
+            logg.critical(message)
+            raise AssertionError(message)
+        # Null-padded -> space-padded
+        paths_uint8 = paths.astype(f'S{LEGACY_PATH_BYTES}').view(np.uint8).reshape(len(paths), LEGACY_PATH_BYTES).copy()
+        paths_uint8[paths_uint8 == 0] = ord(' ')
+
+        buff_uint8 = np.zeros((len(self.path_idx), LEGACY_ROW_BYTES), dtype=np.uint8)
+        buff_uint8[:, :LEGACY_PATH_BYTES] = paths_uint8[self.path_idx]
+        buff_uint8.view(np.uint64)[:, -1] = self.frame_idx
+        return buff_uint8
+
+
 def object_buff_to_uint_buff(object_buff: np.ndarray) -> np.ndarray:
     '''
         object_buff should be a n x 2 object array
         object_buff[:, 0] should contain strings of len < 256
         object_buff[:, 1] should contain an int
     '''
-    n = object_buff.shape[0]
-    buff_uint8 = np.zeros((n, 264), dtype=np.uint8)
-    buff_uint64 = buff_uint8.view(dtype=np.uint64)
-
-    for ii in range(n):
-        buff_uint64[ii, :-1] = np.frombuffer(b'%-256s' % object_buff[ii, 0].encode('ascii'), dtype=np.uint64)
-        buff_uint64[ii, -1] = object_buff[ii, 1]
+    return FrameRefs.from_object_buff(object_buff).to_uint_buff()
 
-    return buff_uint8
 
 def uint_buff_to_object_buff(uint8_buff: np.ndarray) -> np.ndarray:
     '''
@@ -40,29 +132,39 @@ def uint_buff_to_object_buff(uint8_buff: np.ndarray) -> np.ndarray:
         the first 256 bytes encode the file name in ASCII
         the last 8 bytes encode an integer.
     '''
-    n = uint8_buff.shape[0]
-    uint64_buff = uint8_buff.view(dtype=np.uint64)
+    return FrameRefs.from_uint_buff(uint8_buff).to_object_buff()
 
-    obj_arr = np.zeros((n, 2), dtype=object)
 
-    for ii in range(n):
-        obj_arr[ii, 0] = uint8_buff[ii, :-8].tobytes().strip().decode('ascii')
-        obj_arr[ii, 1] = uint64_buff[ii, -1]
+class FrameListFitsFileObj(MotherOfFileObj):
+    '''
+        .fitsframes: the header of a FITS cube, and references to its frames in other files.
+
+        Layout:
+            HDU 0: the header, with an empty (NAXIS1 = 0) data unit - NAXIS3 is still the frame count.
+            FLPATHS: BINTABLE, one row per source file (PATH).
+            FLRUNS: BINTABLE of runs of consecutive frames (PATHIDX, FIRST, COUNT)
+                    - the (path index, frame index) column, run-length encoded.
+        Files from before that layout (264 bytes per frame in HDU 0) are still read.
+    '''
 
-    return obj_arr
+    DEBUG = False
 
+    PATHS_EXTNAME = 'FLPATHS'
+    RUNS_EXTNAME = 'FLRUNS'
 
-class FrameListFitsFileObj(MotherOfFileObj):
-    
-    DEBUG = False
+    # Write the legacy layout - for consumers not updated yet.
+    WRITE_LEGACY_FORMAT = False
 
     def __init__(self, *args, **kwargs):
 
+        self._frame_refs: typ.Optional[FrameRefs] = None
+
         MotherOfFileObj.__init__(self, *args, **kwargs)
 
         if type(self).DEBUG:
             print(self.full_filepath)
-            print(kwargs['data'][:2, :])
+            data = kwargs['data']
+            print(data.to_object_buff()[:2] if isinstance(data, FrameRefs) else data[:2, :])
             import pdb; pdb.set_trace()
 
 
@@ -82,12 +184,55 @@ class FrameListFitsFileObj(MotherOfFileObj):
             f'FrameListFitsFileObj::write_to_disk - Writing {str(self.full_filepath)} '
             f'({self.get_nframes()}x[{self.fits_header["PRD-RNG1"]}x{self.fits_header["PRD-RNG2"]}])'
         )
-                
-        # typ.Iterable[typ.Tuple[str, int]]
-        _data = object_buff_to_uint_buff(self.constr_data)
 
-        # We add an axis to still have the cube length as NAXIS3
-        fits.writeto(filename, _data[:, None, :], self.fits_header)
+        if type(self).WRITE_LEGACY_FORMAT:
+            # typ.Iterable[typ.Tuple[str, int]]
+            _data = self.get_frame_refs().to_uint_buff()
+
+            # We add an axis to still have the cube length as NAXIS3
+            fits.writeto(filename, _data[:, None, :], self.fits_header)
+            return
+
+        refs = self.get_frame_refs()
+        run_path_idx, run_first, run_count = refs.to_runs()
+        max_len = int(np.char.str_len(refs.paths.astype(str)).max()) if len(refs.paths) > 0 else 1
+
+        hdul = fits.HDUList([
+            # Empty data unit - but NAXIS3 still counts the frames.
+            fits.PrimaryHDU(np.zeros((refs.n_frames, 1, 0), np.uint8), self.fits_header),
+            fits.BinTableHDU.from_columns(
+                [fits.Column('PATH', f'{max_len}A', array=np.char.encode(refs.paths.astype(str), 'ascii'))],
+                name=self.PATHS_EXTNAME),
+            fits.BinTableHDU.from_columns([
+                fits.Column('PATHIDX', 'J', array=run_path_idx),
+                fits.Column('FIRST', 'K', array=run_first),
+                fits.Column('COUNT', 'K', array=run_count),
+            ], name=self.RUNS_EXTNAME),
+        ])
+        hdul.writeto(filename)
+
+    def get_frame_refs(self) -> FrameRefs:
+        '''
+            The frame references, without building the object array of self.data.
+        '''
+        if self._frame_refs is None:
+            if self.is_on_disk:
+                self._frame_refs = self._read_frame_refs()
+            elif isinstance(self.constr_data, FrameRefs):
+                self._frame_refs = self.constr_data
+            else:
+                self._frame_refs = FrameRefs.from_object_buff(np.asarray(self.constr_data))
+        return self._frame_refs
+
+    def _read_frame_refs(self) -> FrameRefs:
+        with fits.open(self.full_filepath) as hdul:
+            if self.RUNS_EXTNAME in hdul:
+                runs = hdul[self.RUNS_EXTNAME].data
+                paths = np.asarray(hdul[self.PATHS_EXTNAME].data['PATH']).astype(str)
+                return FrameRefs.from_runs(paths, np.asarray(runs['PATHIDX']), np.asarray(runs['FIRST']),
+                                           np.asarray(runs['COUNT']))
+            # Legacy: need to remove the unit second axis added when saving.
+            return FrameRefs.from_uint_buff(np.asarray(hdul[0].data)[:, 0, :])
 
     def get_nframes(self) -> int:
         # Assume logshim format... n_frames = last axis
@@ -96,12 +241,11 @@ class FrameListFitsFileObj(MotherOfFileObj):
 
     def _ensure_data_loaded(self):
         if self.data is None:
-            if self.is_on_disk:
-                # Need to remove the unit second axis added when saving.
-                _data: np.ndarray = fits.getdata(self.full_filepath, memmap=False)[:,0,:]
-                self.data = uint_buff_to_object_buff(_data)
+            if self.is_on_disk or isinstance(self.constr_data, FrameRefs):
+                # n x 2 object array of (path, frame index)
+                self.data = self.get_frame_refs().to_object_buff()
             else:
                 self.data = self.constr_data
 
-    def _merge_data_after(self, other_data):
-        return np.concatenate((self.data, other_data), axis=0)
\ No newline at end of file
+    def _merge_data_after(self, *others_data):
+        return np.concatenate((self.data, ) + others_data, axis=0)
\ No newline at end of file
@@ -0,0 +1,145 @@
+'''
+    Machine-wide registry of running compression / deinterleaving jobs
+
+    A small SQLite table: one row per target file path, with the job kind and the pid
+    that works on it. Any process (job managers, archive monitors) can check whether a file
+    is being processed with a primary key lookup, instead of parsing `ps` output.
+
+    Rows whose pid is dead are purged lazily, so a crashed manager doesn't leave
+    files locked forever.
+'''
+from __future__ import annotations
+import typing as typ
+
+import logging
+
+logg = logging.getLogger(__name__)
+
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+
+class JOBKIND:
+    FPACK = 'fpack'
+    PDIDEINT = 'pdideint'
+
+
+JOB_REGISTRY_PATH = '/tmp/.scxkw_job_registry.sqlite'
+
+
+def pid_is_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:  # Exists, not ours.
+        return True
+    return True
+
+
+class JobRegistry:
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS jobs (
+            target TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            pid INTEGER NOT NULL,
+            t_start REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS jobs_kind ON jobs (kind);
+    '''
+
+    def __init__(self, db_path: typ.Union[str, Path] = JOB_REGISTRY_PATH) -> None:
+        self.db_path = Path(db_path)
+
+        # Autocommit mode - we open explicit BEGIN IMMEDIATE transactions for check-and-set.
+        # Managers release jobs from their completion threads: serialize access with a lock.
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(str(self.db_path), timeout=30.0, isolation_level=None,
+                                    check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript(self.SCHEMA)
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def claim(self, target: typ.Union[str, Path], kind: str, pid: typ.Optional[int] = None) -> bool:
+        '''
+            Atomically register a job on <target>, unless a live job already holds it.
+
+            pid defaults to the calling process - claim before spawning, then set_pid.
+            Returns False if the target is already claimed by a live job.
+        '''
+        with self.lock:
+            target = str(target)
+            pid = os.getpid() if pid is None else pid
+
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = self.conn.execute('SELECT pid FROM jobs WHERE target = ?', (target, )).fetchone()
+                if row is not None and pid_is_alive(row[0]):
+                    self.conn.execute('ROLLBACK')
+                    return False
+                self.conn.execute('INSERT OR REPLACE INTO jobs (target, kind, pid, t_start) VALUES (?, ?, ?, ?)',
+                                  (target, kind, pid, time.time()))
+                self.conn.execute('COMMIT')
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+            return True
+
+    def set_pid(self, target: typ.Union[str, Path], pid: int) -> None:
+        with self.lock:
+            self.conn.execute('UPDATE jobs SET pid = ? WHERE target = ?', (pid, str(target)))
+
+    def release(self, target: typ.Union[str, Path]) -> None:
+        with self.lock:
+            self.conn.execute('DELETE FROM jobs WHERE target = ?', (str(target), ))
+
+    def is_running(self, target: typ.Union[str, Path]) -> bool:
+        with self.lock:
+            row = self.conn.execute('SELECT pid FROM jobs WHERE target = ?', (str(target), )).fetchone()
+            return row is not None and pid_is_alive(row[0])
+
+    def running_targets(self, kind: typ.Optional[str] = None) -> typ.Set[str]:
+        '''
+            Targets of all the live jobs (of a given kind). Purges dead entries.
+        '''
+        with self.lock:
+            if kind is None:
+                rows = self.conn.execute('SELECT target, pid FROM jobs').fetchall()
+            else:
+                rows = self.conn.execute('SELECT target, pid FROM jobs WHERE kind = ?', (kind, )).fetchall()
+
+            alive_pids: typ.Dict[int, bool] = {}
+            running: typ.Set[str] = set()
+            dead: typ.List[typ.Tuple[str, int]] = []
+            for target, pid in rows:
+                if pid not in alive_pids:
+                    alive_pids[pid] = pid_is_alive(pid)
+                if alive_pids[pid]:
+                    running.add(target)
+                else:
+                    dead.append((target, pid))
+
+            if len(dead) > 0:
+                # Only delete if still the same pid - someone may have re-claimed meanwhile.
+                self.conn.executemany('DELETE FROM jobs WHERE target = ? AND pid = ?', dead)
+
+            return running
+
+
+_REGISTRIES: typ.Dict[str, JobRegistry] = {}
+
+
+def get_job_registry(db_path: typ.Union[str, Path] = JOB_REGISTRY_PATH) -> JobRegistry:
+    '''
+        One registry connection per process.
+    '''
+    key = str(Path(db_path).absolute())
+    if key not in _REGISTRIES:
+        _REGISTRIES[key] = JobRegistry(key)
+    return _REGISTRIES[key]
@@ -5,11 +5,169 @@ logg = logging.getLogger(__name__)
 
 import typing as typ
 
+import os
 from pathlib import Path
 
 import numpy as np
 
+# Binary timing sidecar: <name>.tim.npy next to <name>.txt, a structured array.
+# Without framegrabber timings, there is no fgrab_t_us field.
+TIMING_SIDECAR_SUFFIX = '.tim.npy'
+TIMING_DTYPE = np.dtype([('cnt0', '<i8'), ('cnt1', '<i8'), ('logshim_t_us', '<f8'), ('fgrab_t_us', '<f8')])
+TIMING_DTYPE_NO_FGRAB = np.dtype([('cnt0', '<i8'), ('cnt1', '<i8'), ('logshim_t_us', '<f8')])
+
+
+def timing_sidecar_path(txt_path: typ.Union[str, Path]) -> str:
+    txt_path = str(txt_path)
+    assert txt_path.endswith('.txt')
+    return txt_path[:-4] + TIMING_SIDECAR_SUFFIX
+
+
+def load_timing_sidecar(txt_path: typ.Union[str, Path]) -> typ.Optional[np.ndarray]:
+    '''
+        Memory-map the sidecar of <txt_path> - if it exists and is not older than the txt file.
+    '''
+    sidecar = timing_sidecar_path(txt_path)
+    try:
+        if os.stat(sidecar).st_mtime_ns < os.stat(txt_path).st_mtime_ns:
+            return None  # The txt was rewritten by someone else.
+        table = np.load(sidecar, mmap_mode='r')
+    except (FileNotFoundError, ValueError) as exc:
+        if isinstance(exc, ValueError):
+            logg.warning(f'load_timing_sidecar: unreadable {sidecar} - {exc}')
+        return None
+    if table.dtype not in (TIMING_DTYPE, TIMING_DTYPE_NO_FGRAB) or table.ndim != 1:
+        logg.warning(f'load_timing_sidecar: unexpected layout in {sidecar}')
+        return None
+    return table
+
+
+def write_timing_sidecar(txt_path: typ.Union[str, Path], parser: LogshimTxtParser) -> None:
+    '''
+        Atomic write, to be done after the txt file (see load_timing_sidecar).
+    '''
+    dtype = TIMING_DTYPE if parser.has_fgrab_timing else TIMING_DTYPE_NO_FGRAB
+    table = np.empty(len(parser.logshim_t_us), dtype)
+    table['cnt0'] = parser.cnt0
+    table['cnt1'] = parser.cnt1
+    table['logshim_t_us'] = parser.logshim_t_us
+    if parser.has_fgrab_timing:
+        table['fgrab_t_us'] = parser.fgrab_t_us
+
+    sidecar = timing_sidecar_path(txt_path)
+    tmp_name = sidecar + '.tmp.npy'
+    np.save(tmp_name, table)
+    os.replace(tmp_name, sidecar)
+
+_POW10 = 10**np.arange(1, 19, dtype=np.int64)
+
+
+def _digit_rows(values: np.ndarray, n_digits: int) -> np.ndarray:
+    '''
+        (n_digits, n) ASCII digits of non-negative ints, zero-padded.
+    '''
+    # 32 bit divisions when we can: several times faster.
+    dtype = np.uint32 if len(values) == 0 or values.max() < 2**32 else np.uint64
+    ten = dtype(10)
+    rest = values.astype(dtype)
+    digits = np.empty((n_digits, len(values)), np.uint8)
+    for jj in range(n_digits - 1, -1, -1):
+        quotient = rest // ten
+        np.subtract(rest, quotient * ten, out=digits[jj], casting='unsafe')
+        rest = quotient
+    digits += ord('0')
+    return digits
+
+
+def _format_fixed_width(values: np.ndarray, width: int, precision: typ.Optional[int],
+                        out: np.ndarray) -> bool:
+    '''
+        Render '%{width}d' % v (precision None) or '%{width}.{precision}f' % v for all values
+        into out, a (width, n) uint8 array: one row per character position - contiguous rows
+        are much faster to fill than the columns of an (n, width) array.
+
+        Returns False if some value doesn't fit in width (or isn't finite).
+    '''
+    if not np.all(np.isfinite(values)) or np.any(np.abs(values) >= 9e18):
+        return False
+
+    if precision is None:
+        int_part = np.trunc(values).astype(np.int64)  # '%d' % float truncates
+        negative = int_part < 0
+        int_part = np.abs(int_part)
+    else:
+        negative = np.signbit(values)  # '-0.000' for small negatives, like %
+        abs_values = np.abs(values)
+        int_part_f = np.floor(abs_values)
+        scaled = (abs_values - int_part_f) * 10.0**precision  # The subtraction is exact.
+        frac_part_f = np.rint(scaled)  # Half to even, as % - ties are re-done below anyway.
+        carry = frac_part_f >= 10.0**precision
+        int_part = (int_part_f + carry).astype(np.int64)
+        frac_part = np.where(carry, 0.0, frac_part_f).astype(np.int64)
+
+    n_int_digits = 1 + np.searchsorted(_POW10, int_part, side='right')
+    frac_len = 0 if precision is None else precision + 1
+    if np.any(n_int_digits + negative + frac_len > width):
+        return False
+
+    int_end = width - frac_len
+    if precision is not None:
+        out[int_end] = ord('.')
+        out[int_end + 1:] = _digit_rows(frac_part, precision)
+
+    max_digits = int(n_int_digits.max())
+    out[:int_end - max_digits] = ord(' ')
+    out[int_end - max_digits:int_end] = _digit_rows(int_part, max_digits)
+    n_blanks = max_digits - n_int_digits
+    for jj in range(max_digits - 1):  # Leading zeros
+        np.copyto(out[int_end - max_digits + jj], ord(' '), where=n_blanks > jj)
+    cols = np.flatnonzero(negative)
+    out[int_end - n_int_digits[cols] - 1, cols] = ord('-')
+
+    if precision is not None:
+        # Within float error of a rounding tie: let % decide.
+        for ii in np.flatnonzero(np.abs(scaled - np.floor(scaled) - 0.5) < 1e-6):
+            text = ('%*.*f' % (width, precision, values[ii])).encode('ascii')
+            if len(text) != width:
+                return False
+            out[:, ii] = np.frombuffer(text, np.uint8)
+
+    return True
+
+
+def backfill_timing_sidecar(txt_path: typ.Union[str, Path], force: bool = False) -> bool:
+    '''
+        Write the sidecar of an existing txt file, unless already up to date (or <force>).
+
+        Returns True if written.
+    '''
+    if not force and load_timing_sidecar(txt_path) is not None:
+        return False
+
+    parser = LogshimTxtParser(Path(txt_path).absolute())
+    parser._sidecar_checked = True  # Parse the txt, whatever sidecar there is.
+    if len(parser.logshim_t_us) != parser.n_lines:
+        # Malformed lines: the txt stays the only source, so file objects judge it as before.
+        logg.warning(f'backfill_timing_sidecar: malformed lines in {txt_path} - skipped.')
+        return False
+
+    write_timing_sidecar(txt_path, parser)
+    return True
+
+
 class LogshimTxtParser:
+    '''
+        The timing arrays are authoritative - text lines are only generated to write the file.
+
+        The file is only parsed on first access to the arrays (see _LAZY_ATTRIBUTES),
+        in one vectorized pass. n_lines and time_bounds_us() don't need the full parse.
+        If an up-to-date .tim.npy sidecar exists, the arrays are memory-mapped from it instead.
+    '''
+
+    _LAZY_ATTRIBUTES = ('header', 'has_fgrab_timing', 'logshim_t_us', 'fgrab_t_us', 'cnt0', 'cnt1')
+
+    # Write the .tim.npy sidecar along with the txt file.
+    WRITE_SIDECAR = True
 
     def __init__(self, filename_txt: typ.Union[str, Path]) -> None:
         '''
@@ -24,95 +182,303 @@ class LogshimTxtParser:
             raise AssertionError(message)
 
         self.name: str = str(path)
+        # Where the lazy loads read from - self.name is also the write target, and may change.
+        self._source_name: typ.Optional[str] = self.name
+        self._n_lines: typ.Optional[int] = None
+        self._sidecar_checked = False
+        self._sidecar_table: typ.Optional[np.ndarray] = None
+
+    def _sidecar(self) -> typ.Optional[np.ndarray]:
+        if not self._sidecar_checked and self._source_name is not None:
+            self._sidecar_table = load_timing_sidecar(self._source_name)
+            self._sidecar_checked = True
+        return self._sidecar_table
+
+    def __getattr__(self, attr: str):
+        # Only called when attr isn't set yet - i.e. the file hasn't been parsed.
+        if attr in LogshimTxtParser._LAZY_ATTRIBUTES:
+            self._load()
+            return self.__dict__[attr]
+        raise AttributeError(attr)
+
+    def _read_raw(self) -> typ.Tuple[typ.List[str], bytes]:
+        '''
+            Returns (header lines, data bytes)
+        '''
+        assert self._source_name is not None
+        with open(self._source_name, 'rb') as f:
+            raw = f.read()
+
+        pos = 0
+        while raw.startswith(b'#', pos):
+            eol = raw.find(b'\n', pos)
+            pos = len(raw) if eol < 0 else eol + 1
+        header = [l.strip() for l in raw[:pos].decode('ascii').splitlines()]
+        data = raw[pos:]
+
+        if b'\n#' in data:  # Comments past the top - never seen, but stay correct.
+            lines = data.split(b'\n')
+            header += [l.decode('ascii').strip() for l in lines if l.startswith(b'#')]
+            data = b'\n'.join(l for l in lines if not l.startswith(b'#'))
+
+        return header, data
+
+    @staticmethod
+    def _count_lines(data: bytes) -> int:
+        return data.count(b'\n') + (1 if len(data) > 0 and not data.endswith(b'\n') else 0)
+
+    @property
+    def n_lines(self) -> int:
+        '''
+            Number of data lines in the file, well-formed or not.
+        '''
+        if self._n_lines is None:
+            if 'fgrab_t_us' in self.__dict__:
+                self._n_lines = len(self.fgrab_t_us)
+            elif self._sidecar() is not None:
+                self._n_lines = len(self._sidecar())
+            else:
+                _, data = self._read_raw()
+                self._n_lines = self._count_lines(data)
+        return self._n_lines
+
+    def _read_header_lines(self) -> typ.List[str]:
+        assert self._source_name is not None
+        header: typ.List[str] = []
+        with open(self._source_name, 'r') as f:
+            for line in f:
+                if not line.startswith('#'):
+                    break
+                header.append(line.strip())
+        return header
+
+    def _load(self) -> None:
+        table = self._sidecar()
+        if table is not None:
+            self._n_lines = len(table)
+            self._set_arrays_from_sidecar(self._read_header_lines(), table)
+            return
+
+        header, data = self._read_raw()
+        self._n_lines = self._count_lines(data)
+
+        n_cols = len(data[:data.find(b'\n')].split()) if len(data) > 0 else 0
+        try:
+            values = np.fromstring(data, dtype=np.float64, sep=' ')
+        except ValueError:  # Unparsable tokens
+            values = None
+
+        if n_cols == 0:
+            values = np.zeros((0, 7), np.float64)
+        elif values is not None and values.size == self._n_lines * n_cols:
+            values = values.reshape(self._n_lines, n_cols)
+        else:
+            # The txt writer probably messed up halfway. Line by line, tossing the bad ones.
+            logg.warning('LogshimTxtParser::_load: it seems that the file has missing data.')
+            splits = [l.split() for l in data.decode('ascii').splitlines()]
+            values = np.asarray([[float(v) for v in s] for s in splits if len(s) == n_cols],
+                                dtype=np.float64).reshape(-1, n_cols)
 
-        with open(filename_txt, 'r') as f:
-            raw_lines = f.readlines()
-        
-        self.header = [l.strip() for l in raw_lines if l[0] == '#']
-        self.lines = [l.strip() for l in raw_lines if not l[0] == '#']
+        self._set_arrays_from_values(header, values)
 
-        self._init_arrays_from_lines()
+    def _set_arrays_from_values(self, header: typ.List[str], values: np.ndarray) -> None:
+        # setdefault: arrays assigned before the load stay authoritative.
+        self.__dict__.setdefault('header', header)
 
-    def clone_instance(self) -> LogshimTxtParser:
-        '''
-            This is really an alternative constructor.
-            We create a bare instance without calling __init__()
-        '''
-        cls = type(self) # Important if this gets subclassed
-        other = cls.__new__(cls)
+        has_fgrab_timing = values.shape[1] != 6
+        self.__dict__.setdefault('has_fgrab_timing', has_fgrab_timing)
 
-        assert self.name.endswith('.txt')
-        other.name = self.name
+        logshim_t_us = values[:, 3] * 1e6
+        self.__dict__.setdefault('logshim_t_us', logshim_t_us)
+        if has_fgrab_timing:
+            self.__dict__.setdefault('fgrab_t_us', values[:, 4] * 1e6)
+        else:
+            logg.warning('LogshimTxtParser::_load: no fgrab timings, only logshim.')
+            self.__dict__.setdefault('fgrab_t_us', logshim_t_us)
 
-        other.header = self.header.copy()
-        other.lines = self.lines.copy()
+        self.__dict__.setdefault('cnt0', values[:, -2].copy())
+        self.__dict__.setdefault('cnt1', values[:, -1].copy())
 
-        other._init_arrays_from_lines()
+    def _set_arrays_from_sidecar(self, header: typ.List[str], table: np.ndarray) -> None:
+        # Field views into the memory map - nothing is read until used.
+        self.__dict__.setdefault('header', header)
 
-        return other
+        has_fgrab_timing = 'fgrab_t_us' in table.dtype.names
+        self.__dict__.setdefault('has_fgrab_timing', has_fgrab_timing)
 
-    def sub_parser_by_selection(self, subname:str, selection: np.ndarray) -> LogshimTxtParser:
+        self.__dict__.setdefault('logshim_t_us', table['logshim_t_us'])
+        self.__dict__.setdefault('fgrab_t_us', table['fgrab_t_us'] if has_fgrab_timing else table['logshim_t_us'])
+        self.__dict__.setdefault('cnt0', table['cnt0'])
+        self.__dict__.setdefault('cnt1', table['cnt1'])
+
+    def time_bounds_us(self) -> typ.Tuple[typ.Optional[float], typ.Optional[float]]:
         '''
-            This is really an alternative constructor.
-            We create a bare instance without calling __init__()
+            (first, last) framegrabber times - without parsing the whole file if not loaded yet.
+        '''
+        if 'fgrab_t_us' in self.__dict__:
+            if len(self.fgrab_t_us) == 0:
+                return None, None
+            return float(self.fgrab_t_us[0]), float(self.fgrab_t_us[-1])
+
+        table = self._sidecar()
+        if table is not None:
+            if len(table) == 0:
+                return None, None
+            field = 'fgrab_t_us' if 'fgrab_t_us' in table.dtype.names else 'logshim_t_us'
+            return float(table[field][0]), float(table[field][-1])
+
+        assert self._source_name is not None
+        with open(self._source_name, 'rb') as f:
+            first: typ.List[bytes] = []
+            for line in f:
+                if not line.startswith(b'#') and len(line.split()) > 0:
+                    first = line.split()
+                    break
+            if len(first) == 0:
+                return None, None
+
+            # Truncated last line(s) are tossed, as in _load - read further back until a complete one.
+            f.seek(0, 2)
+            size = f.tell()
+            last: typ.List[bytes] = []
+            window = 4096
+            while len(last) == 0 and window <= 1024**2:
+                f.seek(max(0, size - window))
+                lines = f.read().splitlines()
+                if size > window:
+                    lines = lines[1:]  # Most likely a partial line
+                complete = [l.split() for l in lines
+                            if not l.startswith(b'#') and len(l.split()) == len(first)]
+                if len(complete) > 0:
+                    last = complete[-1]
+                elif size <= window:
+                    break
+                window *= 4
+
+        if len(last) == 0:
+            # Give up and parse it all.
+            self._load()
+            return self.time_bounds_us()
+
+        col = 4 if len(first) != 6 else 3
+        return float(first[col]) * 1e6, float(last[col]) * 1e6
+
+    @property
+    def logshim_dt_us(self) -> np.ndarray:
+        return self.logshim_t_us[1:] - self.logshim_t_us[:-1]
+
+    @property
+    def fgrab_dt_us(self) -> np.ndarray:
+        return self.fgrab_t_us[1:] - self.fgrab_t_us[:-1]
+
+    def follow_file_move(self, new_name: str) -> None:
+        '''
+            The txt file itself was moved: read (if not loaded yet) and write at the new place.
+        '''
+        self.name = new_name
+        if self._source_name is not None:
+            self._source_name = new_name
+
+    def _bare_instance(self, name: str, header: typ.List[str], **arrays: np.ndarray) -> LogshimTxtParser:
+        '''
+            Create a bare instance without calling __init__()
         '''
         cls = type(self) # Important if this gets subclassed
         other = cls.__new__(cls)
 
-        assert self.name.endswith('.txt')
-        other.name = self.name[:-4] + '.' + subname + '.txt'
-
-        other.header = self.header
-        other.lines = [l for k, l in enumerate(self.lines) if selection[k]]
-
-        other._init_arrays_from_lines()
+        other.name = name
+        other._source_name = None
+        other._sidecar_checked = True
+        other._sidecar_table = None
+        other.header = header
+        other.has_fgrab_timing = self.has_fgrab_timing
+        for key, arr in arrays.items():
+            setattr(other, key, arr)
+        other._n_lines = len(other.fgrab_t_us)
 
         return other
 
-    def _regenerate_lines_from_arrays(self):
-        n_frames = len(self.fgrab_t_us)
-
-        lines: typ.List[str] = []
-
-        for ii in range(n_frames):
-            lines += ['%10ld  %10lu  %15.9lf   %20.9lf  %17.6lf   %10ld   %10ld' %
-                      (ii, self.cnt0[ii], (self.logshim_t_us[ii] - self.logshim_t_us[0]) / 1e6, self.logshim_t_us[ii] / 1e6,
-                       self.fgrab_t_us[ii] / 1e6, self.cnt0[ii], self.cnt1[ii])]
-            
-        self.lines = lines
-
-
-    def _init_arrays_from_lines(self):
-
-        self.has_fgrab_timing = True
-
-        if len(self.lines) == 0: # Empty file case.
-            values = np.zeros((0,7), np.float64)
-        else:
-            splits = [[float(v) for v in l.split()] for l in self.lines]
-            if len(splits[-1]) != len(splits[0]):
-                # The txt writer probably messed up halfway.
-                # We toss the end
-                logg.warning('LogshimTxtParser::_init_arrays: it seems that the file has missing data.')
-
-            values = np.asarray([s for s in splits if len(s) == len(splits[0])])
-            
-            if values.shape[1] == 6:
-                self.has_fgrab_timing = False
-
-        self.logshim_t_us = values[:, 3] * 1e6
-        if self.has_fgrab_timing:
-            self.fgrab_t_us = values[:, 4] * 1e6
-        else:
-            logg.warning('LogshimTxtParser::_init_arrays: no fgrab timings, only logshim.')
-            self.fgrab_t_us = self.logshim_t_us
+    def clone_instance(self) -> LogshimTxtParser:
+        '''
+            This is really an alternative constructor.
+        '''
+        assert self.name.endswith('.txt')
+        return self._bare_instance(self.name, self.header.copy(),
+                                   logshim_t_us=self.logshim_t_us.copy(),
+                                   fgrab_t_us=self.fgrab_t_us.copy(),
+                                   cnt0=self.cnt0.copy(),
+                                   cnt1=self.cnt1.copy())
 
-        self.logshim_dt_us = self.logshim_t_us[1:] - self.logshim_t_us[:-1]
-        self.fgrab_dt_us = self.fgrab_t_us[1:] - self.fgrab_t_us[:-1]
+    def concatenated_with(self, *others: LogshimTxtParser) -> LogshimTxtParser:
+        '''
+            This is really an alternative constructor: self's frames then the others'.
+        '''
+        assert self.name.endswith('.txt')
+        parsers = (self, ) + others
+        return self._bare_instance(self.name, self.header.copy(),
+                                   logshim_t_us=np.concatenate([p.logshim_t_us for p in parsers]),
+                                   fgrab_t_us=np.concatenate([p.fgrab_t_us for p in parsers]),
+                                   cnt0=np.concatenate([p.cnt0 for p in parsers]),
+                                   cnt1=np.concatenate([p.cnt1 for p in parsers]))
 
-        self.cnt0 = values[:, -2]
-        self.cnt1 = values[:, -1]
+    def sub_parser_by_selection(self, subname:str, selection: np.ndarray) -> LogshimTxtParser:
+        '''
+            This is really an alternative constructor.
+        '''
+        assert self.name.endswith('.txt')
+        return self._bare_instance(self.name[:-4] + '.' + subname + '.txt', self.header,
+                                   logshim_t_us=self.logshim_t_us[selection],
+                                   fgrab_t_us=self.fgrab_t_us[selection],
+                                   cnt0=self.cnt0[selection],
+                                   cnt1=self.cnt1[selection])
+
+    @property
+    def lines(self) -> typ.List[str]:
+        return self._regenerate_lines_from_arrays()
+
+    LINE_FORMAT = '%10ld  %10lu  %15.9lf   %20.9lf  %17.6lf   %10ld   %10ld\n'
+    # Same thing, as (separator before, width, precision | None for ints)
+    LINE_FIELDS = (('', 10, None), ('  ', 10, None), ('  ', 15, 9), ('   ', 20, 9),
+                   ('  ', 17, 6), ('   ', 10, None), ('   ', 10, None))
+
+    def _format_data_block(self) -> bytes:
+        '''
+            All the data lines as ASCII bytes, byte-identical to LINE_FORMAT % (...) line by line.
 
+            Fields are rendered into a fixed-width byte matrix with integer arithmetic;
+            if any field overflows its width, we fall back to a single % over the whole block.
+        '''
+        n_frames = len(self.fgrab_t_us)
+        if n_frames == 0:
+            return b''
+
+        columns = (
+            np.arange(n_frames, dtype=np.float64),
+            self.cnt0,
+            (self.logshim_t_us - self.logshim_t_us[0]) / 1e6,
+            self.logshim_t_us / 1e6,
+            self.fgrab_t_us / 1e6,
+            self.cnt0,
+            self.cnt1,
+        )
+
+        line_len = sum(len(sep) + width for sep, width, _ in self.LINE_FIELDS) + 1
+        block = np.empty((line_len, n_frames), np.uint8)  # Transposed - see _format_fixed_width
+        pos = 0
+        for (sep, width, precision), column in zip(self.LINE_FIELDS, columns):
+            block[pos:pos + len(sep)] = ord(' ')
+            pos += len(sep)
+            if not _format_fixed_width(np.asarray(column, np.float64), width, precision,
+                                       block[pos:pos + width]):
+                return ((self.LINE_FORMAT * n_frames) %
+                        tuple(np.column_stack(columns).ravel().tolist())).encode('ascii')
+            pos += width
+        block[pos] = ord('\n')
+
+        return np.ascontiguousarray(block.T).tobytes()
+
+    def _regenerate_lines_from_arrays(self) -> typ.List[str]:
+        return self._format_data_block().decode('ascii').splitlines()
 
     def print_stats(self):
         print(f'Parsing {self.name}')
@@ -133,17 +499,10 @@ class LogshimTxtParser:
 
     def write_to_disk(self):
 
-        self._regenerate_lines_from_arrays()
-        
-        with open(self.name, 'w') as file:
-            for line in self.header:
-                file.write(line + '\n')
-
-            for kk, line in enumerate(self.lines):
-                file.write(line + '\n')
-
-            
-
-
+        header = ''.join(line + '\n' for line in self.header).encode('ascii')
 
+        with open(self.name, 'wb') as file:
+            file.write(header + self._format_data_block())
 
+        if self.WRITE_SIDECAR:
+            write_timing_sidecar(self.name, self)
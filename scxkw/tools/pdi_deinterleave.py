@@ -12,6 +12,7 @@ from astropy.io import fits
 from enum import IntEnum
 
 from .logshim_txt_parser import LogshimTxtParser
+from .job_registry import JOBKIND, JobRegistry, get_job_registry
 
 if typ.TYPE_CHECKING:
     from .file_obj import MotherOfFileObj as MFFO
@@ -56,24 +57,16 @@ class SyncPDIDeintManager:
 class AsyncPDIDeintJobManager:
     MAX_CONCURRENT_JOBS = 15
 
-    def __init__(self) -> None:
+    def __init__(self, registry: typ.Optional[JobRegistry] = None) -> None:
         self.pending_jobs: typ.Dict[str, sproc.Popen] = {}
 
-        # Now check for active fpack jobs that this manager didn't launch.
-        running_pdi_str = sproc.run(
-            'ps -eo args | egrep ^scxkw-pdideint', shell=True,
-            capture_output=True).stdout.decode('utf8').strip()
-        if running_pdi_str == '':
-            running_pdi = []
-        else:
-            running_pdi = running_pdi_str.split('\n')
+        # Shared with other managers / monitors, possibly in other processes.
+        self.registry = get_job_registry() if registry is None else registry
 
+        running_pdi = self.registry.running_targets(JOBKIND.PDIDEINT)
         if len(running_pdi) > 0:
-            logg.error('PDIDeintJobManager::__init__ - Running PDI deint jobs:')
-            logg.error(str(running_pdi))
-            raise AssertionError(
-                'There are running scxkw-pdideinterleave jobs on the system. '
-                'It is bad juju to instantiate a PDIDeintJobManager now.')
+            logg.warning(f'PDIDeintJobManager::__init__ - {len(running_pdi)} deint jobs '
+                         'from other managers are running - will not touch their files.')
 
     def run_pdi_deint_job(self, file_obj: MFFO, new_stream_name: str) -> PDIJobCodeEnum:
         if not file_obj.check_existence_on_disk():
@@ -85,8 +78,16 @@ class AsyncPDIDeintJobManager:
             return PDIJobCodeEnum.TOOMANY
         if str(file_obj.full_filepath) in self.pending_jobs:
             return PDIJobCodeEnum.ALREADY_RUNNING
+        if not self.registry.claim(file_obj.full_filepath, JOBKIND.PDIDEINT):
+            return PDIJobCodeEnum.ALREADY_RUNNING
 
-        proc = deinterleave_start_job_async(str(file_obj.full_filepath), new_stream_name, keep_original=False)
+        try:
+            proc = deinterleave_start_job_async(str(file_obj.full_filepath), new_stream_name, keep_original=False)
+            self.registry.set_pid(file_obj.full_filepath, proc.pid)
+        except Exception:
+            # Don't leave the file locked under our (live) pid.
+            self.registry.release(file_obj.full_filepath)
+            raise
 
         self.pending_jobs[str(file_obj.full_filepath)] = proc
 
@@ -94,12 +95,22 @@ class AsyncPDIDeintJobManager:
 
     def refresh_running_jobs(self) -> None:
         # job.poll() is None if process is still running.
+        for filename in self.pending_jobs:
+            if self.pending_jobs[filename].poll() is not None:
+                self.registry.release(filename)
         self.pending_jobs = {
             filename: self.pending_jobs[filename]
             for filename in self.pending_jobs
             if self.pending_jobs[filename].poll() is None
         }
 
+    def running_targets(self) -> typ.Set[str]:
+        '''
+            Full paths of the files currently being deinterleaved - by any manager.
+        '''
+        self.refresh_running_jobs()
+        return self.registry.running_targets(JOBKIND.PDIDEINT)
+
 def deinterleave_filechecker(file_list: typ.List[MFFO]) -> typ.List[bool]:
     '''
         return False for files that need NOT to be deinterleaved
@@ -0,0 +1,109 @@
+from __future__ import annotations
+import typing as typ
+
+import logging
+
+logg = logging.getLogger(__name__)
+
+import time
+from concurrent import futures
+
+
+class TransferItem(typ.NamedTuple):
+    name: str  # For logging
+    n_bytes: int  # For accounting
+    payload: typ.Any  # Whatever send_func needs
+
+
+class TransferScheduler:
+    '''
+        A bounded worker pool for transfer requests: at most <n_workers> requests in flight.
+
+        send_func(item) must block until the request is completed,
+        and raise on failure. It is called from worker threads.
+        keep_going() is checked before every new submission (e.g. time window).
+        on_done(item) is called in the calling thread for every successful item.
+
+        There is no pacing or throughput estimate: Gen2 acknowledges archive requests before
+        the data moves, so request completions say nothing about the link.
+    '''
+
+    def __init__(self,
+                 send_func: typ.Callable[[TransferItem], typ.Any],
+                 *,
+                 n_workers: int = 4,
+                 keep_going: typ.Optional[typ.Callable[[], bool]] = None,
+                 on_done: typ.Optional[typ.Callable[[TransferItem], None]] = None) -> None:
+
+        assert n_workers >= 1
+
+        self.send_func = send_func
+        self.n_workers = n_workers
+        self.keep_going = keep_going
+        self.on_done = on_done
+
+        self.n_bytes_done = 0
+        self.n_items_done = 0
+        self.n_items_failed = 0
+
+    def run(self, items: typ.Iterable[TransferItem]) -> int:
+        '''
+            Submit all items, keeping at most self.n_workers in flight.
+
+            Returns the number of successfully completed items.
+            Failed items and items not submitted because keep_going() turned
+            False are simply not reported to on_done - retry them next time.
+        '''
+        item_iter = iter(items)
+        in_flight: typ.Dict[futures.Future, TransferItem] = {}
+        exhausted = False
+
+        t_run_start = time.time()
+        n_done_before = self.n_items_done
+        bytes_before = self.n_bytes_done
+
+        with futures.ThreadPoolExecutor(max_workers=self.n_workers) as executor:
+            while True:
+                # Refill the pool.
+                while not exhausted and len(in_flight) < self.n_workers:
+                    if self.keep_going is not None and not self.keep_going():
+                        logg.warning('TransferScheduler::run - stopping submissions (keep_going is False).')
+                        exhausted = True
+                        break
+                    try:
+                        item = next(item_iter)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    in_flight[executor.submit(self.send_func, item)] = item
+
+                if len(in_flight) == 0:
+                    break
+
+                done, _ = futures.wait(in_flight, return_when=futures.FIRST_COMPLETED)
+                for fut in done:
+                    item = in_flight.pop(fut)
+                    self._complete(item, fut)
+
+        elapsed = time.time() - t_run_start
+        n_done = self.n_items_done - n_done_before
+        mbytes = (self.n_bytes_done - bytes_before) / 1024**2
+        logg.warning(f'TransferScheduler::run - {n_done} items ({mbytes:.1f} MB) requested in {elapsed:.1f} s, '
+                     f'{self.n_items_failed} failed so far.')
+
+        return n_done
+
+    def _complete(self, item: TransferItem, fut: futures.Future) -> None:
+        exc = fut.exception()
+        if exc is not None:
+            self.n_items_failed += 1
+            logg.error(f'TransferScheduler::_complete - {item.name} failed ({exc}).')
+            return
+
+        logg.info(f'TransferScheduler::_complete - {item.name} ({item.n_bytes / 1024**2:.1f} MB).')
+
+        self.n_items_done += 1
+        self.n_bytes_done += item.n_bytes
+
+        if self.on_done is not None:
+            self.on_done(item)
@@ -0,0 +1,520 @@
+'''
+    Plan / execute VAMPIRES synchronization
+
+    VampiresSynchronizer syncs online, one pair of files at a time: remainders are written back
+    to disk and re-queued, and the outputs are renamed, moved and header-edited a few times over.
+
+    For a batch of files (e.g. a night), plan_vampires_sync assigns every frame of the vcam1 / vcam2
+    files to a vsync / vsolo1 / vsolo2 / vbad output from the headers and timing arrays only - no
+    frame data is read. The SyncPlan is plain JSON: it can be saved, inspected, and executed later.
+
+    execute_sync_plan then writes each output once - a FITS cube, or a .fitsframes list referencing
+    the input frames. Files that go out whole (bad files, trivial solo files) are moved - or, for
+    .fitsframes outputs, listed whole while the vcam FITS files stay put, as scxkw-vamp-syncdeint did.
+'''
+from __future__ import annotations
+import typing as typ
+
+import logging
+
+logg = logging.getLogger(__name__)
+
+import json
+import os
+from datetime import datetime, timezone
+from pathlib import Path
+
+import numpy as np
+
+from . import file_tools
+from .file_obj import MotherOfFileObj as MFFO
+from .fits_file_obj import FitsFileObj, FitsFzFileObj
+from .fix_header import fix_header_times
+from .frame_source import FrameSource
+from .framelist_file_obj import FrameListFitsFileObj, FrameRefs
+from .logshim_txt_parser import LogshimTxtParser, timing_sidecar_path
+from .vampires_synchro import (OUTPUT_MAX_GAP_SEC, OUTPUT_MAX_SPAN_SEC, OUTPUT_SPLIT_KEYS, STR_VBAD,
+                               STR_VCAM1, STR_VCAM2, STR_VSYNC, STRFMT_VSOLO, U_SYNC_KEY,
+                               VAMPIRES_USEC_TOLERANCING, find_sync_tol_for_vamp, is_bad_vamp_file,
+                               is_trivial_solo_vamp_file, sync_timing_arrays)
+
+PLAN_VERSION = 1
+
+
+class PLAN_ACTION:
+    MOVE = 'move'  # The whole input file, as is
+    WRITE = 'write'  # A new file, from runs of input frames
+
+
+class PlannedOutput(typ.NamedTuple):
+    stream: str  # vsync, vsolo1, vsolo2, vbad
+    name: str  # File name in <date folder>/<stream>/ - as a .fits
+    action: str  # PLAN_ACTION
+    runs: typ.List[typ.Tuple[int, int, int]]  # (input index, first frame, n frames), in order
+    u_sync: typ.Optional[bool]  # U_SYNC header value - None: leave it alone
+    sync_partner: typ.Optional[int]  # vsync: output index of the other camera, timings are averaged
+
+    @property
+    def n_frames(self) -> int:
+        return sum(count for _, _, count in self.runs)
+
+
+class SyncPlan(typ.NamedTuple):
+    folder: str  # The <date> folder
+    inputs: typ.List[typ.Tuple[str, int]]  # (path, n frames)
+    outputs: typ.List[PlannedOutput]
+    tolerance_us: typ.Optional[int]  # None if automatic (per overlapping group)
+
+    def to_json(self, path: typ.Union[str, Path]) -> None:
+        with open(path, 'w') as file:
+            json.dump({
+                'version': PLAN_VERSION,
+                'folder': self.folder,
+                'inputs': [list(inp) for inp in self.inputs],
+                'outputs': [out._asdict() for out in self.outputs],
+                'tolerance_us': self.tolerance_us,
+            }, file, indent=1)
+
+    @classmethod
+    def from_json(cls, path: typ.Union[str, Path]) -> SyncPlan:
+        with open(path, 'r') as file:
+            content = json.load(file)
+        if content.get('version') != PLAN_VERSION:
+            message = f'SyncPlan::from_json: plan version {content.get("version")} - expected {PLAN_VERSION} - {path}'
+            logg.critical(message)
+            raise AssertionError(message)
+        outputs = [
+            PlannedOutput(**{**out, 'runs': [tuple(run) for run in out['runs']]})
+            for out in content['outputs']
+        ]
+        return cls(content['folder'], [tuple(inp) for inp in content['inputs']], outputs,
+                   content['tolerance_us'])
+
+    def summary(self) -> typ.Dict[str, typ.Tuple[int, int]]:
+        '''
+            {stream: (n files, n frames)}
+        '''
+        out: typ.Dict[str, typ.Tuple[int, int]] = {}
+        for output in self.outputs:
+            n_files, n_frames = out.get(output.stream, (0, 0))
+            out[output.stream] = (n_files + 1, n_frames + output.n_frames)
+        return out
+
+
+def _tstr(t_unix: float) -> str:
+    # What fix_header_times returns for that start time - output names.
+    return datetime.fromtimestamp(t_unix).astimezone(timezone.utc).strftime('%H:%M:%S.%f')
+
+
+def _to_runs(input_idx: np.ndarray, frame_idx: np.ndarray) -> typ.List[typ.Tuple[int, int, int]]:
+    if len(input_idx) == 0:
+        return []
+    breaks = np.flatnonzero((np.diff(input_idx) != 0) | (np.diff(frame_idx) != 1)) + 1
+    starts = np.r_[0, breaks]
+    counts = np.diff(np.r_[starts, len(input_idx)])
+    return [(int(input_idx[s]), int(frame_idx[s]), int(c)) for s, c in zip(starts, counts)]
+
+
+def _cam_index(fobj: MFFO) -> int:
+    if fobj.stream_from_foldername == STR_VCAM1:
+        return 1
+    if fobj.stream_from_foldername == STR_VCAM2:
+        return 2
+    message = f'plan_vampires_sync: invalid stream {fobj.stream_from_foldername} - {fobj.full_filepath}'
+    logg.critical(message)
+    raise ValueError(message)
+
+
+def _move_output(kk: int, fobj: MFFO, stream: str, u_sync: typ.Optional[bool]) -> PlannedOutput:
+    return PlannedOutput(stream, fobj.file_name, PLAN_ACTION.MOVE, [(kk, 0, fobj.get_nframes())], u_sync, None)
+
+
+def _overlap_groups(indices: typ.List[int], starts: typ.List[float],
+                    finishes: typ.List[float]) -> typ.List[typ.List[int]]:
+    '''
+        Files (sorted by start) chained by temporal overlap, across both cameras.
+    '''
+    groups: typ.List[typ.List[int]] = []
+    max_finish = -np.inf
+    for kk in indices:
+        if len(groups) == 0 or starts[kk] > max_finish:
+            groups.append([])
+            max_finish = -np.inf
+        groups[-1].append(kk)
+        max_finish = max(max_finish, finishes[kk])
+    return groups
+
+
+def _cut_output_spans(t_us: np.ndarray, codes: np.ndarray,
+                      exptime_s: np.ndarray) -> typ.List[typ.Tuple[int, int]]:
+    '''
+        [start, stop) of the output files of a sequence of frames: cut where the split keys change,
+        at gaps, and every OUTPUT_MAX_SPAN_SEC (from the first frame of the file).
+    '''
+    n_frames = len(t_us)
+    new_file = np.zeros(n_frames, bool)
+    new_file[0] = True
+    new_file[1:] |= codes[1:] != codes[:-1]
+    new_file[1:] |= (t_us[1:] / 1e6 - exptime_s[1:]) - t_us[:-1] / 1e6 > OUTPUT_MAX_GAP_SEC
+
+    starts = np.flatnonzero(new_file)
+    spans: typ.List[typ.Tuple[int, int]] = []
+    for start, end in zip(starts, np.r_[starts[1:], n_frames]):
+        while start < end:
+            n_in = np.searchsorted(t_us[start:end], t_us[start] + OUTPUT_MAX_SPAN_SEC * 1e6, 'left')
+            stop = start + max(1, int(n_in))
+            spans.append((int(start), stop))
+            start = stop
+    return spans
+
+
+class _Frames(typ.NamedTuple):
+    t_us: np.ndarray  # Pairs of synced frames: averaged timings
+    input_idx: typ.Dict[int, np.ndarray]  # {cam: ...}
+    frame_idx: typ.Dict[int, np.ndarray]
+
+    @classmethod
+    def concatenate(cls, frames: typ.List[_Frames]) -> _Frames:
+        cams = frames[0].input_idx.keys()
+        return cls(np.concatenate([fr.t_us for fr in frames]),
+                   {cam: np.concatenate([fr.input_idx[cam] for fr in frames]) for cam in cams},
+                   {cam: np.concatenate([fr.frame_idx[cam] for fr in frames]) for cam in cams})
+
+
+def _split_codes(fobjs: typ.List[MFFO], *input_idx: np.ndarray) -> np.ndarray:
+    '''
+        Per frame (or pair of frames): an int for the values of OUTPUT_SPLIT_KEYS of its file(s).
+    '''
+    file_keys = {
+        kk: tuple(fobjs[kk].fits_header.get(key) for key in OUTPUT_SPLIT_KEYS)
+        for kk in np.unique(np.concatenate(input_idx))
+    }
+    key_codes: typ.Dict[typ.Tuple, int] = {}
+    return np.array([
+        key_codes.setdefault(tuple(file_keys[kk] for kk in kks), len(key_codes)) for kks in zip(*input_idx)
+    ])
+
+
+def _plan_group(fobjs: typ.List[MFFO], group: typ.List[int], cams: typ.List[int],
+                tolerance_us: typ.Optional[int]) -> typ.Tuple[_Frames, typ.Dict[int, _Frames], typ.List[PlannedOutput]]:
+    '''
+        Sync all the vcam1 frames of an overlapping group against all its vcam2 frames, in one go.
+        Pieces left unsynced by a file pair can still match the next file - no remainder files.
+
+        Returns the synced frame pairs, the strays (unsynced frames of partly synced files) per camera,
+        and the vsolo moves of the files that did not sync at all.
+    '''
+    outputs: typ.List[PlannedOutput] = []
+
+    files: typ.Dict[int, typ.List[int]] = {1: [], 2: []}
+    for kk in group:
+        files[cams[kk]].append(kk)
+
+    timings: typ.Dict[int, np.ndarray] = {}
+    input_idx: typ.Dict[int, np.ndarray] = {}
+    frame_idx: typ.Dict[int, np.ndarray] = {}
+    for cam in (1, 2):
+        timings[cam] = np.concatenate([fobjs[kk].txt_file_parser.fgrab_t_us for kk in files[cam]])  # type: ignore
+        input_idx[cam] = np.concatenate([np.full(fobjs[kk].get_nframes(), kk) for kk in files[cam]])
+        frame_idx[cam] = np.concatenate([np.arange(fobjs[kk].get_nframes()) for kk in files[cam]])
+
+    if tolerance_us is None:
+        tolerance_us = min(find_sync_tol_for_vamp(fobjs[kk]) for kk in group)
+    common_1, common_2 = sync_timing_arrays(timings[1], timings[2], tolerance_us=tolerance_us)
+    matched = {1: np.flatnonzero(common_1), 2: np.flatnonzero(common_2)}
+
+    synced = _Frames(0.5 * (timings[1][matched[1]] + timings[2][matched[2]]),
+                     {cam: input_idx[cam][matched[cam]] for cam in (1, 2)},
+                     {cam: frame_idx[cam][matched[cam]] for cam in (1, 2)})
+
+    # Unsynced frames: whole files move to vsolo, the strays of the others are written to vsolo
+    # - where the online remainders end up, once re-queued and seen again.
+    strays: typ.Dict[int, _Frames] = {}
+    for cam, common in ((1, common_1), (2, common_2)):
+        stray_sel: typ.List[np.ndarray] = []
+        position = 0
+        for kk in files[cam]:
+            n_frames = fobjs[kk].get_nframes()
+            unsynced = np.flatnonzero(~common[position:position + n_frames]) + position
+            position += n_frames
+            if len(unsynced) == 0:
+                continue
+            if len(unsynced) == n_frames:
+                outputs.append(_move_output(kk, fobjs[kk], STRFMT_VSOLO % cam, False))
+            else:
+                stray_sel.append(unsynced)
+
+        sel = np.concatenate(stray_sel) if len(stray_sel) > 0 else np.zeros(0, int)
+        strays[cam] = _Frames(timings[cam][sel], {cam: input_idx[cam][sel]}, {cam: frame_idx[cam][sel]})
+
+    return synced, strays, outputs
+
+
+def _plan_strays(fobjs: typ.List[MFFO], cam: int, strays: _Frames) -> typ.List[PlannedOutput]:
+    '''
+        Cut the strays of a camera (time-ordered, across groups) into vsolo outputs, U_SYNC False.
+    '''
+    outputs: typ.List[PlannedOutput] = []
+    if len(strays.t_us) == 0:
+        return outputs
+
+    input_idx, frame_idx = strays.input_idx[cam], strays.frame_idx[cam]
+    exptime_s = np.array([fobjs[kk].fits_header['EXPTIME'] for kk in input_idx], float)
+    for start, stop in _cut_output_spans(strays.t_us, _split_codes(fobjs, input_idx), exptime_s):
+        name = f'{fobjs[input_idx[start]].stream_from_filename}_{_tstr(strays.t_us[start] / 1e6)}.fits'
+        outputs.append(
+            PlannedOutput(STRFMT_VSOLO % cam, name, PLAN_ACTION.WRITE,
+                          _to_runs(input_idx[start:stop], frame_idx[start:stop]), False, None))
+    return outputs
+
+
+def _plan_vsync(fobjs: typ.List[MFFO], synced: _Frames, first_out: int) -> typ.List[PlannedOutput]:
+    '''
+        Cut the synced pairs (time-ordered, across groups) into vsync outputs - the same cuts
+        for both cameras, so that pairs stay pairs. first_out: output index of the first one.
+    '''
+    outputs: typ.List[PlannedOutput] = []
+    if len(synced.t_us) == 0:
+        return outputs
+
+    codes = _split_codes(fobjs, synced.input_idx[1], synced.input_idx[2])
+    exptime_s = np.array([fobjs[kk].fits_header['EXPTIME'] for kk in synced.input_idx[1]], float)
+
+    for start, stop in _cut_output_spans(synced.t_us, codes, exptime_s):
+        tstr = _tstr(synced.t_us[start] / 1e6)
+        partner = first_out + len(outputs)
+        for cam in (1, 2):
+            outputs.append(
+                PlannedOutput(STR_VSYNC, f'{STR_VSYNC}_{tstr}.cam{cam}.fits', PLAN_ACTION.WRITE,
+                              _to_runs(synced.input_idx[cam][start:stop], synced.frame_idx[cam][start:stop]),
+                              True, partner + 2 - cam))  # The other one
+    return outputs
+
+
+def plan_vampires_sync(fobjs: typ.Iterable[MFFO],
+                       tolerance_us: int = VAMPIRES_USEC_TOLERANCING,
+                       auto_tolerancing: bool = False) -> SyncPlan:
+    '''
+        Assign every frame of the vcam1 / vcam2 <fobjs> (all from the same <date> folder)
+        to a vsync / vsolo1 / vsolo2 / vbad output. Reads headers and timings only.
+    '''
+    fobjs = list(fobjs)
+    starts_unsorted = [fobj.get_start_unixtime_secs() for fobj in fobjs]
+    order = np.argsort(starts_unsorted, kind='stable')
+    fobjs = [fobjs[kk] for kk in order]
+    starts = [starts_unsorted[kk] for kk in order]
+
+    folders = set(fobj.full_filepath.parent.parent for fobj in fobjs)
+    if len(folders) != 1:
+        message = f'plan_vampires_sync: need files from exactly one <date> folder - got {folders}'
+        logg.critical(message)
+        raise AssertionError(message)
+
+    outputs: typ.List[PlannedOutput] = []
+    cams = [_cam_index(fobj) for fobj in fobjs]
+    finishes = [0.0] * len(fobjs)
+
+    syncable: typ.List[int] = []
+    for kk, fobj in enumerate(fobjs):
+        if is_bad_vamp_file(fobj):
+            logg.error(f'plan_vampires_sync - BAD FILE {fobj.file_name}')
+            outputs.append(_move_output(kk, fobj, STR_VBAD, None))
+        elif is_trivial_solo_vamp_file(fobj):
+            outputs.append(_move_output(kk, fobj, STRFMT_VSOLO % cams[kk], False))
+        else:
+            finishes[kk] = fobj.get_finish_unixtime_secs()
+            syncable.append(kk)
+
+    group_tolerance = None if auto_tolerancing else tolerance_us
+    all_synced: typ.List[_Frames] = []
+    all_strays: typ.Dict[int, typ.List[_Frames]] = {1: [], 2: []}
+    for group in _overlap_groups(syncable, starts, finishes):
+        group_cams = set(cams[kk] for kk in group)
+        if len(group_cams) == 1:
+            # No temporally overlapping file.
+            for kk in group:
+                outputs.append(_move_output(kk, fobjs[kk], STRFMT_VSOLO % cams[kk], False))
+        else:
+            synced, strays, group_outputs = _plan_group(fobjs, group, cams, group_tolerance)
+            all_synced.append(synced)
+            for cam in (1, 2):
+                all_strays[cam].append(strays[cam])
+            outputs += group_outputs
+
+    # Groups are in time order - vsync / vsolo outputs may span several groups.
+    if len(all_synced) > 0:
+        for cam in (1, 2):
+            outputs += _plan_strays(fobjs, cam, _Frames.concatenate(all_strays[cam]))
+        outputs += _plan_vsync(fobjs, _Frames.concatenate(all_synced), len(outputs))
+
+    names = [(out.stream, out.name) for out in outputs]
+    if len(set(names)) != len(names):
+        message = f'plan_vampires_sync: output name collision in {folders}'
+        logg.critical(message)
+        raise AssertionError(message)
+
+    return SyncPlan(str(folders.pop()), [(str(fobj.full_filepath), fobj.get_nframes()) for fobj in fobjs],
+                    outputs, group_tolerance)
+
+
+def _open_input(path: str) -> MFFO:
+    if path.endswith('.fitsframes'):
+        return FrameListFitsFileObj(path)
+    if path.endswith('.fits.fz'):
+        return FitsFzFileObj(path)
+    return FitsFileObj(path)
+
+
+def _output_refs(output: PlannedOutput, fobjs: typ.List[MFFO]) -> FrameRefs:
+    '''
+        The frames of <output> - for .fitsframes inputs, the frames they reference.
+    '''
+    paths: typ.Dict[str, int] = {}
+    path_idx: typ.List[np.ndarray] = []
+    frame_idx: typ.List[np.ndarray] = []
+    for kk, first, count in output.runs:
+        fobj = fobjs[kk]
+        frames = np.arange(first, first + count)
+        if isinstance(fobj, FrameListFitsFileObj):
+            in_refs = fobj.get_frame_refs()
+            table = np.array([paths.setdefault(str(path), len(paths)) for path in in_refs.paths], np.int32)
+            path_idx.append(table[in_refs.path_idx[frames]])
+            frame_idx.append(in_refs.frame_idx[frames])
+        else:
+            path_idx.append(np.full(count, paths.setdefault(str(fobj.full_filepath), len(paths)), np.int32))
+            frame_idx.append(frames)
+
+    return FrameRefs(np.array(list(paths), dtype=str), np.concatenate(path_idx).astype(np.int32),
+                     np.concatenate(frame_idx).astype(np.int64))
+
+
+def _output_parser(output: PlannedOutput, fobjs: typ.List[MFFO]) -> LogshimTxtParser:
+    parsers = []
+    for kk, first, count in output.runs:
+        assert fobjs[kk].txt_file_parser is not None
+        parsers.append(fobjs[kk].txt_file_parser.sub_parser_by_selection('x', np.arange(first, first + count)))
+    return parsers[0].concatenated_with(*parsers[1:])
+
+
+def _build_output(plan: SyncPlan, output: PlannedOutput, refs: FrameRefs, fobjs: typ.List[MFFO],
+                  framelist_output: bool, source_cache: typ.Dict[str, FrameSource]) -> MFFO:
+    parser = _output_parser(output, fobjs)
+    if output.sync_partner is not None:
+        # Force synced timings on both cameras' files.
+        partner_parser = _output_parser(plan.outputs[output.sync_partner], fobjs)
+        timings = 0.5 * (parser.fgrab_t_us + partner_parser.fgrab_t_us)
+        parser.fgrab_t_us = timings
+        parser.logshim_t_us = timings
+
+    header = fobjs[output.runs[0][0]].fits_header.copy()
+    header['NAXIS3'] = refs.n_frames
+    fix_header_times(header, parser.fgrab_t_us[0] / 1e6, parser.fgrab_t_us[-1] / 1e6)
+    if output.u_sync is not None:
+        header[U_SYNC_KEY] = output.u_sync
+
+    path = Path(plan.folder) / output.stream / output.name
+    if framelist_output:
+        flist_path = '.fitsframes'.join(str(path).rsplit('.fits', 1))
+        return FrameListFitsFileObj(flist_path, on_disk=False, header=header, data=refs, txt_parser=parser)
+
+    data = file_tools.frame_selection_from_refs(refs, source_cache=source_cache, what=str(path))
+    header['NAXIS1'] = data.frame_shape[-1]
+    header['NAXIS2'] = data.frame_shape[-2]
+    return FitsFileObj(path, on_disk=False, header=header, data=data, txt_parser=parser)
+
+
+def _whole_file_list(plan: SyncPlan, output: PlannedOutput, fobjs: typ.List[MFFO]) -> FrameListFitsFileObj:
+    '''
+        A MOVE output, as a framelist: all the frames of the input, which stays where it is.
+        Header and timings as they are - bad files may have no (usable) txt file.
+    '''
+    fobj = fobjs[output.runs[0][0]]
+    header = fobj.fits_header.copy()
+    if output.u_sync is not None:
+        header[U_SYNC_KEY] = output.u_sync
+    n_frames = fobj.get_nframes()
+    parser = None
+    if fobj.txt_file_parser is not None:
+        parser = fobj.txt_file_parser.sub_parser_by_selection('x', np.arange(n_frames))
+
+    path = Path(plan.folder) / output.stream / output.name
+    flist_path = '.fitsframes'.join(str(path).rsplit('.fits', 1))
+    return FrameListFitsFileObj(flist_path, on_disk=False, header=header, data=_output_refs(output, fobjs),
+                                txt_parser=parser)
+
+
+def _drop_txt_file(fobj: MFFO) -> None:
+    '''
+        The txt file (and timing sidecar) of an input that stays on disk only for the lists that
+        reference its frames - each list has its own txt file.
+    '''
+    if not fobj.txt_exists:
+        return
+    os.remove(fobj.txt_file_path)
+    try:
+        os.remove(timing_sidecar_path(fobj.txt_file_path))
+    except FileNotFoundError:
+        pass
+    fobj.disown_txt_file()
+
+
+def execute_sync_plan(plan: SyncPlan, framelist_output: bool = False, delete_inputs: bool = True) -> None:
+    '''
+        Write each output of <plan> once.
+
+        framelist_output: write .fitsframes lists referencing the input FITS frames - rather than cubes.
+            Whole-file (MOVE) outputs are lists too, the input FITS files stay where they are.
+            Otherwise, MOVE outputs are the input files, moved to their stream.
+        delete_inputs: then delete the inputs that were written out. Those that the lists reference
+            stay, without their txt files (the vcam*_hlinkbak backups of scxkw-vamp-syncdeint have them).
+    '''
+    fobjs = [_open_input(path) for path, _ in plan.inputs]
+    for fobj, (path, n_frames) in zip(fobjs, plan.inputs):
+        if fobj.get_nframes() != n_frames:
+            message = (f'execute_sync_plan: {path} has {fobj.get_nframes()} frames, '
+                       f'{n_frames} in the plan - out of date?')
+            logg.critical(message)
+            raise AssertionError(message)
+
+    # Inputs are sorted by start time: in order of their first frame, the outputs are written
+    # roughly in time order and each input's source is only open for a while.
+    writes = sorted((out for out in plan.outputs if out.action == PLAN_ACTION.WRITE),
+                    key=lambda out: out.runs[0][:2])
+    writes_refs = [_output_refs(output, fobjs) for output in writes]
+    last_use: typ.Dict[str, int] = {}
+    for kk, refs in enumerate(writes_refs):
+        last_use.update((str(path), kk) for path in refs.paths)
+
+    source_cache: typ.Dict[str, FrameSource] = {}
+    referenced: typ.Set[str] = set()
+    for kk, (output, refs) in enumerate(zip(writes, writes_refs)):
+        out_fobj = _build_output(plan, output, refs, fobjs, framelist_output, source_cache)
+        out_fobj.write_to_disk(try_flush_ram=True)
+        if framelist_output:
+            referenced.update(str(path) for path in refs.paths)
+        for path in refs.paths:
+            if last_use[str(path)] == kk and str(path) in source_cache:
+                source_cache.pop(str(path)).close()
+
+    moved: typ.Set[int] = set()
+    for output in plan.outputs:
+        if output.action != PLAN_ACTION.MOVE:
+            continue
+        kk = output.runs[0][0]
+        if framelist_output:
+            _whole_file_list(plan, output, fobjs).write_to_disk()
+            referenced.update(str(path) for path in _output_refs(output, fobjs).paths)
+            continue
+        if output.u_sync is not None:
+            fobjs[kk].edit_header(U_SYNC_KEY, output.u_sync)
+        fobjs[kk].move_file_to_streamname(output.stream)
+        moved.add(kk)
+
+    if delete_inputs:
+        for kk, fobj in enumerate(fobjs):
+            if kk in moved:
+                continue
+            if str(fobj.full_filepath) in referenced:
+                _drop_txt_file(fobj)
+            else:
+                fobj.delete_from_disk(try_purge_ram=True, silent_fail=True)
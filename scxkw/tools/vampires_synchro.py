@@ -6,7 +6,10 @@ import logging
 logg = logging.getLogger(__name__)
 logg.setLevel(logging.DEBUG)
 
+import heapq
+import itertools
 import time
+from collections import deque
 import numpy as np
 
 from scxkw.config import GEN2PATH_PRELIM
@@ -27,6 +30,126 @@ U_SYNC_KEY = 'U_SYNC'
 
 VAMPIRES_USEC_TOLERANCING = 400
 
+# Output files: at most OUTPUT_MAX_SPAN_SEC long, cut at gaps > OUTPUT_MAX_GAP_SEC
+# and when any of OUTPUT_SPLIT_KEYS changes.
+OUTPUT_MAX_SPAN_SEC = 10.0
+OUTPUT_MAX_GAP_SEC = 3.0
+OUTPUT_SPLIT_KEYS = ('EXPTIME', 'NAXIS1', 'NAXIS2', 'RET-ANG1', 'FILTER01', 'FILTER02')
+
+# Unsynced frames of a file synced above that ratio are not worth a vsolo file.
+SOLO_REMAINDER_MAX_RATIO = 0.95
+
+# seen_before only matters for remainders of the files being synced - which start after them.
+# Forget files starting that long before the last file popped.
+SEEN_BEFORE_RETENTION_SEC = 600.0
+
+
+class FileTimeQueue:
+    '''
+        File objects by start time: a heap keyed on get_start_unixtime_secs (computed once, at push),
+        and an index by path so that re-feeding a file doesn't queue it twice.
+
+        Heap entries of files popped or replaced are left in the heap and skipped when they surface.
+    '''
+
+    def __init__(self) -> None:
+        self.heap: typ.List[typ.Tuple[float, int, str]] = []
+        self.index: typ.Dict[str, typ.Tuple[int, float, MFFO]] = {}  # path: (seq, start time, file)
+        self.counter = itertools.count()
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def __contains__(self, path: str) -> bool:
+        return path in self.index
+
+    def push(self, file_obj: MFFO, start_time: typ.Optional[float] = None) -> float:
+        '''
+            Returns the start time of the file (the sort key).
+        '''
+        if start_time is None:
+            start_time = file_obj.get_start_unixtime_secs()
+        seq = next(self.counter)
+        self.index[str(file_obj.full_filepath)] = (seq, start_time, file_obj)
+        heapq.heappush(self.heap, (start_time, seq, str(file_obj.full_filepath)))
+        return start_time
+
+    def _prune(self) -> None:
+        while len(self.heap) > 0:
+            _, seq, path = self.heap[0]
+            if path in self.index and self.index[path][0] == seq:
+                return
+            heapq.heappop(self.heap)  # Stale
+
+    def peek(self) -> typ.Tuple[float, MFFO]:
+        self._prune()
+        _, start_time, file_obj = self.index[self.heap[0][2]]
+        return start_time, file_obj
+
+    def pop(self) -> typ.Tuple[float, MFFO]:
+        self._prune()
+        _, _, path = heapq.heappop(self.heap)
+        _, start_time, file_obj = self.index.pop(path)
+        return start_time, file_obj
+
+
+class SyncOutputBuilder:
+    '''
+        The pending output file of one camera: the synced pieces (in-RAM sub-files, whose data are
+        frame references) that will make it up, in order.
+
+        Pieces are only referenced as they come. The output header, txt and data are built once,
+        by materialize, when the file is written - rather than a merge_with_file_after per piece.
+    '''
+
+    def __init__(self, pieces: typ.List[MFFO]) -> None:
+        self.pieces = pieces
+        self.start_time = pieces[0].get_start_unixtime_secs()
+        self.finish_time = pieces[-1].get_finish_unixtime_secs()
+
+    @property
+    def fits_header(self):
+        return self.pieces[0].fits_header
+
+    def append(self, file_obj: MFFO) -> None:
+        self.pieces.append(file_obj)
+        self.finish_time = file_obj.get_finish_unixtime_secs()
+
+    def fgrab_t_us(self) -> np.ndarray:
+        assert all(piece.txt_file_parser is not None for piece in self.pieces)
+        return np.concatenate([piece.txt_file_parser.fgrab_t_us for piece in self.pieces])  # type: ignore
+
+    def split(self, selector: np.ndarray) -> \
+            typ.Tuple[typ.Optional[SyncOutputBuilder], typ.Optional[SyncOutputBuilder]]:
+        '''
+            (selected frames, other frames) - None if empty. Only pieces straddling the cut are split.
+        '''
+        if np.all(selector):
+            return self, None
+        if not np.any(selector):
+            return None, self
+
+        head: typ.List[MFFO] = []
+        tail: typ.List[MFFO] = []
+        position = 0
+        for piece in self.pieces:
+            piece_selector = selector[position:position + piece.get_nframes()]
+            position += piece.get_nframes()
+            if np.all(piece_selector):
+                head.append(piece)
+            elif not np.any(piece_selector):
+                tail.append(piece)
+            else:
+                head.append(piece.sub_file_nodisk(piece_selector))
+                tail.append(piece.sub_file_nodisk(~piece_selector))
+
+        return SyncOutputBuilder(head), SyncOutputBuilder(tail)
+
+    def materialize(self) -> MFFO:
+        if len(self.pieces) == 1:
+            return self.pieces[0]
+        return self.pieces[0].merge_with_files_after(self.pieces[1:])
+
 
 class VampiresSynchronizer:
 
@@ -34,9 +157,9 @@ class VampiresSynchronizer:
                  tolerancing_us: int = VAMPIRES_USEC_TOLERANCING,
                  auto_tolerancing: bool = False) -> None:
 
-        self.queue1: typ.List[MFFO] = []
-        self.queue2: typ.List[MFFO] = []
-        self.queue_dict_p: typ.Dict[int, typ.List[MFFO]] = {
+        self.queue1 = FileTimeQueue()
+        self.queue2 = FileTimeQueue()
+        self.queue_dict_p: typ.Dict[int, FileTimeQueue] = {
             1: self.queue1,
             2: self.queue2
         }
@@ -47,41 +170,50 @@ class VampiresSynchronizer:
         self.tolerance_usec = tolerancing_us
         self.auto_tol = auto_tolerancing
 
-        self.seen_before: typ.Set[str] = set(
-        )  # TODO sanitize from very old files to avoid growing indefinitely.
+        # path: start time - evicted by time, see _evict_seen_before.
+        self.seen_before: typ.Dict[str, float] = {}
+        self.seen_before_heap: typ.List[typ.Tuple[float, str]] = []
 
-        self.out_files: typ.Dict[int, OpT_MFFO] = {1: None, 2: None}
-        self.out_queues: typ.Dict[int, typ.List[MFFO]] = {1: [], 2: []}
+        self.out_files: typ.Dict[int, typ.Optional[SyncOutputBuilder]] = {1: None, 2: None}
+        self.out_queues: typ.Dict[int, typ.Deque[MFFO]] = {1: deque(), 2: deque()}
 
     def feed_file_objs(self, file_objs: typ.Iterable[MFFO]):
-        # We make sets to avoid the queues growing forever with repeated calls that pushes the same file over and over.
-        qdict1 = {str(file.full_filepath): file for file in self.queue1}
-        qdict2 = {str(file.full_filepath): file for file in self.queue2}
-
         for file_obj in file_objs:
             logg.info(
                 f'VampiresSynchronizer::feed_file_objs - file {file_obj.file_name}'
             )
-            if file_obj.stream_from_foldername == STR_VCAM1:
-                qdict1[str(file_obj.full_filepath)] = file_obj
-            elif file_obj.stream_from_foldername == STR_VCAM2:
-                qdict2[str(file_obj.full_filepath)] = file_obj
-            else:
-                message = (f'VampiresSynchronizer::feed_file_objs - '
-                           f'invalid stream {file_obj.stream_from_foldername}')
-                logg.critical(message)
-                raise ValueError(message)
-            self.seen_before.add(str(file_obj))
-
-        # Re-sort queues by time/name
-        self.queue1 = list([qdict1[fn] for fn in qdict1])
-        self.queue2 = list([qdict2[fn] for fn in qdict2])
-        self.queue_dict_p: typ.Dict[int, typ.List[MFFO]] = {
-            1: self.queue1,
-            2: self.queue2
-        }
-        self.queue1.sort(key=lambda fobj: fobj.get_start_unixtime_secs())
-        self.queue2.sort(key=lambda fobj: fobj.get_start_unixtime_secs())
+            # Files already queued are skipped: we don't want the queues growing with repeated calls
+            # that push the same file over and over, nor to recompute their start times.
+            self._enqueue(file_obj, replace=False)
+
+    def _enqueue(self, file_obj: MFFO, replace: bool) -> None:
+        '''
+            replace: a file rewritten at the path of a queued one (remainders) supersedes it.
+        '''
+        if file_obj.stream_from_foldername == STR_VCAM1:
+            queue = self.queue1
+        elif file_obj.stream_from_foldername == STR_VCAM2:
+            queue = self.queue2
+        else:
+            message = (f'VampiresSynchronizer::feed_file_objs - '
+                       f'invalid stream {file_obj.stream_from_foldername}')
+            logg.critical(message)
+            raise ValueError(message)
+
+        if not replace and str(file_obj.full_filepath) in queue:
+            return
+        start_time = queue.push(file_obj)
+
+        if str(file_obj) not in self.seen_before:
+            self.seen_before[str(file_obj)] = start_time
+            heapq.heappush(self.seen_before_heap, (start_time, str(file_obj)))
+
+    def _evict_seen_before(self, current_time: float) -> None:
+        limit = current_time - SEEN_BEFORE_RETENTION_SEC
+        while len(self.seen_before_heap) > 0 and self.seen_before_heap[0][0] < limit:
+            start_time, name = heapq.heappop(self.seen_before_heap)
+            if self.seen_before.get(name) == start_time:
+                del self.seen_before[name]
 
     def process_queues(self, throtle_down: int = 30) -> bool:
         status = True
@@ -102,51 +234,38 @@ class VampiresSynchronizer:
     def process_out_queue_oneshot(self, idx: int) -> bool:
 
         # No files
-        file = self.out_files[idx]
-        if file is None:
+        builder = self.out_files[idx]
+        if builder is None:
             if len(self.out_queues[idx]) == 0:
                 return False
             else:
-                file = self.out_queues[idx].pop(0)
-                self.out_files[idx] = file
+                builder = SyncOutputBuilder([self.out_queues[idx].popleft()])
+                self.out_files[idx] = builder
 
         # File is big enough by itself
-        assert file is not None
-        if (file.get_finish_unixtime_secs() - file.get_start_unixtime_secs()
-                > 10.0):
-            assert file.txt_file_parser is not None
-
+        assert builder is not None
+        if builder.finish_time - builder.start_time > OUTPUT_MAX_SPAN_SEC:
             # Offset by 1 EXPTIME, the same way as for get_start_unixtime
             # This matters for exposures.... well, longer than 10 sec.
-            selector = (file.txt_file_parser.fgrab_t_us / 1e6 -
-                        file.fits_header['EXPTIME'] -
-                        file.get_start_unixtime_secs()) < 10.0
-            if sum(selector) > 0:
-                file_0 = file.sub_file_nodisk(selector)
-
-                assert file_0.stream_from_foldername == 'vsync' and '.cam' in file_0.file_name  # TODO remove once confident
-                file_0.write_to_disk(try_flush_ram=True)
-
-            if sum(~selector) > 0:
-                file_1 = file.sub_file_nodisk(~selector)
-                self.out_files[idx] = file_1
-                # Must return false if this file is ALL the frames. We've done nothing really.
-                # Otherwise this creates an infinite loop.
-                if sum(selector) == 0:
-                    return False
-            else:
-                self.out_files[idx] = None
-
-            return True
+            selector = (builder.fgrab_t_us() / 1e6 -
+                        builder.fits_header['EXPTIME'] -
+                        builder.start_time) < OUTPUT_MAX_SPAN_SEC
+            builder_0, builder_1 = builder.split(selector)
+            if builder_0 is not None:
+                self._write_out_file(builder_0)
+
+            self.out_files[idx] = builder_1
+            # Must return false if this file is ALL the frames. We've done nothing really.
+            # Otherwise this creates an infinite loop.
+            return builder_0 is not None
 
         now = time.time()
 
         # There is no next file AND the input queues are empty AND we've waited 30 seconds
         if (len(self.out_queues[idx]) == 0 and len(self.queue1) == 0
                 and len(self.queue2) == 0
-                and (now - file.get_finish_unixtime_secs()) > 30.0):
-            assert file.stream_from_foldername == 'vsync' and '.cam' in file.file_name  # TODO remove once confident
-            file.write_to_disk(try_flush_ram=True)
+                and (now - builder.finish_time) > 30.0):
+            self._write_out_file(builder)
             self.out_files[idx] = None
 
             return True
@@ -154,30 +273,20 @@ class VampiresSynchronizer:
         # There is a next file
 
         if len(self.out_queues[idx]) > 0:
-            next_file = self.out_queues[idx].pop(0)
+            next_file = self.out_queues[idx].popleft()
+            header = builder.fits_header
 
             # and some critical parameters have changed OR
             # and there's 3 second gap
-            if (next_file.fits_header['EXPTIME'] != file.fits_header['EXPTIME']
-                    or next_file.fits_header['NAXIS1']
-                    != file.fits_header['NAXIS1']
-                    or next_file.fits_header['NAXIS2']
-                    != file.fits_header['NAXIS2']
-                    or next_file.fits_header['RET-ANG1']
-                    != file.fits_header['RET-ANG1']
-                    or next_file.fits_header["FILTER01"]
-                    != file.fits_header["FILTER01"]
-                    or next_file.fits_header["FILTER02"]
-                    != file.fits_header["FILTER02"]
+            if (any(next_file.fits_header[key] != header[key] for key in OUTPUT_SPLIT_KEYS)
                     or next_file.get_start_unixtime_secs() -
-                    file.get_finish_unixtime_secs() > 3.0):
-                assert file.stream_from_foldername == 'vsync' and '.cam' in file.file_name  # TODO remove once confident
-                file.write_to_disk(try_flush_ram=True)
-                self.out_files[idx] = next_file
+                    builder.finish_time > OUTPUT_MAX_GAP_SEC):
+                self._write_out_file(builder)
+                self.out_files[idx] = SyncOutputBuilder([next_file])
                 return True
 
             # and there's no big gap - FIXME TODO try if possible to split before merging.
-            self.out_files[idx] = file.merge_with_file_after(next_file)
+            builder.append(next_file)
 
             return True
 
@@ -185,29 +294,31 @@ class VampiresSynchronizer:
         # and we have no next file...
         return False
 
-    def find_pop_earliest_file(self) -> typ.Tuple[typ.Optional[MFFO], int]:
-        if len(self.queue1) == 0 and len(self.queue2) == 0:
-            return None, 0
-
-        if len(self.queue1) > 0 and len(self.queue2) == 0:
-            return self.queue1.pop(0), 1
+    def _write_out_file(self, builder: SyncOutputBuilder) -> None:
+        file = builder.materialize()
+        assert file.stream_from_foldername == 'vsync' and '.cam' in file.file_name  # TODO remove once confident
+        file.write_to_disk(try_flush_ram=True)
+
+    def find_pop_earliest_file(self) -> typ.Tuple[typ.Optional[MFFO], int, float]:
+        while len(self.queue1) > 0 or len(self.queue2) > 0:
+            if len(self.queue2) == 0:
+                idx = 1
+            elif len(self.queue1) == 0:
+                idx = 2
+            else:
+                idx = 1 if self.queue1.peek()[0] < self.queue2.peek()[0] else 2
 
-        if len(self.queue1) == 0 and len(self.queue2) > 0:
-            return self.queue2.pop(0), 2
+            start_time, file = self.queue_dict_p[idx].pop()
 
-        time_q1 = self.queue1[0].get_start_unixtime_secs()
-        time_q2 = self.queue2[0].get_start_unixtime_secs()
-        if time_q1 < time_q2:
-            file, idx = self.queue1.pop(0), 1
-        else:
-            file, idx = self.queue2.pop(0), 2
+            if not file.check_existence_on_disk():
+                logg.error(f'VampiresSynchronizer::find_pop_earliest_file - '
+                           f'{file} not on disk.')
+                continue
 
-        if not file.check_existence_on_disk():
-            logg.error(f'VampiresSynchronizer::find_pop_earliest_file - '
-                       f'{file} not on disk.')
-            return self.find_pop_earliest_file()  # reCURSE.
+            self._evict_seen_before(start_time)
+            return file, idx, start_time
 
-        return file, idx
+        return None, 0, 0.0
 
     def process_queue_oneshot(self) -> bool:
         '''
@@ -217,7 +328,7 @@ class VampiresSynchronizer:
             queue, because they eventually get deleted.
         '''
 
-        earliest_file, v_idx = self.find_pop_earliest_file()  # POPPED
+        earliest_file, v_idx, earliest_start = self.find_pop_earliest_file()  # POPPED
         if earliest_file is None:  # Both queues empty.
             return False
 
@@ -245,11 +356,10 @@ class VampiresSynchronizer:
         if len(self.queue_dict_p[v_other_idx]) == 0:
             to_match_file = None
         else:
-            to_match_file = self.queue_dict_p[v_other_idx][0]  # NOT POPPED
+            to_match_start, to_match_file = self.queue_dict_p[v_other_idx].peek()  # NOT POPPED
 
         # to_match_file that starts without an overlap.
-        if to_match_file is not None and to_match_file.get_start_unixtime_secs(
-        ) > time_finish_file:
+        if to_match_file is not None and to_match_start > time_finish_file:
             logg.warning(
                 f'VampiresSynchronizer::process_queue_oneshot - '
                 f'{earliest_file.file_name} has no temporally overlapping file.'
@@ -274,20 +384,20 @@ class VampiresSynchronizer:
                     f'{earliest_file.file_name} has no other stream file for now.'
                 )
                 # We need to re-queue
-                self.queue_dict_p[v_idx].insert(0, earliest_file)
+                self.queue_dict_p[v_idx].push(earliest_file, earliest_start)
                 return False
         '''
         We now have a guaranteed temporal overlap between earliest_file and to_match_file.
         '''
         # We pop the to_merge_file for good, it's gonna be affected.
-        _ = self.queue_dict_p[v_other_idx].pop(0)
+        _ = self.queue_dict_p[v_other_idx].pop()
 
         # Could be a badfile
         if self.is_bad_file(to_match_file):
             logg.error(
                 f'VampiresSynchronizer::process_queue_oneshot - BAD FILE')
             to_match_file.move_file_to_streamname(STR_VBAD)
-            self.queue_dict_p[v_idx].insert(0, earliest_file)  # Re-enqueue
+            self.queue_dict_p[v_idx].push(earliest_file, earliest_start)  # Re-enqueue
             return True
         # Could be that the to_match_file is a single frame OR has no EXTTRIG
         if self.is_trivial_solo_vamp_file(to_match_file):
@@ -295,7 +405,7 @@ class VampiresSynchronizer:
                       f'{to_match_file.file_name} is trivial vsolo.')
             to_match_file.edit_header(U_SYNC_KEY, False)
             to_match_file.move_file_to_streamname(STRFMT_VSOLO % v_other_idx)
-            self.queue_dict_p[v_idx].insert(0, earliest_file)  # Re-enqueue
+            self.queue_dict_p[v_idx].push(earliest_file, earliest_start)  # Re-enqueue
             return True
 
         if v_idx == 1:
@@ -321,8 +431,6 @@ class VampiresSynchronizer:
             fobj_merge_2.txt_file_parser.fgrab_t_us = timings
             fobj_merge_1.txt_file_parser.logshim_t_us = timings
             fobj_merge_2.txt_file_parser.logshim_t_us = timings
-            fobj_merge_1.txt_file_parser._regenerate_lines_from_arrays()
-            fobj_merge_2.txt_file_parser._regenerate_lines_from_arrays()
 
             fobj_merge_1.rename_from_first_frame()
             fobj_merge_2.rename_from_first_frame()
@@ -349,38 +457,46 @@ class VampiresSynchronizer:
                 fobj_remainder_1) in self.seen_before:
             fobj_remainder_1.edit_header(U_SYNC_KEY, False)
             fobj_remainder_1.move_file_to_streamname(STRFMT_VSOLO % 1)
-            b = save_to_disk_if(fobj_remainder_1, 1, r1 < 0.95)
+            b = save_to_disk_if(fobj_remainder_1, 1, r1 < SOLO_REMAINDER_MAX_RATIO)
             logg.debug(f'A branch: {r1} - {fobj_remainder_1} - {b}')
-        elif save_to_disk_if(fobj_remainder_1, 1, r1 < 0.95):
+        elif save_to_disk_if(fobj_remainder_1, 1, r1 < SOLO_REMAINDER_MAX_RATIO):
             assert fobj_remainder_1 is not None  # mypy
-            self.feed_file_objs([fobj_remainder_1])
+            self._enqueue(fobj_remainder_1, replace=True)
             logg.debug(f'B branch: {r1} - {fobj_remainder_1}')
 
         if fobj_remainder_2 is not None and str(
                 fobj_remainder_2) in self.seen_before:
             fobj_remainder_2.edit_header(U_SYNC_KEY, False)
             fobj_remainder_2.move_file_to_streamname(STRFMT_VSOLO % 2)
-            b = save_to_disk_if(fobj_remainder_2, 1, r2 < 0.95)
+            b = save_to_disk_if(fobj_remainder_2, 1, r2 < SOLO_REMAINDER_MAX_RATIO)
             logg.debug(f'C branch: {r2} - {fobj_remainder_2} - {b}')
-        elif save_to_disk_if(fobj_remainder_2, 1, r2 < 0.95):
+        elif save_to_disk_if(fobj_remainder_2, 1, r2 < SOLO_REMAINDER_MAX_RATIO):
             assert fobj_remainder_2 is not None  # mypy
-            self.feed_file_objs([fobj_remainder_2])
+            self._enqueue(fobj_remainder_2, replace=True)
             logg.debug(f'D branch: {r2} - {fobj_remainder_2}')
 
         return True
 
     def is_trivial_solo_vamp_file(self, file: MFFO) -> bool:
-        # We can only synchro if the cameras are in exttrig
-        return file.fits_header['EXTTRIG'] is False
+        return is_trivial_solo_vamp_file(file)
 
     def is_bad_file(self, file: MFFO) -> bool:
-        # We need EXPTIME and DET-NSMP because they allow to calculate the start and end
-        # of a single frame file properly and give it some temporal "thickness"
-        return (file.txt_file_parser is None
-                or file.get_nframes() != len(file.txt_file_parser.fgrab_t_us)
-                or file.fits_header is None
-                or not 'EXPTIME' in file.fits_header
-                or file.fits_header['EXPTIME'] is None)
+        return is_bad_vamp_file(file)
+
+
+def is_trivial_solo_vamp_file(file: MFFO) -> bool:
+    # We can only synchro if the cameras are in exttrig
+    return file.fits_header['EXTTRIG'] is False
+
+
+def is_bad_vamp_file(file: MFFO) -> bool:
+    # We need EXPTIME and DET-NSMP because they allow to calculate the start and end
+    # of a single frame file properly and give it some temporal "thickness"
+    return (file.txt_file_parser is None
+            or file.get_nframes() != len(file.txt_file_parser.fgrab_t_us)
+            or file.fits_header is None
+            or not 'EXPTIME' in file.fits_header
+            or file.fits_header['EXPTIME'] is None)
 
 
 def save_to_disk_if(file_obj: OpT_MFFO,